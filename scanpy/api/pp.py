@@ -1,10 +1,12 @@
 from ..preprocessing.recipes import recipe_zheng17, recipe_weinreb17, recipe_seurat
-from ..preprocessing.simple import filter_cells, filter_genes
+from ..preprocessing.simple import filter_cells, filter_genes, filter_cells_and_genes
 from ..preprocessing._deprecated.highly_variable_genes import filter_genes_dispersion
 from ..preprocessing.highly_variable_genes import highly_variable_genes
 from ..preprocessing.simple import log1p, sqrt, pca, normalize_per_cell, regress_out, scale, subsample, downsample_counts
 from ..preprocessing.qc import calculate_qc_metrics
+from ..preprocessing.size_factors import pooled_size_factors
 from ..preprocessing.mnn_correct import mnn_correct
 from ..preprocessing.dca import dca
 from ..preprocessing.magic import magic
 from ..neighbors import neighbors
+from ..preprocessing.lazy import Plan
@@ -6,13 +6,14 @@ from ..tools.draw_graph import draw_graph
 
 from ..tools.paga import paga, paga_degrees, paga_expression_entropies, paga_compare_paths
 from ..tools.rank_genes_groups import rank_genes_groups
+from ..tools.aggregate import aggregate
 from ..tools.dpt import dpt
 from ..tools.louvain import louvain
 from ..tools.graph_clustering import graph_clustering
 from ..tools.sim import sim
 from ..tools.top_genes import correlation_matrix, ROC_AUC_analysis
 
-from ..tools.score_genes import score_genes, score_genes_cell_cycle
+from ..tools.score_genes import score_genes, score_genes_multi, score_genes_cell_cycle
 
 from ..tools.pypairs import cyclone, sandbag
 
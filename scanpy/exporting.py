@@ -10,6 +10,8 @@ import json
 import logging as logg
 from pandas.api.types import is_categorical
 
+from .preprocessing._utils import _get_mean_var
+
 
 
 def spring_project(
@@ -205,17 +207,7 @@ def spring_project(
 
 
 def get_mean_var(X):
-    mean = X.mean(axis=0)
-    if scipy.sparse.issparse(X):
-        mean_sq = X.multiply(X).mean(axis=0)
-        mean = mean.A1
-        mean_sq = mean_sq.A1
-    else:
-        mean_sq = np.multiply(X, X).mean(axis=0)
-    # enforce R convention (unbiased estimator) for variance
-    var = (mean_sq - mean**2) * (X.shape[0]/(X.shape[0]-1))
-
-    return mean, var
+    return _get_mean_var(X)
 
 def get_edges(adata):
     if 'distances' in adata.uns['neighbors']:  # these are sparse matrices
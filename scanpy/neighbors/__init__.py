@@ -13,6 +13,12 @@ from .. utils import doc_params
 from .. import utils
 from ..tools._utils import choose_representation, doc_use_rep, doc_n_pcs
 
+# install dask if available
+try:
+    import dask.array as da
+except ImportError:
+    da = None
+
 N_DCS = 15  # default number of diffusion components
 N_PCS = 50  # default number of PCs
 
@@ -254,6 +260,46 @@ def compute_neighbors_umap(
     return knn_indices, knn_dists
 
 
+def compute_neighbors_dask(X, n_neighbors, metric='euclidean', metric_kwds={}):
+    """Exact nearest neighbors of the rows of a dask array.
+
+    The neighbors of each block of rows are searched in every block of rows
+    separately; the candidates of all blocks are merged afterwards. Only
+    blocks of `n_neighbors` candidates are held in memory per pair of blocks.
+
+    Returns
+    -------
+    knn_indices, knn_dists : np.arrays of shape (n_observations, n_neighbors)
+    """
+    from dask import compute, delayed
+    X = X.rechunk({1: -1})
+    blocks = X.to_delayed().ravel()
+    offsets = np.concatenate([[0], np.cumsum(X.chunks[0])])
+
+    def search(query, data, offset):
+        D = pairwise_distances(query, data, metric=metric, **metric_kwds)
+        indices, distances = get_indices_distances_from_dense_matrix(
+            D, min(n_neighbors, D.shape[1]))
+        return indices + offset, distances
+
+    def merge(*candidates):
+        indices = np.hstack([c[0] for c in candidates])
+        distances = np.hstack([c[1] for c in candidates])
+        sample_range = np.arange(indices.shape[0])[:, None]
+        order = np.argsort(distances, axis=1, kind='mergesort')[:, :n_neighbors]
+        return indices[sample_range, order], distances[sample_range, order]
+
+    merged = [
+        delayed(merge)(*[
+            delayed(search)(query, data, offsets[j])
+            for j, data in enumerate(blocks)])
+        for query in blocks]
+    results = compute(*merged)
+    knn_indices = np.vstack([r[0] for r in results])
+    knn_dists = np.vstack([r[1] for r in results])
+    return knn_indices, knn_dists
+
+
 def compute_connectivities_umap(knn_indices, knn_dists,
         n_obs, n_neighbors, set_op_mix_ratio=1.0,
         local_connectivity=1.0, bandwidth=1.0):
@@ -627,8 +673,13 @@ class Neighbors:
         self.knn = knn
         X = choose_representation(self._adata, use_rep=use_rep, n_pcs=n_pcs)
         # neighbor search
-        use_dense_distances = (metric == 'euclidean' and X.shape[0] < 8192) or knn == False
-        if use_dense_distances:
+        use_dask = da is not None and isinstance(X, da.Array) and knn
+        use_dense_distances = not use_dask and (
+            (metric == 'euclidean' and X.shape[0] < 8192) or knn == False)
+        if use_dask:
+            knn_indices, knn_distances = compute_neighbors_dask(
+                X, n_neighbors, metric=metric, metric_kwds=metric_kwds)
+        elif use_dense_distances:
             _distances = pairwise_distances(X, metric=metric, **metric_kwds)
             knn_indices, knn_distances = get_indices_distances_from_dense_matrix(
                 _distances, n_neighbors)
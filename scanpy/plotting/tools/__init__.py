@@ -6,6 +6,7 @@ from matplotlib import rcParams
 
 from .. import utils
 from ...utils import doc_params
+from ...tools.rank_genes_groups import _ranked_groups, _ranked_field
 from ... import logging as logg
 from ..anndata import scatter, ranking
 from ..utils import timeseries, timeseries_subplot, timeseries_as_heatmap
@@ -178,7 +179,7 @@ def rank_genes_groups(adata, groups=None, n_genes=20, gene_symbols=None, key=Non
         key = 'rank_genes_groups'
     groups_key = str(adata.uns[key]['params']['groupby'])
     reference = str(adata.uns[key]['params']['reference'])
-    group_names = (adata.uns[key]['names'].dtype.names
+    group_names = (_ranked_groups(adata.uns[key])
                    if groups is None else groups)
     # one panel for each group
     n_panels = len(group_names)
@@ -213,8 +214,8 @@ def rank_genes_groups(adata, groups=None, n_genes=20, gene_symbols=None, key=Non
         else:
             ax = fig.add_subplot(gs[count])
 
-        gene_names = adata.uns[key]['names'][group_name]
-        scores = adata.uns[key]['scores'][group_name]
+        gene_names = _ranked_field(adata, key, 'names', group_name)
+        scores = _ranked_field(adata, key, 'scores', group_name)
         for ig, g in enumerate(gene_names[:n_genes]):
             gene_name = gene_names[ig]
             if adata.raw is not None and adata.uns[key]['params']['use_raw']:
@@ -285,7 +286,7 @@ def _rank_genes_groups_plot(adata, plot_type='heatmap', groups=None,
         kwds['dendrogram'] = True
     if groupby is None:
         groupby = str(adata.uns[key]['params']['groupby'])
-    group_names = (adata.uns[key]['names'].dtype.names
+    group_names = (_ranked_groups(adata.uns[key])
                    if groups is None else groups)
 
     # make a list of tuples containing the index for the start gene and the
@@ -293,7 +294,7 @@ def _rank_genes_groups_plot(adata, plot_type='heatmap', groups=None,
     group_positions = [(x, x + n_genes - 1) for x in range(0, n_genes * len(group_names), n_genes)]
 
     # sum(list, []) is used to flatten the gene list
-    gene_names = sum([list(adata.uns[key]['names'][x][:n_genes]) for x in group_names], [])
+    gene_names = sum([list(_ranked_field(adata, key, 'names', x)[:n_genes]) for x in group_names], [])
 
     if plot_type == 'dotplot':
         from ..anndata import dotplot
@@ -488,14 +489,14 @@ def rank_genes_groups_violin(
     if use_raw is None:
         use_raw = bool(adata.uns[key]['params']['use_raw'])
     reference = str(adata.uns[key]['params']['reference'])
-    groups_names = (adata.uns[key]['names'].dtype.names
+    groups_names = (_ranked_groups(adata.uns[key])
                     if groups is None else groups)
     if isinstance(groups_names, str): groups_names = [groups_names]
     axs = []
     for group_name in groups_names:
         if gene_names is None:
-            gene_names = adata.uns[
-                key]['names'][group_name][:n_genes]
+            gene_names = _ranked_field(
+                adata, key, 'names', group_name)[:n_genes]
         df = pd.DataFrame()
         new_gene_names = []
         for g in gene_names:
@@ -164,11 +164,11 @@ def exploratory_rank_analysis(adata, groupby, x='inflation', y='mean', groups='a
         if (x is 'full_var_group' or y is 'full_var_group'):
             # Slice first appropriately:
             adata_relevant = adata[:, name_list]
-            exp, full_var_group = simple._get_mean_var(adata_relevant.X[mask])
+            exp, full_var_group = simple._get_mean_var(adata_relevant.X, mask=mask)
         if (x is 'full_var_rest' or y is 'full_var_rest'):
             # Slice first appropriately:
             adata_relevant = adata[:, name_list]
-            exp_rest, full_var_rest = simple._get_mean_var(adata_relevant.X[mask_rest])
+            exp_rest, full_var_rest = simple._get_mean_var(adata_relevant.X, mask=mask_rest)
 
         ### Prepare for coloring
         # get colored scatterplot
@@ -469,9 +469,9 @@ def top_ranked_group_analysis(adata, groupby, groupid, n=100, special_markers=No
     var_rest = _tail_var_estimate(adata[:, name_list], mask_rest)
     CDR = _Avg_CDR(adata, mask, name_list, model='rough', n_genes=None)
     adata_relevant = adata[:, name_list]
-    exp, full_var_group = simple._get_mean_var(adata_relevant.X[mask])
+    exp, full_var_group = simple._get_mean_var(adata_relevant.X, mask=mask)
     adata_relevant = adata[:, name_list]
-    exp_rest, full_var_rest = simple._get_mean_var(adata_relevant.X[mask_rest])
+    exp_rest, full_var_rest = simple._get_mean_var(adata_relevant.X, mask=mask_rest)
 
     ### Prepare for coloring
     # get colored scatterplot
@@ -654,11 +654,11 @@ def scatter(adata, groupby, groupid, x,y, n=100, special_markers=None,
     if (x is 'full_var_group' or y is 'full_var_group'):
         # Slice first appropriately:
         adata_relevant = adata[:, name_list]
-        exp, full_var_group = simple._get_mean_var(adata_relevant.X[mask])
+        exp, full_var_group = simple._get_mean_var(adata_relevant.X, mask=mask)
     if (x is 'full_var_rest' or y is 'full_var_rest'):
         # Slice first appropriately:
         adata_relevant = adata[:, name_list]
-        exp_rest, full_var_rest = simple._get_mean_var(adata_relevant.X[mask_rest])
+        exp_rest, full_var_rest = simple._get_mean_var(adata_relevant.X, mask=mask_rest)
 
     ### Prepare for coloring
     # get colored scatterplot
@@ -0,0 +1,172 @@
+"""Helpers for iterating over chunks of (possibly backed or distributed) data matrices.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy.sparse import issparse, isspmatrix_csr, csr_matrix, csc_matrix, vstack
+from anndata import AnnData
+
+from .. import settings
+
+
+def get_X(data):
+    """Return the data matrix of `data`, which is either an AnnData or a matrix."""
+    return data.X if isinstance(data, AnnData) else data
+
+
+def to_memory(chunk):
+    """Convert a chunk read from a backed, zarr or dask matrix to a numpy or CSR array."""
+    if hasattr(chunk, 'compute'):  # dask
+        chunk = chunk.compute()
+    if issparse(chunk):
+        # backed sparse matrices are subclasses of csr_matrix
+        if not isspmatrix_csr(chunk) or type(chunk) is not csr_matrix:
+            chunk = csr_matrix(chunk)
+        return chunk
+    return np.asarray(chunk)
+
+
+def iter_row_chunks(X, chunk_size=6000, prefetch=False):
+    """Iterate over row chunks of `X`.
+
+    Works for numpy arrays, scipy sparse matrices, backed h5ad datasets, zarr
+    and dask arrays. In-memory sparse matrices that are not CSR are converted
+    once; every yielded chunk is either a `np.ndarray` or a `csr_matrix`.
+
+    If `prefetch`, the next chunk is read in a background thread while the
+    current one is processed, so that reading overlaps with computations that
+    release the GIL, like compiled kernels. Two chunks are then held in memory.
+
+    Yields
+    ------
+    `(chunk, start, end)`
+    """
+    if issparse(X) and not isspmatrix_csr(X):
+        X = csr_matrix(X)
+    return _iter_chunks(_read_rows, X, X.shape[0], chunk_size, prefetch)
+
+
+def iter_col_chunks(X, chunk_size=1000, prefetch=False):
+    """Iterate over column chunks of `X`, see :func:`iter_row_chunks`.
+
+    Every yielded chunk is either a `np.ndarray` or a `csc_matrix`. Column
+    chunks of backed CSR matrices are assembled from chunks of rows, so that
+    each one takes a pass over the file; store such data as CSC for repeated
+    column access.
+
+    Yields
+    ------
+    `(chunk, start, end)`
+    """
+    if issparse(X):
+        X = csc_matrix(X)
+    return _iter_chunks(_read_cols, X, X.shape[1], chunk_size, prefetch)
+
+
+def _iter_chunks(read, X, n, chunk_size, prefetch):
+    bounds = [(start, min(start + chunk_size, n)) for start in range(0, n, chunk_size)]
+    if not prefetch:
+        for start, end in bounds:
+            yield read(X, start, end), start, end
+        return
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(read, X, *bounds[0]) if bounds else None
+        for i, (start, end) in enumerate(bounds):
+            chunk = future.result()
+            if i + 1 < len(bounds):
+                future = executor.submit(read, X, *bounds[i + 1])
+            yield chunk, start, end
+
+
+def _read_rows(X, start, end):
+    if hasattr(X, 'h5py_group') and X.format_str == 'csr':
+        return _read_major(X, start, end, csr_matrix)
+    if hasattr(X, 'h5py_group') and end - start == X.shape[0]:
+        # slicing all rows of a backed sparse matrix fails
+        return to_memory(X.value)
+    return to_memory(X[start:end])
+
+
+def _read_cols(X, start, end):
+    if hasattr(X, 'h5py_group'):
+        if X.format_str == 'csc':
+            return _read_major(X, start, end, csc_matrix)
+        chunk_size = chunk_size_from_budget(row_nbytes(X))
+        return csc_matrix(vstack([
+            chunk[:, start:end]
+            for chunk, _, _ in iter_row_chunks(X, chunk_size)]))
+    chunk = to_memory(X[:, start:end])
+    return csc_matrix(chunk) if issparse(chunk) else chunk
+
+
+def _read_major(X, start, end, format_class):
+    """Read a range of the compressed axis of a backed sparse matrix.
+
+    Slicing backed matrices with scipy reads the whole arrays from disk.
+    """
+    group = X.h5py_group
+    indptr = group['indptr'][start:end + 1]
+    data = group['data'][indptr[0]:indptr[-1]]
+    indices = group['indices'][indptr[0]:indptr[-1]]
+    shape = ((end - start, X.shape[1]) if format_class is csr_matrix
+             else (X.shape[0], end - start))
+    return format_class((data, indices, indptr - indptr[0]), shape=shape)
+
+
+def memory_budget():
+    """Number of bytes that computations may use, see `settings.max_memory`."""
+    return int(settings.max_memory * 1024 ** 3)
+
+
+def row_nbytes(X, dense=False):
+    """Average number of bytes of a row of `X`.
+
+    For sparse `X`, the size of the CSR representation is estimated unless
+    `dense` is `True`, that is, the row is converted to a dense array.
+    """
+    itemsize = np.dtype(X.dtype).itemsize
+    n_obs, n_vars = X.shape
+    if issparse(X):
+        nnz = X.nnz
+    elif hasattr(X, 'h5py_group'):  # backed sparse
+        nnz = X.h5py_group['data'].shape[0]
+    else:
+        dense = True
+    if dense:
+        return n_vars * itemsize
+    # data and int32 indices
+    return max(1, nnz * (itemsize + 4) // max(1, n_obs))
+
+
+def col_nbytes(X):
+    """Average number of bytes of a column of `X`, see :func:`row_nbytes`."""
+    itemsize = np.dtype(X.dtype).itemsize
+    n_obs, n_vars = X.shape
+    if issparse(X):
+        nnz = X.nnz
+    elif hasattr(X, 'h5py_group'):  # backed sparse
+        nnz = X.h5py_group['data'].shape[0]
+    else:
+        return n_obs * itemsize
+    return max(1, nnz * (itemsize + 4) // max(1, n_vars))
+
+
+def chunk_size_from_budget(bytes_per_row, n_copies=1):
+    """Number of rows so that `n_copies` of a chunk fit into the memory budget."""
+    return max(1, int(memory_budget() // (bytes_per_row * n_copies)))
+
+
+def check_budget(n_bytes, what):
+    """Fail fast if an operation needs more than `settings.max_memory`.
+
+    Raises
+    ------
+    MemoryError
+    """
+    if n_bytes > memory_budget():
+        raise MemoryError(
+            '{} needs about {:.1f} GB of memory, which exceeds '
+            '`settings.max_memory = {}` (GB). Increase it, if you have enough '
+            'memory, or use a sparse or chunked alternative.'
+            .format(what, n_bytes / 1024 ** 3, settings.max_memory))
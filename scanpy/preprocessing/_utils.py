@@ -0,0 +1,156 @@
+"""Compiled reductions shared by preprocessing, tools and plotting.
+"""
+
+import numba
+import numpy as np
+from scipy.sparse import issparse, isspmatrix_csr, isspmatrix_csc
+
+# upper bound on the number of float64 entries of the per-thread partial sums
+# used when reducing the columns of a CSR matrix in parallel
+_MAX_PARTIAL_SIZE = 2 ** 26
+
+
+def _get_mean_var(X, mask=None, expm1=False):
+    """Mean and variance (unbiased, R convention) of the columns of `X`.
+
+    Parameters
+    ----------
+    X : `np.ndarray`, `sp.spmatrix`
+        Data matrix. Dask and zappy arrays are reduced blockwise by their own
+        implementations.
+    mask : `np.ndarray`, optional (default: `None`)
+        Boolean mask or indices of the rows to consider. Rows are never
+        copied.
+    expm1 : `bool`, optional (default: `False`)
+        Compute the statistics of `np.expm1(X)`, transforming each value on
+        the fly instead of copying `X`.
+
+    Returns
+    -------
+    mean, var : `np.ndarray`
+    """
+    if not (issparse(X) or isinstance(X, np.ndarray)):
+        X = X if mask is None else X[mask]
+        return _get_mean_var_blockwise(np.expm1(X) if expm1 else X)
+    codes = np.zeros(X.shape[0], dtype=np.int64)
+    if mask is not None:
+        codes[:] = -1
+        codes[mask] = 0
+    means, vars, _ = _get_mean_var_groups(X, codes, 1, expm1=expm1)
+    return means[0], vars[0]
+
+
+def _get_mean_var_groups(X, codes, n_groups, expm1=False):
+    """Per-group means and variances of the columns of `X` in a single pass.
+
+    Parameters
+    ----------
+    X : `np.ndarray`, `sp.spmatrix`
+        Data matrix, CSR and CSC matrices are processed without conversion.
+    codes : `np.ndarray`
+        Group code of each row, in `range(n_groups)`. Rows with negative codes
+        are ignored.
+    n_groups : `int`
+        Number of groups.
+    expm1 : `bool`, optional (default: `False`)
+        Compute the statistics of `np.expm1(X)` without copying `X`.
+
+    Returns
+    -------
+    means, vars : `np.ndarray`
+        Arrays of shape `n_groups` × `n_vars`.
+    ns : `np.ndarray`
+        Number of rows per group.
+    """
+    codes = np.asarray(codes, dtype=np.int64)
+    n_vars = X.shape[1]
+    if issparse(X):
+        if isspmatrix_csc(X):
+            sums, sums_sq = _sums_csc(X.data, X.indices, X.indptr, codes,
+                                      n_groups, n_vars, expm1)
+        else:
+            if not isspmatrix_csr(X):
+                X = X.tocsr()
+            n_blocks = min(
+                numba.config.NUMBA_NUM_THREADS,
+                max(1, X.shape[0] // 1000),
+                max(1, _MAX_PARTIAL_SIZE // max(1, n_groups * n_vars)))
+            sums, sums_sq = _sums_csr(X.data, X.indices, X.indptr, codes,
+                                      n_groups, n_vars, n_blocks, expm1)
+            sums, sums_sq = sums.sum(axis=0), sums_sq.sum(axis=0)
+    else:
+        sums, sums_sq = _sums_dense(np.asarray(X), codes, n_groups, expm1)
+    ns = np.bincount(codes[codes >= 0], minlength=n_groups)[:n_groups]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = sums / ns[:, None]
+        # enforce R convention (unbiased estimator) for variance
+        vars = (sums_sq - ns[:, None] * means ** 2) / (ns[:, None] - 1)
+    return means, vars, ns
+
+
+def _get_mean_var_blockwise(X):
+    # accumulate in double precision like the compiled kernels
+    X = X.astype(np.float64)
+    mean = X.mean(axis=0)
+    if issparse(X):
+        mean_sq = X.multiply(X).mean(axis=0)
+        mean = mean.A1
+        mean_sq = mean_sq.A1
+    else:
+        mean_sq = (X * X).mean(axis=0)
+    # enforce R convention (unbiased estimator) for variance
+    var = (mean_sq - mean ** 2) * (X.shape[0] / (X.shape[0] - 1))
+    return mean, var
+
+
+@numba.njit(parallel=True)
+def _sums_csr(data, indices, indptr, codes, n_groups, n_vars, n_blocks, expm1):
+    # every block of rows accumulates into its own partial sums
+    n_obs = len(indptr) - 1
+    step = (n_obs + n_blocks - 1) // n_blocks
+    sums = np.zeros((n_blocks, n_groups, n_vars))
+    sums_sq = np.zeros((n_blocks, n_groups, n_vars))
+    for b in numba.prange(n_blocks):
+        for i in range(b * step, min((b + 1) * step, n_obs)):
+            g = codes[i]
+            if g < 0:
+                continue
+            for k in range(indptr[i], indptr[i + 1]):
+                value = np.expm1(data[k]) if expm1 else data[k]
+                sums[b, g, indices[k]] += value
+                sums_sq[b, g, indices[k]] += value * value
+    return sums, sums_sq
+
+
+@numba.njit(parallel=True)
+def _sums_csc(data, indices, indptr, codes, n_groups, n_vars, expm1):
+    sums = np.zeros((n_groups, n_vars))
+    sums_sq = np.zeros((n_groups, n_vars))
+    for j in numba.prange(n_vars):
+        for k in range(indptr[j], indptr[j + 1]):
+            g = codes[indices[k]]
+            if g < 0:
+                continue
+            value = np.expm1(data[k]) if expm1 else data[k]
+            sums[g, j] += value
+            sums_sq[g, j] += value * value
+    return sums, sums_sq
+
+
+@numba.njit(parallel=True)
+def _sums_dense(X, codes, n_groups, expm1):
+    # blocks of columns keep the row-wise memory access of C-ordered arrays
+    n_obs, n_vars = X.shape
+    block = 64
+    sums = np.zeros((n_groups, n_vars))
+    sums_sq = np.zeros((n_groups, n_vars))
+    for b in numba.prange((n_vars + block - 1) // block):
+        for i in range(n_obs):
+            g = codes[i]
+            if g < 0:
+                continue
+            for j in range(b * block, min((b + 1) * block, n_vars)):
+                value = np.expm1(X[i, j]) if expm1 else X[i, j]
+                sums[g, j] += value
+                sums_sq[g, j] += value * value
+    return sums, sums_sq
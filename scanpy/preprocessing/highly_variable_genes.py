@@ -1,9 +1,13 @@
 from anndata import AnnData
+import numba
 import numpy as np
 import pandas as pd
 import warnings
+from scipy.sparse import issparse
 from .. import logging as logg
 from .simple import materialize_as_ndarray, _get_mean_var
+from ._utils import _get_mean_var_groups, _MAX_PARTIAL_SIZE
+from ._chunked import iter_row_chunks, chunk_size_from_budget, row_nbytes
 
 
 def highly_variable_genes(data,
@@ -12,10 +16,13 @@ def highly_variable_genes(data,
                           min_mean=None, max_mean=None,
                           n_bins=20,
                           n_top_genes=None,
+                          batch_key=None,
+                          span=0.3,
                           copy=False):
-    """Extract highly variable genes [Satija15]_ [Zheng17]_.
+    """Extract highly variable genes [Satija15]_ [Zheng17]_ [Stuart19]_.
 
-    Expects logarithmized data.
+    Expects logarithmized data, except for `flavor='seurat_v3'`, which
+    expects counts.
 
     If trying out parameters, pass the data matrix instead of AnnData.
 
@@ -30,15 +37,23 @@ def highly_variable_genes(data,
     Use `flavor='cell_ranger'` with care and in the same way as in
     :func:`~scanpy.api.pp.recipe_zheng17`.
 
+    For `flavor='seurat_v3'`, a loess curve is fitted to the relation of the
+    logarithms of variance and mean of the counts of each gene [Stuart19]_.
+    Genes are ranked by the variance of their counts standardized with the
+    fitted variance, where standardized values are clipped at the square
+    root of the number of cells. This only needs two streaming passes over
+    the rows of the data matrix and runs on backed data without loading it
+    into memory.
+
     Parameters
     ----------
     data : :class:`~anndata.AnnData`, `np.ndarray`, `sp.sparse`
         The (annotated) data matrix of shape `n_obs` × `n_vars`. Rows correspond
         to cells and columns to genes.
-    flavor : {'seurat', 'cell_ranger'}, optional (default: 'seurat')
+    flavor : {'seurat', 'cell_ranger', 'seurat_v3'}, optional (default: 'seurat')
         Choose the flavor for computing normalized dispersion. In their default
         workflows, Seurat passes the cutoffs whereas Cell Ranger passes
-        `n_top_genes`.
+        `n_top_genes`. `'seurat_v3'` requires `n_top_genes`.
     min_mean=0.0125, max_mean=3, min_disp=0.5, max_disp=`None` : `float`, optional
         If `n_top_genes` unequals `None`, these cutoffs for the means and the
         normalized dispersions are ignored.
@@ -49,6 +64,17 @@ def highly_variable_genes(data,
         about this if you set `settings.verbosity = 4`.
     n_top_genes : `int` or `None` (default: `None`)
         Number of highly-variable genes to keep.
+    batch_key : `str` or `None`, optional (default: `None`)
+        Key of a categorical annotation in `.obs` of batches. If given, means
+        and dispersions are computed per batch in a single pass over the
+        data, and genes are selected within each batch. With `n_top_genes`,
+        genes are then ranked by the number of batches in which they are
+        highly variable, ties are broken by the normalized dispersion
+        averaged across batches. Otherwise, the cutoffs are applied to the
+        averages across batches. Only for :class:`~anndata.AnnData`.
+    span : `float`, optional (default: 0.3)
+        Fraction of genes used for each local fit of the loess curve if
+        `flavor='seurat_v3'`.
     copy : `bool`, optional (default: `False`)
         If an :class:`~anndata.AnnData` is passed, determines whether a copy
         is returned.
@@ -65,27 +91,310 @@ def highly_variable_genes(data,
     dispersions_norm : adata.var
         Normalized dispersions per gene.
 
+    If `batch_key` is given, the above are averages across batches and
+    additionally
+
+    highly_variable_nbatches : adata.var
+        Number of batches in which a gene is highly variable.
+    highly_variable_intersection : adata.var
+        Whether a gene is highly variable in all batches.
+    means_per_batch, dispersions_norm_per_batch, highly_variable_per_batch : adata.varm
+        Statistics per batch, columns are ordered as the categories of
+        `adata.obs[batch_key]`.
+
     If a data matrix `X` is passed, the annotation is returned as `np.recarray` \
     with the same information stored in fields: `gene_subset`, `means`, `dispersions`, `dispersion_norm`.
+
+    For `flavor='seurat_v3'`, `variances` and `variances_norm` (the
+    standardized variances) replace `dispersions` and `dispersions_norm`.
     """
+    if flavor == 'seurat_v3':
+        return _highly_variable_genes_seurat_v3(
+            data, n_top_genes=n_top_genes, batch_key=batch_key, span=span,
+            copy=copy)
+
     if n_top_genes is not None and not all([
             min_disp is None, max_disp is None, min_mean is None, max_mean is None]):
         logg.info('If you pass `n_top_genes`, all cutoffs are ignored.')
-    if min_disp is None: min_disp = 0.5
-    if min_mean is None: min_mean = 0.0125
-    if max_mean is None: max_mean = 3
+
+    if batch_key is not None:
+        if not isinstance(data, AnnData):
+            raise ValueError('`batch_key` requires passing an AnnData.')
+        adata = data.copy() if copy else data
+        _highly_variable_genes_batches(
+            adata, batch_key, flavor=flavor, min_disp=min_disp,
+            max_disp=max_disp, min_mean=min_mean, max_mean=max_mean,
+            n_bins=n_bins, n_top_genes=n_top_genes)
+        return adata if copy else None
 
     if isinstance(data, AnnData):
         data_is_AnnData = True
         adata = data.copy() if copy else data
-        X = np.expm1(adata.X) if flavor=='seurat' else adata.X
+        X = adata.X
     else:
         data_is_AnnData = False
-        X = np.expm1(data) if flavor=='seurat' else data
+        X = data
 
     logg.msg('extracting highly variable genes',
               r=True, v=4)
-    mean, var = materialize_as_ndarray(_get_mean_var(X))
+    # for seurat, the statistics of the exponentiated data, computed on the fly
+    mean, var = materialize_as_ndarray(_get_mean_var(X, expm1=flavor == 'seurat'))
+    df, gene_subset = _highly_variable_genes_from_mean_var(
+        mean, var, flavor=flavor, min_disp=min_disp, max_disp=max_disp,
+        min_mean=min_mean, max_mean=max_mean, n_bins=n_bins,
+        n_top_genes=n_top_genes)
+    logg.msg('    finished', time=True, v=4)
+
+    if data_is_AnnData:
+        adata.var['means'] = df['mean'].values
+        adata.var['dispersions'] = df['dispersion'].values
+        adata.var['dispersions_norm'] = df['dispersion_norm'].values.astype('float32', copy=False)
+        adata.var['highly_variable'] = gene_subset
+        return adata if copy else None
+    else:
+        return np.rec.fromarrays((gene_subset,
+                                  df['mean'].values,
+                                  df['dispersion'].values,
+                                  df['dispersion_norm'].values.astype('float32', copy=False)),
+                                  dtype=[('gene_subset', bool),
+                                         ('means', 'float32'),
+                                         ('dispersions', 'float32'),
+                                         ('dispersions_norm', 'float32')])
+
+
+def _highly_variable_genes_batches(adata, batch_key, flavor='seurat', min_disp=None,
+                                   max_disp=None, min_mean=None, max_mean=None,
+                                   n_bins=20, n_top_genes=None):
+    """Select highly variable genes within batches and combine the selections."""
+    logg.msg('extracting highly variable genes per batch', r=True, v=4)
+    batches = pd.Categorical(adata.obs[batch_key])
+    n_batches = len(batches.categories)
+    X = adata.X
+    expm1 = flavor == 'seurat'
+    if issparse(X) or isinstance(X, np.ndarray):
+        means, vars, _ = _get_mean_var_groups(X, batches.codes, n_batches, expm1=expm1)
+    else:
+        stats = [materialize_as_ndarray(
+                     _get_mean_var(X, mask=batches.codes == b, expm1=expm1))
+                 for b in range(n_batches)]
+        means = np.array([mean for mean, _ in stats])
+        vars = np.array([var for _, var in stats])
+    means_batch = np.zeros((adata.n_vars, n_batches), dtype=np.float32)
+    dispersions_batch = np.zeros((adata.n_vars, n_batches), dtype=np.float32)
+    dispersions_norm_batch = np.zeros((adata.n_vars, n_batches), dtype=np.float32)
+    highly_variable_batch = np.zeros((adata.n_vars, n_batches), dtype=bool)
+    for b in range(n_batches):
+        df, gene_subset = _highly_variable_genes_from_mean_var(
+            means[b], vars[b], flavor=flavor, min_disp=min_disp,
+            max_disp=max_disp, min_mean=min_mean, max_mean=max_mean,
+            n_bins=n_bins, n_top_genes=n_top_genes)
+        means_batch[:, b] = df['mean'].values
+        dispersions_batch[:, b] = df['dispersion'].values
+        dispersions_norm_batch[:, b] = df['dispersion_norm'].values
+        highly_variable_batch[:, b] = gene_subset
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)  # all-nan genes
+        mean = np.nanmean(means_batch, axis=1)
+        dispersion = np.nanmean(dispersions_batch, axis=1)
+        dispersion_norm = np.nanmean(dispersions_norm_batch, axis=1)
+    n_batches_hv = highly_variable_batch.sum(axis=1)
+    if n_top_genes is not None:
+        # more batches first, then larger average normalized dispersion
+        order = np.lexsort((-np.nan_to_num(dispersion_norm), -n_batches_hv))
+        gene_subset = np.zeros(adata.n_vars, dtype=bool)
+        gene_subset[order[:n_top_genes]] = True
+    else:
+        gene_subset = _cutoff_genes(
+            mean, np.nan_to_num(dispersion_norm), min_disp=min_disp,
+            max_disp=max_disp, min_mean=min_mean, max_mean=max_mean)
+    logg.msg('    finished', time=True, v=4)
+    adata.var['means'] = mean
+    adata.var['dispersions'] = dispersion
+    adata.var['dispersions_norm'] = dispersion_norm
+    adata.var['highly_variable'] = gene_subset
+    adata.var['highly_variable_nbatches'] = n_batches_hv
+    adata.var['highly_variable_intersection'] = n_batches_hv == n_batches
+    adata.varm['means_per_batch'] = means_batch
+    adata.varm['dispersions_norm_per_batch'] = dispersions_norm_batch
+    adata.varm['highly_variable_per_batch'] = highly_variable_batch
+
+
+def _highly_variable_genes_seurat_v3(data, n_top_genes=None, batch_key=None,
+                                     span=0.3, copy=False):
+    """Rank genes by their standardized variance on counts [Stuart19]_."""
+    from statsmodels.nonparametric.smoothers_lowess import lowess
+    if n_top_genes is None:
+        raise ValueError('`flavor=\'seurat_v3\'` requires `n_top_genes`.')
+    if isinstance(data, AnnData):
+        adata = data.copy() if copy else data
+        X = adata.X
+        chunked = adata.isbacked
+    else:
+        if batch_key is not None:
+            raise ValueError('`batch_key` requires passing an AnnData.')
+        X = data
+        chunked = False
+    chunked = chunked or not (issparse(X) or isinstance(X, np.ndarray))
+    n_vars = X.shape[1]
+    if batch_key is None:
+        codes, n_batches = np.zeros(X.shape[0], dtype=np.int64), 1
+    else:
+        batches = pd.Categorical(adata.obs[batch_key])
+        codes, n_batches = batches.codes.astype(np.int64), len(batches.categories)
+    logg.msg('extracting highly variable genes', r=True, v=4)
+    # first pass: means and variances of the counts
+    no_clip = np.full((n_batches, n_vars), np.inf)
+    sums, sums_sq = _clipped_sums(X, codes, n_batches, no_clip, chunked)
+    ns = np.bincount(codes[codes >= 0], minlength=n_batches)[:, None]
+    means = sums / ns
+    variances = (sums_sq - ns * means ** 2) / (ns - 1)
+    # fit the mean-variance trend in log space
+    reg_std = np.zeros((n_batches, n_vars))
+    for b in range(n_batches):
+        not_const = variances[b] > 0
+        log_mean = np.log10(means[b, not_const])
+        fitted = lowess(
+            np.log10(variances[b, not_const]), log_mean, frac=span,
+            delta=.01 * np.ptp(log_mean), return_sorted=False)
+        reg_std[b, not_const] = np.sqrt(10 ** fitted)
+    # second pass: sums of the counts clipped at sqrt(n_cells) standard deviations
+    clip = means + reg_std * np.sqrt(ns)
+    sums, sums_sq = _clipped_sums(X, codes, n_batches, clip, chunked)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        variances_norm = (ns * means ** 2 + sums_sq - 2 * means * sums) \
+                         / ((ns - 1) * reg_std ** 2)
+    variances_norm[reg_std == 0] = 0
+    highly_variable = np.zeros((n_batches, n_vars), dtype=bool)
+    for b in range(n_batches):
+        highly_variable[b, np.argsort(-variances_norm[b])[:n_top_genes]] = True
+    n_batches_hv = highly_variable.sum(axis=0)
+    variances_norm_mean = variances_norm.mean(axis=0)
+    # more batches first, then larger average standardized variance
+    order = np.lexsort((-variances_norm_mean, -n_batches_hv))
+    gene_subset = np.zeros(n_vars, dtype=bool)
+    gene_subset[order[:n_top_genes]] = True
+    logg.msg('    finished', time=True, v=4)
+    if not isinstance(data, AnnData):
+        return np.rec.fromarrays((gene_subset,
+                                  means[0],
+                                  variances[0],
+                                  variances_norm[0]),
+                                  dtype=[('gene_subset', bool),
+                                         ('means', 'float32'),
+                                         ('variances', 'float32'),
+                                         ('variances_norm', 'float32')])
+    # with batches, means over all cells and average (standardized) variances
+    adata.var['means'] = np.average(means, axis=0, weights=ns[:, 0])
+    adata.var['variances'] = variances.mean(axis=0)
+    adata.var['variances_norm'] = variances_norm_mean
+    adata.var['highly_variable'] = gene_subset
+    if batch_key is not None:
+        adata.var['highly_variable_nbatches'] = n_batches_hv
+        adata.var['highly_variable_intersection'] = n_batches_hv == n_batches
+        adata.varm['means_per_batch'] = means.T.astype(np.float32)
+        adata.varm['variances_norm_per_batch'] = variances_norm.T.astype(np.float32)
+        adata.varm['highly_variable_per_batch'] = highly_variable.T
+    return adata if copy else None
+
+
+def _clipped_sums(X, codes, n_groups, clip, chunked):
+    """Per-group column sums and sums of squares of `X` clipped at `clip`."""
+    if not chunked:
+        return _clipped_sums_chunk(X, codes, n_groups, clip)
+    # the next chunk is prefetched while processing the current one
+    chunk_size = chunk_size_from_budget(row_nbytes(X), n_copies=2)
+    sums = np.zeros((n_groups, X.shape[1]))
+    sums_sq = np.zeros((n_groups, X.shape[1]))
+    for chunk, start, end in iter_row_chunks(X, chunk_size, prefetch=True):
+        chunk_sums, chunk_sums_sq = _clipped_sums_chunk(
+            chunk, codes[start:end], n_groups, clip)
+        sums += chunk_sums
+        sums_sq += chunk_sums_sq
+    return sums, sums_sq
+
+
+def _clipped_sums_chunk(X, codes, n_groups, clip):
+    n_obs, n_vars = X.shape
+    n_blocks = min(
+        numba.config.NUMBA_NUM_THREADS,
+        max(1, n_obs // 1000),
+        max(1, _MAX_PARTIAL_SIZE // max(1, n_groups * n_vars)))
+    if issparse(X):
+        X = X.tocsr()
+        sums, sums_sq = _clipped_sums_csr(
+            X.data, X.indices, X.indptr, codes, clip, n_blocks)
+    else:
+        sums, sums_sq = _clipped_sums_dense(np.asarray(X), codes, clip, n_blocks)
+    return sums.sum(axis=0), sums_sq.sum(axis=0)
+
+
+@numba.njit(parallel=True, nogil=True)
+def _clipped_sums_csr(data, indices, indptr, codes, clip, n_blocks):
+    # every block of rows accumulates into its own partial sums
+    n_obs = len(indptr) - 1
+    n_groups, n_vars = clip.shape
+    step = (n_obs + n_blocks - 1) // n_blocks
+    sums = np.zeros((n_blocks, n_groups, n_vars))
+    sums_sq = np.zeros((n_blocks, n_groups, n_vars))
+    for b in numba.prange(n_blocks):
+        for i in range(b * step, min((b + 1) * step, n_obs)):
+            g = codes[i]
+            if g < 0:
+                continue
+            for k in range(indptr[i], indptr[i + 1]):
+                j = indices[k]
+                value = min(data[k], clip[g, j])
+                sums[b, g, j] += value
+                sums_sq[b, g, j] += value * value
+    return sums, sums_sq
+
+
+@numba.njit(parallel=True, nogil=True)
+def _clipped_sums_dense(X, codes, clip, n_blocks):
+    n_obs, n_vars = X.shape
+    n_groups = clip.shape[0]
+    step = (n_obs + n_blocks - 1) // n_blocks
+    sums = np.zeros((n_blocks, n_groups, n_vars))
+    sums_sq = np.zeros((n_blocks, n_groups, n_vars))
+    for b in numba.prange(n_blocks):
+        for i in range(b * step, min((b + 1) * step, n_obs)):
+            g = codes[i]
+            if g < 0:
+                continue
+            for j in range(n_vars):
+                value = min(X[i, j], clip[g, j])
+                sums[b, g, j] += value
+                sums_sq[b, g, j] += value * value
+    return sums, sums_sq
+
+
+def _cutoff_genes(mean, dispersion_norm, min_disp=None, max_disp=None,
+                  min_mean=None, max_mean=None):
+    if min_disp is None: min_disp = 0.5
+    if min_mean is None: min_mean = 0.0125
+    if max_mean is None: max_mean = 3
+    max_disp = np.inf if max_disp is None else max_disp
+    return np.logical_and.reduce((mean > min_mean, mean < max_mean,
+                                  dispersion_norm > min_disp,
+                                  dispersion_norm < max_disp))
+
+
+def _highly_variable_genes_from_mean_var(
+        mean, var, flavor='seurat',
+        min_disp=None, max_disp=None,
+        min_mean=None, max_mean=None,
+        n_bins=20, n_top_genes=None):
+    """Compute (normalized) dispersions and select genes from per-gene statistics.
+
+    `mean` and `var` are the per-gene means and variances of the data, for
+    `flavor='seurat'` of the exponentiated data.
+
+    Returns
+    -------
+    A data frame with columns `mean`, `dispersion`, `dispersion_norm` and the
+    boolean `gene_subset` of highly variable genes.
+    """
+    mean = mean.copy()
     # now actually compute the dispersion
     mean[mean == 0] = 1e-12  # set entries equal to zero to small value
     dispersion = var / mean
@@ -135,7 +444,7 @@ def highly_variable_genes(data,
                                  - disp_median_bin[df['mean_bin']].values)) \
                                 / disp_mad_bin[df['mean_bin']].values
     else:
-        raise ValueError('`flavor` needs to be "seurat" or "cell_ranger"')
+        raise ValueError('`flavor` needs to be "seurat", "cell_ranger" or "seurat_v3"')
     dispersion_norm = df['dispersion_norm'].values.astype('float32')
     if n_top_genes is not None:
         dispersion_norm = dispersion_norm[~np.isnan(dispersion_norm)]
@@ -145,25 +454,8 @@ def highly_variable_genes(data,
         logg.msg('the {} top genes correspond to a normalized dispersion cutoff of'
                  .format(n_top_genes, disp_cut_off), v=5)
     else:
-        max_disp = np.inf if max_disp is None else max_disp
         dispersion_norm[np.isnan(dispersion_norm)] = 0  # similar to Seurat
-        gene_subset = np.logical_and.reduce((mean > min_mean, mean < max_mean,
-                                             dispersion_norm > min_disp,
-                                             dispersion_norm < max_disp))
-    logg.msg('    finished', time=True, v=4)
-
-    if data_is_AnnData:
-        adata.var['means'] = df['mean'].values
-        adata.var['dispersions'] = df['dispersion'].values
-        adata.var['dispersions_norm'] = df['dispersion_norm'].values.astype('float32', copy=False)
-        adata.var['highly_variable'] = gene_subset
-        return adata if copy else None
-    else:
-        return np.rec.fromarrays((gene_subset,
-                                  df['mean'].values,
-                                  df['dispersion'].values,
-                                  df['dispersion_norm'].values.astype('float32', copy=False)),
-                                  dtype=[('gene_subset', bool),
-                                         ('means', 'float32'),
-                                         ('dispersions', 'float32'),
-                                         ('dispersions_norm', 'float32')])
+        gene_subset = _cutoff_genes(
+            mean, dispersion_norm, min_disp=min_disp, max_disp=max_disp,
+            min_mean=min_mean, max_mean=max_mean)
+    return df, gene_subset
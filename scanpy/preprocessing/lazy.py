@@ -0,0 +1,506 @@
+"""Lazy preprocessing plans
+
+Record a sequence of preprocessing steps and execute them in as few passes as
+possible over a (backed) data matrix, writing the result to a new file.
+"""
+
+import os
+import tempfile
+
+import h5py
+import numpy as np
+from scipy.sparse import issparse, csr_matrix
+from sklearn.utils import sparsefuncs
+from anndata import AnnData, read_h5ad, read_zarr
+
+from .. import logging as logg
+from ._chunked import iter_row_chunks, chunk_size_from_budget, row_nbytes
+from .highly_variable_genes import _highly_variable_genes_from_mean_var
+
+
+# steps that transform each entry of the data matrix independently
+_ELEMENTWISE = {'log1p', 'sqrt'}
+# steps that need per-gene statistics of the data they are applied to
+_COLUMN_STATS = {'filter_genes', 'scale', 'highly_variable_genes'}
+
+
+class Plan:
+    """A lazy sequence of preprocessing steps.
+
+    Steps are recorded by calling the methods of the plan, which mirror the
+    functions in `sc.pp` and can be chained. Nothing is computed until
+    :meth:`execute` is called, which streams row chunks of the data through
+    the fused steps and writes the result to a new `.h5ad` file. Element-wise
+    steps and per-cell steps are fused into a single pass; steps that need
+    statistics over all cells (`filter_genes`, `normalize_per_cell` without
+    `counts_per_cell_after`, `scale`, `highly_variable_genes`) require a
+    reading pass before the data can be written. Consecutive steps whose
+    statistics are independent of each other share a pass.
+
+    Examples
+    --------
+    >>> plan = (sc.pp.Plan()
+    ...     .filter_cells(min_genes=200)
+    ...     .filter_genes(min_cells=3)
+    ...     .normalize_per_cell(counts_per_cell_after=1e4)
+    ...     .log1p()
+    ...     .highly_variable_genes()
+    ...     .scale(max_value=10))
+    >>> plan.n_passes
+    3
+    >>> plan.execute('atlas_raw.h5ad', 'atlas_preprocessed.h5ad')
+    """
+
+    def __init__(self):
+        self.steps = []
+
+    def __repr__(self):
+        return 'Plan with steps\n' + '\n'.join(
+            '    {}({})'.format(name, ', '.join(
+                '{}={!r}'.format(k, v) for k, v in params.items() if v is not None))
+            for name, params in self.steps)
+
+    def _add(self, name, **params):
+        self.steps.append((name, params))
+        return self
+
+    def filter_cells(self, min_counts=None, min_genes=None, max_counts=None,
+                     max_genes=None):
+        """Record :func:`~scanpy.api.pp.filter_cells`."""
+        _check_one_option(min_counts, min_genes, max_counts, max_genes)
+        return self._add('filter_cells', min_counts=min_counts, min_genes=min_genes,
+                         max_counts=max_counts, max_genes=max_genes)
+
+    def filter_genes(self, min_counts=None, min_cells=None, max_counts=None,
+                     max_cells=None):
+        """Record :func:`~scanpy.api.pp.filter_genes`."""
+        _check_one_option(min_counts, min_cells, max_counts, max_cells)
+        return self._add('filter_genes', min_counts=min_counts, min_cells=min_cells,
+                         max_counts=max_counts, max_cells=max_cells)
+
+    def normalize_per_cell(self, counts_per_cell_after=None, key_n_counts=None,
+                           min_counts=1):
+        """Record :func:`~scanpy.api.pp.normalize_per_cell`.
+
+        If `counts_per_cell_after` is `None`, the median of the counts per
+        cell needs to be computed in a separate pass.
+        """
+        return self._add('normalize_per_cell',
+                         counts_per_cell_after=counts_per_cell_after,
+                         key_n_counts='n_counts' if key_n_counts is None else key_n_counts,
+                         min_counts=min_counts)
+
+    def log1p(self):
+        """Record :func:`~scanpy.api.pp.log1p`."""
+        return self._add('log1p')
+
+    def sqrt(self):
+        """Record :func:`~scanpy.api.pp.sqrt`."""
+        return self._add('sqrt')
+
+    def scale(self, zero_center=True, max_value=None):
+        """Record :func:`~scanpy.api.pp.scale`.
+
+        With `zero_center=True`, the written data matrix is dense.
+        """
+        return self._add('scale', zero_center=zero_center, max_value=max_value)
+
+    def highly_variable_genes(self, flavor='seurat', min_disp=None, max_disp=None,
+                              min_mean=None, max_mean=None, n_bins=20,
+                              n_top_genes=None):
+        """Record :func:`~scanpy.api.pp.highly_variable_genes`."""
+        if flavor not in {'seurat', 'cell_ranger'}:
+            raise ValueError('`flavor` needs to be "seurat" or "cell_ranger"')
+        return self._add('highly_variable_genes', flavor=flavor,
+                         min_disp=min_disp, max_disp=max_disp, min_mean=min_mean,
+                         max_mean=max_mean, n_bins=n_bins, n_top_genes=n_top_genes)
+
+    def _passes(self):
+        """Group the indices of steps that need statistics into reading passes."""
+        passes = []
+        i = 0
+        while i < len(self.steps):
+            if not _needs_stats(self.steps[i]):
+                i += 1
+                continue
+            group = [i]
+            name, params = self.steps[i]
+            # per-gene statistics of later steps can be computed in the same
+            # pass if only element-wise steps and steps that do not alter the
+            # data lie in between; subsetting genes does not alter the
+            # statistics of the remaining genes
+            if name in _COLUMN_STATS and name != 'scale':
+                j = i + 1
+                while j < len(self.steps):
+                    name_j = self.steps[j][0]
+                    if name_j in _ELEMENTWISE:
+                        j += 1
+                    elif name_j in _COLUMN_STATS:
+                        group.append(j)
+                        j += 1
+                        if name_j == 'scale':
+                            break
+                    else:
+                        break
+            passes.append(group)
+            i = group[-1] + 1
+        return passes
+
+    @property
+    def n_passes(self):
+        """Number of passes over the data needed to execute the plan."""
+        return len(self._passes()) + 1
+
+    def execute(self, data, filename, chunk_size=None):
+        """Execute the plan and write the result to `filename`.
+
+        Parameters
+        ----------
+        data : :class:`~anndata.AnnData` or `str`
+            The annotated data matrix, possibly opened in backed mode or with
+            a zarr or dask array as `.X`, or the path to an `.h5ad` file,
+            which is opened in backed mode, or to a `.zarr` store.
+        filename : `str`
+            Path of the `.h5ad` file to write the result to.
+        chunk_size : `int`, optional (default: `None`)
+            Number of observations read into memory at once. By default
+            derived from `settings.max_memory`.
+
+        Returns
+        -------
+        `None`. The result is written to `filename`, with the annotations of
+        the individual steps in `.obs` and `.var`.
+        """
+        if not str(filename).endswith('.h5ad'):
+            raise ValueError('Can only write the result to an `.h5ad` file.')
+        if isinstance(data, str):
+            adata = (read_zarr(data) if data.rstrip('/').endswith('.zarr')
+                     else read_h5ad(data, backed='r'))
+        else:
+            adata = data
+        if adata.isbacked and os.path.abspath(adata.filename) == os.path.abspath(filename):
+            raise ValueError('Cannot write the result to the file that is read.')
+        logg.info('executing preprocessing plan', r=True)
+        if chunk_size is None:
+            # chunks may be densified and are transformed step by step
+            chunk_size = chunk_size_from_budget(row_nbytes(adata.X, dense=True), n_copies=3)
+        passes = self._passes()
+        try:
+            state = _State(adata)
+            i = 0
+            for group in passes:
+                for name, params in self.steps[i:group[0]]:
+                    state.add_row_local(name, params)
+                _run_stats_pass(state, self.steps[group[0]:group[-1] + 1], group[0], group, chunk_size)
+                i = group[-1] + 1
+            for name, params in self.steps[i:]:
+                state.add_row_local(name, params)
+            _run_write_pass(state, filename, chunk_size)
+        finally:
+            if isinstance(data, str) and adata.isbacked:
+                adata.file.close()
+        logg.info('    finished', time=True, end=' ')
+        logg.info('using {} passes over the data and wrote \'{}\''
+                  .format(len(passes) + 1, filename), no_indent=True)
+
+
+# --------------------------------------------------------------------------------
+# Helper Functions
+# --------------------------------------------------------------------------------
+
+
+def _check_one_option(*options):
+    if sum(option is not None for option in options) != 1:
+        raise ValueError(
+            'Only provide one of the optional parameters `min_counts`, '
+            '`min_cells`/`min_genes`, `max_counts`, `max_cells`/`max_genes` per call.')
+
+
+def _needs_stats(step):
+    name, params = step
+    if name == 'normalize_per_cell':
+        return params['counts_per_cell_after'] is None
+    return name in _COLUMN_STATS
+
+
+def _sum(X, axis):
+    return np.ravel(X.sum(axis=axis))
+
+
+def _n_positive(X, axis):
+    return np.ravel((X > 0).sum(axis=axis))
+
+
+def _elementwise(name, X):
+    func = np.log1p if name == 'log1p' else np.sqrt
+    if issparse(X):
+        X = X.copy()
+        func(X.data, out=X.data)
+        return X
+    return func(X)
+
+
+def _subset_rows(X, obs, keep):
+    return X[keep], {k: v[keep] for k, v in obs.items()}
+
+
+class _State:
+    """The chain of resolved per-chunk operations and the annotation."""
+
+    def __init__(self, adata):
+        self.adata = adata
+        self.ops = []
+        self.var = adata.var.copy()
+        self.obs_keys = []
+        self.transforms = False
+
+    def apply(self, X, start, end):
+        if self.transforms and not np.issubdtype(X.dtype, np.floating):
+            X = X.astype(np.float32)
+        obs = {'index': np.arange(start, end)}
+        for op in self.ops:
+            X, obs = op(X, obs)
+        return X, obs
+
+    def add_row_local(self, name, params, median=None):
+        if name == 'filter_cells':
+            by_counts = params['min_genes'] is None and params['max_genes'] is None
+            key = 'n_counts' if by_counts else 'n_genes'
+            min_number = params['min_counts'] if by_counts else params['min_genes']
+            max_number = params['max_counts'] if by_counts else params['max_genes']
+
+            def op(X, obs):
+                number = _sum(X, 1) if by_counts else _n_positive(X, 1)
+                obs[key] = number
+                keep = (number >= min_number if min_number is not None
+                        else number <= max_number)
+                return _subset_rows(X, obs, keep)
+            self.obs_keys.append(key)
+        elif name == 'normalize_per_cell':
+            after = params['counts_per_cell_after'] if median is None else median
+            key, min_counts = params['key_n_counts'], params['min_counts']
+            self.transforms = True
+
+            def op(X, obs):
+                counts = _sum(X, 1)
+                obs[key] = counts
+                keep = counts >= min_counts
+                X, obs = _subset_rows(X, obs, keep)
+                counts = counts[keep]
+                counts = counts + (counts == 0)
+                if issparse(X):
+                    X = X.copy()
+                    sparsefuncs.inplace_row_scale(X, after / counts)
+                else:
+                    X = (X / (counts / after)[:, None]).astype(X.dtype, copy=False)
+                return X, obs
+            self.obs_keys.append(key)
+        elif name in _ELEMENTWISE:
+            self.transforms = True
+
+            def op(X, obs):
+                return _elementwise(name, X), obs
+        else:
+            raise ValueError('Step {} needs to be resolved with statistics.'.format(name))
+        self.ops.append(op)
+
+    def add_gene_subset(self, gene_subset):
+        self.var = self.var[gene_subset]
+
+        def op(X, obs):
+            return X[:, gene_subset], obs
+        self.ops.append(op)
+
+    def add_scale(self, mean, std, zero_center, max_value):
+        self.transforms = True
+
+        def op(X, obs):
+            if zero_center:
+                X = X.toarray() if issparse(X) else X
+                X = ((X - mean) / std).astype(X.dtype, copy=False)
+                if max_value is not None:
+                    X[X > max_value] = max_value
+            else:
+                if issparse(X):
+                    X = X.copy()
+                    sparsefuncs.inplace_column_scale(X, 1 / std)
+                    if max_value is not None:
+                        X.data[X.data > max_value] = max_value
+                else:
+                    X = (X / std).astype(X.dtype, copy=False)
+                    if max_value is not None:
+                        X[X > max_value] = max_value
+            return X, obs
+        self.ops.append(op)
+
+
+class _ColumnAccumulator:
+    """Per-gene sums, sums of squares and numbers of positive entries."""
+
+    def __init__(self):
+        self.n = 0
+        self.sums = self.sums_sq = self.n_positive = 0
+
+    def add(self, X, squares=True, positive=False):
+        self.n += X.shape[0]
+        self.sums = self.sums + _sum(X, 0)
+        if squares:
+            X_sq = X.multiply(X) if issparse(X) else np.multiply(X, X)
+            self.sums_sq = self.sums_sq + _sum(X_sq, 0)
+        if positive:
+            self.n_positive = self.n_positive + _n_positive(X, 0)
+
+    def mean_var(self):
+        mean = self.sums / self.n
+        # enforce R convention (unbiased estimator) for variance
+        var = (self.sums_sq / self.n - mean**2) * (self.n / (self.n - 1))
+        return mean, var
+
+
+def _run_stats_pass(state, steps, first_index, group, chunk_size):
+    """Run a single reading pass that resolves the steps in `steps`.
+
+    `steps` starts with a step that needs statistics, and contains the
+    element-wise steps in between further steps of the same pass.
+    """
+    logg.msg('    reading pass for steps', [name for name, _ in steps], v=4)
+    n_obs = state.adata.n_obs
+    if steps[0][0] == 'normalize_per_cell':
+        counts = []
+        for chunk, start, end in iter_row_chunks(state.adata.X, chunk_size):
+            X, _ = state.apply(chunk, start, end)
+            counts_chunk = _sum(X, 1)
+            counts.append(counts_chunk[counts_chunk >= steps[0][1]['min_counts']])
+        median = np.median(np.concatenate(counts)) if n_obs > 0 else 1
+        state.add_row_local(*steps[0], median=median)
+        return
+    accumulators = [_ColumnAccumulator() if first_index + k in group else None
+                    for k in range(len(steps))]
+    for chunk, start, end in iter_row_chunks(state.adata.X, chunk_size):
+        X, _ = state.apply(chunk, start, end)
+        for (name, params), acc in zip(steps, accumulators):
+            if name in _ELEMENTWISE:
+                X = _elementwise(name, X)
+            elif name == 'filter_genes':
+                acc.add(X, squares=False, positive=True)
+            elif name == 'highly_variable_genes':
+                acc.add(_elementwise_expm1(X) if params['flavor'] == 'seurat' else X)
+            else:
+                acc.add(X)
+    # resolve the steps in order, only keeping statistics for retained genes
+    genes = np.arange(state.var.shape[0])
+    for (name, params), acc in zip(steps, accumulators):
+        if name in _ELEMENTWISE:
+            state.add_row_local(name, params)
+        elif name == 'filter_genes':
+            by_counts = params['min_cells'] is None and params['max_cells'] is None
+            number = (acc.sums if by_counts else acc.n_positive)[genes]
+            min_number = params['min_counts'] if by_counts else params['min_cells']
+            max_number = params['max_counts'] if by_counts else params['max_cells']
+            gene_subset = (number >= min_number if min_number is not None
+                           else number <= max_number)
+            s = np.sum(~gene_subset)
+            if s > 0:
+                logg.info('filtered out {} genes'.format(s))
+            state.var['n_counts' if by_counts else 'n_cells'] = number
+            state.add_gene_subset(gene_subset)
+            genes = genes[gene_subset]
+        elif name == 'highly_variable_genes':
+            mean, var = acc.mean_var()
+            df, gene_subset = _highly_variable_genes_from_mean_var(
+                mean[genes], var[genes], **params)
+            state.var['means'] = df['mean'].values
+            state.var['dispersions'] = df['dispersion'].values
+            state.var['dispersions_norm'] = df['dispersion_norm'].values.astype('float32', copy=False)
+            state.var['highly_variable'] = gene_subset
+        elif name == 'scale':
+            mean, var = acc.mean_var()
+            state.add_scale(mean[genes], np.sqrt(var[genes]), **params)
+
+
+def _elementwise_expm1(X):
+    if issparse(X):
+        X = X.copy()
+        np.expm1(X.data, out=X.data)
+        return X
+    return np.expm1(X)
+
+
+def _run_write_pass(state, filename, chunk_size):
+    obs = {key: [] for key in ['index'] + state.obs_keys}
+    with h5py.File(filename, 'w') as f:
+        writer = None
+        for chunk, start, end in iter_row_chunks(state.adata.X, chunk_size):
+            X, obs_chunk = state.apply(chunk, start, end)
+            for key in obs:
+                obs[key].append(obs_chunk[key])
+            if writer is None:
+                writer = _SparseWriter(f, X) if issparse(X) else _DenseWriter(f, X)
+            writer.append(X)
+        if writer is None:  # no observations at all
+            writer = _SparseWriter(f, csr_matrix((0, state.var.shape[0]), dtype=np.float32))
+        n_obs = writer.close()
+    obs = {k: np.concatenate(v) if v else np.zeros(0, dtype=int) for k, v in obs.items()}
+    obs_df = state.adata.obs.iloc[obs.pop('index')].copy()
+    for key, values in obs.items():
+        obs_df[key] = values
+    # write the annotation with anndata and copy it into the file with the data
+    skeleton = AnnData(csr_matrix((n_obs, state.var.shape[0]), dtype=np.float32),
+                       obs=obs_df, var=state.var, uns=dict(state.adata.uns))
+    fd, skeleton_filename = tempfile.mkstemp(
+        suffix='.h5ad', dir=os.path.dirname(os.path.abspath(filename)))
+    os.close(fd)
+    try:
+        skeleton.write(skeleton_filename)
+        with h5py.File(skeleton_filename, 'r') as src, h5py.File(filename, 'a') as dst:
+            for key in src.keys():
+                if key != 'X':
+                    src.copy(key, dst)
+    finally:
+        os.remove(skeleton_filename)
+
+
+class _SparseWriter:
+    def __init__(self, f, X):
+        self.group = f.create_group('X')
+        self.n_vars = X.shape[1]
+        self.data = self.group.create_dataset(
+            'data', shape=(0,), maxshape=(None,), dtype=X.dtype, chunks=True)
+        self.indices = self.group.create_dataset(
+            'indices', shape=(0,), maxshape=(None,), dtype=X.indices.dtype, chunks=True)
+        self.indptr = [np.zeros(1, dtype=np.int64)]
+        self.nnz = 0
+
+    def append(self, X):
+        X.sort_indices()
+        nnz = X.nnz
+        self.data.resize((self.nnz + nnz,))
+        self.indices.resize((self.nnz + nnz,))
+        self.data[self.nnz:] = X.data
+        self.indices[self.nnz:] = X.indices
+        self.indptr.append(X.indptr[1:].astype(np.int64) + self.nnz)
+        self.nnz += nnz
+
+    def close(self):
+        indptr = np.concatenate(self.indptr)
+        self.group.create_dataset('indptr', data=indptr)
+        n_obs = indptr.size - 1
+        self.group.attrs['h5sparse_format'] = 'csr'
+        self.group.attrs['h5sparse_shape'] = np.array([n_obs, self.n_vars])
+        return n_obs
+
+
+class _DenseWriter:
+    def __init__(self, f, X):
+        self.dataset = f.create_dataset(
+            'X', shape=(0, X.shape[1]), maxshape=(None, X.shape[1]),
+            dtype=X.dtype, chunks=True)
+        self.n_obs = 0
+
+    def append(self, X):
+        self.dataset.resize((self.n_obs + X.shape[0], X.shape[1]))
+        self.dataset[self.n_obs:] = X
+        self.n_obs += X.shape[0]
+
+    def close(self):
+        return self.n_obs
@@ -3,9 +3,12 @@
 
 import numbers
 import numpy as np
+from anndata import AnnData
+from scipy.sparse import issparse
 
 from .. import settings
 from .. import logging as logg
+from ._chunked import chunk_size_from_budget
 
 
 def magic(adata,
@@ -19,6 +22,7 @@ def magic(adata,
           n_jobs=None,
           verbose=False,
           copy=None,
+          method='magic',
           **kwargs):
     """Markov Affinity-based Graph Imputation of Cells (MAGIC) API [vanDijk18]_.
 
@@ -45,7 +49,8 @@ def magic(adata,
     t : int, optional, default: 'auto'
         power to which the diffusion operator is powered.
         This sets the level of diffusion. If 'auto', t is selected
-        according to the Procrustes disparity of the diffused data
+        according to the Procrustes disparity of the diffused data.
+        For `method='neighbors'`, 'auto' means 3.
     n_pca : int, optional, default: 100
         Number of principal components to use for calculating
         neighborhoods. For extremely large datasets, using
@@ -69,6 +74,17 @@ def magic(adata,
         `genes` is not `'all_genes'` or `'pca_only'`. `copy` may only be False
         if `genes` is `'all_genes'` or `'pca_only'`, as the resultant data
         will otherwise have different column names from the input data.
+    method : {'magic', 'neighbors'}, optional (default: `'magic'`)
+        With `'magic'`, call the `magic` package, which computes its own PCA
+        and kNN graph. With `'neighbors'`, diffuse in-process with the
+        transition matrix of the graph computed by
+        :func:`~scanpy.api.pp.neighbors`, which avoids a second kNN search
+        and does not require the `magic` package. The transition matrix is
+        applied `t` times to blocks of genes or to at most `n_pca` components
+        of `.obsm['X_pca']` (computed if not present), its powers are never
+        formed.
+        `k`, `a`, `knn_dist`, `random_state`, `n_jobs` and `kwargs` are
+        ignored.
     kwargs : additional arguments to `magic.MAGIC`
 
     Returns
@@ -97,6 +113,10 @@ def magic(adata,
     >>> adata.X.shape
     (2730, 3451)
     """
+    if method not in {'magic', 'neighbors'}:
+        raise ValueError('`method` needs to be \'magic\' or \'neighbors\'.')
+    if method == 'neighbors':
+        return _magic_neighbors(adata, name_list, t, n_pca, copy)
 
     try:
         from magic import MAGIC
@@ -151,3 +171,79 @@ def magic(adata,
 
     if copy:
         return adata
+
+
+def _magic_neighbors(adata, name_list, t, n_pca, copy):
+    """Diffusion with the transition matrix of the existing neighbors graph."""
+    from ..neighbors import Neighbors
+    if 'neighbors' not in adata.uns:
+        raise ValueError(
+            'You need to run `pp.neighbors` first to compute a neighborhood graph.')
+    if t == 'auto':
+        t = 3
+    elif not isinstance(t, numbers.Integral) or t < 1:
+        raise ValueError('`t` needs to be a positive integer or \'auto\'.')
+    logg.info('computing MAGIC on the neighborhood graph', r=True)
+    if name_list is None:
+        name_list = 'all_genes'
+    needs_copy = not (isinstance(name_list, str) and
+                      name_list in ['all_genes', 'pca_only'])
+    if copy is None:
+        copy = needs_copy
+    elif needs_copy and not copy:
+        raise ValueError(
+            "Can only perform MAGIC in-place with `name_list=='all_genes' or "
+            "`name_list=='pca_only'` (got {}). Consider setting "
+            "`copy=True`".format(name_list))
+    adata = adata.copy() if copy and not needs_copy else adata
+    neighbors = Neighbors(adata)
+    neighbors.compute_transitions()
+    transitions = neighbors.transitions.tocsr()
+    if name_list == 'pca_only':
+        if 'X_pca' in adata.obsm_keys():
+            X_pca = adata.obsm['X_pca'][:, :n_pca]
+            logg.info('    using {} components of \'X_pca\''.format(X_pca.shape[1]))
+        else:
+            from .simple import pca
+            logg.info('    computing PCA with {} components'.format(n_pca))
+            X_pca = pca(adata.X, n_comps=n_pca)
+        adata.obsm['X_magic'] = _diffuse(transitions, X_pca, t)
+        logg.info('    finished', time=True,
+                  end=' ' if settings.verbosity > 2 else '\n')
+        logg.hint('added\n'
+                  '    \'X_magic\', PCA on MAGIC coordinates (adata.obsm)')
+        return adata if copy else None
+    if name_list == 'all_genes':
+        genes = np.arange(adata.n_vars)
+    else:
+        genes = adata.var_names.get_indexer(name_list)
+        if np.any(genes < 0):
+            raise ValueError(
+                'Genes {} are not in `adata.var_names`.'
+                .format(list(np.array(name_list)[genes < 0])))
+    X = adata.X.tocsc() if issparse(adata.X) else adata.X
+    X_magic = np.empty((adata.n_obs, len(genes)), dtype=np.float32)
+    # blocks of genes whose diffused copies fit into the memory budget
+    chunk_size = chunk_size_from_budget(adata.n_obs * 8, n_copies=3)
+    for start in range(0, len(genes), chunk_size):
+        block = genes[start:start + chunk_size]
+        X_block = X[:, block]
+        X_block = X_block.toarray() if issparse(X_block) else X_block
+        X_magic[:, start:start + len(block)] = _diffuse(transitions, X_block, t)
+    logg.info('    finished', time=True,
+              end=' ' if settings.verbosity > 2 else '\n')
+    if needs_copy:
+        adata_magic = AnnData(
+            X_magic, obs=adata.obs.copy(), var=adata.var.iloc[genes].copy())
+        adata_magic.raw = adata
+        return adata_magic
+    adata.raw = adata
+    adata.X = X_magic
+    return adata if copy else None
+
+
+def _diffuse(transitions, X, t):
+    X = np.asarray(X, dtype=np.float64)
+    for _ in range(t):
+        X = transitions @ X
+    return X
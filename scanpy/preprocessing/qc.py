@@ -1,17 +1,23 @@
 import numba
 import numpy as np
 import pandas as pd
-from scipy.sparse import csr_matrix, issparse, isspmatrix_csr, isspmatrix_coo
+from scipy.sparse import csr_matrix, issparse, isspmatrix_csr
+
+from ._chunked import chunk_size_from_budget, iter_row_chunks, row_nbytes
+from ._utils import _MAX_PARTIAL_SIZE
 
 
 def calculate_qc_metrics(adata, exprs_values="counts", feature_controls=(),
-                         percent_top=(50, 100, 200, 500), inplace=False):
+                         percent_top=(50, 100, 200, 500), inplace=False,
+                         chunked=False, chunk_size=None, groupby=None):
     """
     Calculate quality control metrics.
 
     Calculates a number of qc metrics for an AnnData object, largely based on
     `calculateQCMetrics` from scater [McCarthy17]_. Currently is most efficient
-    on a sparse CSR or dense matrix.
+    on a sparse CSR or dense matrix. Backed, zarr and dask matrices are
+    streamed in chunks of rows, so that the data matrix needs not fit into
+    memory.
 
     Parameters
     ----------
@@ -27,6 +33,17 @@ def calculate_qc_metrics(adata, exprs_values="counts", feature_controls=(),
         calculate.
     inplace : bool, optional (default: `False`)
         Whether to place calculated metrics in `.obs` and `.var`
+    chunked : `bool`, optional (default: `False`)
+        Process the data matrix in chunks of rows, reading the next chunk
+        while computing on the current one. Always the case for backed, zarr
+        and dask matrices.
+    chunk_size : `int`, optional (default: `None`)
+        Number of rows per chunk if `chunked`. By default derived from
+        `settings.max_memory`.
+    groupby : `str` or `None`, optional (default: `None`)
+        Key of a categorical annotation in `.obs`, e.g., of samples or
+        batches. If given, variable level metrics are also calculated per
+        group, in the same pass over the data.
 
     Returns
     -------
@@ -48,30 +65,47 @@ def calculate_qc_metrics(adata, exprs_values="counts", feature_controls=(),
         * `mean_{expr_values}`
         * `n_cells_by_{expr_values}`
         * `pct_dropout_by_{expr_values}`
+
+        If `groupby` is given, additionally returns (even if `inplace`) a
+        tidy `pd.DataFrame` with one row per group and variable, with
+        categorical columns `groupby` and `var_names` and the variable level
+        metrics above, without log transformations.
     """
-    if isspmatrix_coo(adata.X):
-        X = csr_matrix(adata.X)  # COO not subscriptable
+    X = adata.X
+    chunked = (chunked or adata.isbacked
+               or not (issparse(X) or isinstance(X, np.ndarray)))
+    percent_top = [] if percent_top is None else list(percent_top)
+    control_flags = _control_flags(adata, feature_controls)
+    if groupby is None:
+        groups = pd.Categorical(np.zeros(adata.n_obs, dtype=int))
     else:
-        X = adata.X
+        groups = pd.Categorical(adata.obs[groupby])
+    # cells without group are accumulated into an extra, last group
+    n_groups = len(groups.categories)
+    codes = np.where(groups.codes < 0, n_groups, groups.codes).astype(np.int64)
+    (totals, n_features, control_totals, proportions,
+     group_totals, group_n_cells) = _qc_metrics(
+         X, control_flags, len(feature_controls), percent_top,
+         codes, n_groups + np.any(groups.codes < 0), chunked, chunk_size)
+    var_totals = group_totals.sum(axis=0)
+    var_n_cells = group_n_cells.sum(axis=0)
     obs_metrics = pd.DataFrame(index=adata.obs_names)
     var_metrics = pd.DataFrame(index=adata.var_names)
     # Calculate obs metrics
-    obs_metrics["total_features_by_{exprs_values}"] = (
-        X != 0).sum(axis=1)
+    obs_metrics["total_features_by_{exprs_values}"] = n_features
     obs_metrics["log1p_total_features_by_{exprs_values}"] = np.log1p(
         obs_metrics["total_features_by_{exprs_values}"])
-    obs_metrics["total_{exprs_values}"] = X.sum(axis=1)
+    obs_metrics["total_{exprs_values}"] = totals
     obs_metrics["log1p_total_{exprs_values}"] = np.log1p(
         obs_metrics["total_{exprs_values}"])
-    proportions = top_segment_proportions(X, percent_top)
     # Since there are local loop variables, formatting must occur in their scope
     # Probably worth looking into a python3.5 compatable way to make this better
     for i, n in enumerate(percent_top):
         obs_metrics["pct_{exprs_values}_in_top_{n}_features".format(**locals())] = \
             proportions[:, i] * 100
-    for feature_control in feature_controls:
+    for i, feature_control in enumerate(feature_controls):
         obs_metrics["total_{exprs_values}_{feature_control}".format(**locals())] = \
-            X[:, adata.var[feature_control].values].sum(axis=1)
+            control_totals[:, i]
         obs_metrics["log1p_total_{exprs_values}_{feature_control}".format(**locals())] = \
             np.log1p(
                 obs_metrics["total_{exprs_values}_{feature_control}".format(**locals())])
@@ -80,15 +114,30 @@ def calculate_qc_metrics(adata, exprs_values="counts", feature_controls=(),
             obs_metrics["total_{exprs_values}_{feature_control}".format(**locals())] / \
             obs_metrics["total_{exprs_values}"] * 100
     # Calculate var metrics
-    var_metrics["mean_{exprs_values}"] = np.ravel(X.mean(axis=0))
+    var_metrics["mean_{exprs_values}"] = var_totals / X.shape[0]
     var_metrics["log1p_mean_{exprs_values}"] = np.log1p(
         var_metrics["mean_{exprs_values}"])
-    var_metrics["n_cells_by_{exprs_values}"] = np.ravel((X != 0).sum(axis=0))
+    var_metrics["n_cells_by_{exprs_values}"] = var_n_cells
     var_metrics["pct_dropout_by_{exprs_values}"] = \
         (1 - var_metrics["n_cells_by_{exprs_values}"] / X.shape[0]) * 100
-    var_metrics["total_{exprs_values}"] = np.ravel(X.sum(axis=0))
+    var_metrics["total_{exprs_values}"] = var_totals
     var_metrics["log1p_total_{exprs_values}"] = np.log1p(
         var_metrics["total_{exprs_values}"])
+    if groupby is not None:
+        group_sizes = np.bincount(codes, minlength=n_groups)[:n_groups, None]
+        names = [name.format(exprs_values=exprs_values) for name in [
+            "total_{exprs_values}", "mean_{exprs_values}",
+            "n_cells_by_{exprs_values}", "pct_dropout_by_{exprs_values}"]]
+        group_metrics = pd.DataFrame({
+            groupby: pd.Categorical.from_codes(
+                np.repeat(np.arange(n_groups), adata.n_vars), groups.categories),
+            "var_names": pd.Categorical.from_codes(
+                np.tile(np.arange(adata.n_vars), n_groups), adata.var_names),
+            names[0]: group_totals[:n_groups].ravel(),
+            names[1]: (group_totals[:n_groups] / group_sizes).ravel(),
+            names[2]: group_n_cells[:n_groups].ravel(),
+            names[3]: ((1 - group_n_cells[:n_groups] / group_sizes) * 100).ravel(),
+        }, columns=[groupby, "var_names"] + names)
     # Format strings
     for df in obs_metrics, var_metrics:
         new_colnames = []
@@ -99,9 +148,164 @@ def calculate_qc_metrics(adata, exprs_values="counts", feature_controls=(),
     if inplace:
         adata.obs[obs_metrics.columns] = obs_metrics
         adata.var[var_metrics.columns] = var_metrics
+        if groupby is not None:
+            return group_metrics
+    elif groupby is not None:
+        return obs_metrics, var_metrics, group_metrics
     else:
         return obs_metrics, var_metrics
 
+
+def _control_flags(adata, feature_controls):
+    """Bitmap of the feature controls each gene belongs to."""
+    if len(feature_controls) > 63:
+        raise ValueError('At most 63 feature controls are supported.')
+    flags = np.zeros(adata.n_vars, dtype=np.int64)
+    for i, feature_control in enumerate(feature_controls):
+        flags[adata.var[feature_control].values.astype(bool)] |= 1 << i
+    return flags
+
+
+def _qc_metrics(X, control_flags, n_controls, percent_top, codes, n_groups,
+                chunked, chunk_size):
+    """All obs and per-group var metrics of `X` in a single pass over its rows."""
+    n_obs, n_vars = X.shape
+    if not chunked:
+        if issparse(X) and not isspmatrix_csr(X):
+            X = csr_matrix(X)  # the compiled kernels iterate over CSR buffers
+        return _qc_metrics_chunk(
+            X, control_flags, n_controls, percent_top, codes, n_groups)
+    if chunk_size is None:
+        # the next chunk is prefetched while processing the current one
+        chunk_size = chunk_size_from_budget(row_nbytes(X), n_copies=2)
+    totals = np.zeros(n_obs)
+    n_features = np.zeros(n_obs, dtype=np.int64)
+    control_totals = np.zeros((n_obs, n_controls))
+    proportions = np.zeros((n_obs, len(percent_top)))
+    var_totals = np.zeros((n_groups, n_vars))
+    var_n_cells = np.zeros((n_groups, n_vars), dtype=np.int64)
+    for chunk, start, end in iter_row_chunks(X, chunk_size, prefetch=True):
+        results = _qc_metrics_chunk(
+            chunk, control_flags, n_controls, percent_top, codes[start:end],
+            n_groups)
+        totals[start:end], n_features[start:end] = results[:2]
+        control_totals[start:end], proportions[start:end] = results[2:4]
+        var_totals += results[4]
+        var_n_cells += results[5]
+    return (totals, n_features, control_totals, proportions,
+            var_totals, var_n_cells)
+
+
+def _qc_metrics_chunk(X, control_flags, n_controls, percent_top, codes, n_groups):
+    n_obs, n_vars = X.shape
+    ns = np.array(percent_top, dtype=np.int64)
+    n_blocks = min(
+        numba.config.NUMBA_NUM_THREADS,
+        max(1, n_obs // 1000),
+        max(1, _MAX_PARTIAL_SIZE // max(1, n_groups * n_vars)))
+    if issparse(X):
+        results = _qc_metrics_csr(
+            X.data, X.indices, X.indptr, n_vars, control_flags, n_controls,
+            ns, codes, n_groups, n_blocks)
+    else:
+        results = _qc_metrics_dense(
+            np.asarray(X), control_flags, n_controls, ns, codes, n_groups,
+            n_blocks)
+    *obs_results, var_totals, var_n_cells = results
+    return (*obs_results, var_totals.sum(axis=0), var_n_cells.sum(axis=0))
+
+
+@numba.njit(error_model='numpy')
+def _top_proportions_row(values, ns, total, out):
+    # cumulative proportions of the largest values at the 1-indexed ranks ns
+    max_n = ns.max()
+    values = values.astype(np.float64)
+    if len(values) > max_n:
+        values = -np.partition(-values, max_n - 1)[:max_n]
+    values = -np.sort(-values)
+    cumsum = np.cumsum(values)
+    for j in range(len(ns)):
+        if len(cumsum) == 0:
+            out[j] = 0 / total
+        else:
+            out[j] = cumsum[min(ns[j], len(cumsum)) - 1] / total
+
+
+@numba.njit(parallel=True, nogil=True, error_model='numpy')
+def _qc_metrics_csr(data, indices, indptr, n_vars, control_flags, n_controls,
+                    ns, codes, n_groups, n_blocks):
+    # every block of rows accumulates into its own partial var metrics
+    n_obs = len(indptr) - 1
+    step = (n_obs + n_blocks - 1) // n_blocks
+    totals = np.zeros(n_obs)
+    n_features = np.zeros(n_obs, dtype=np.int64)
+    control_totals = np.zeros((n_obs, n_controls))
+    proportions = np.zeros((n_obs, len(ns)))
+    var_totals = np.zeros((n_blocks, n_groups, n_vars))
+    var_n_cells = np.zeros((n_blocks, n_groups, n_vars), dtype=np.int64)
+    for b in numba.prange(n_blocks):
+        for i in range(b * step, min((b + 1) * step, n_obs)):
+            g = codes[i]
+            total = 0.
+            for k in range(indptr[i], indptr[i + 1]):
+                value = data[k]
+                j = indices[k]
+                total += value
+                var_totals[b, g, j] += value
+                if value != 0:
+                    n_features[i] += 1
+                    var_n_cells[b, g, j] += 1
+                flags = control_flags[j]
+                c = 0
+                while flags:
+                    if flags & 1:
+                        control_totals[i, c] += value
+                    flags >>= 1
+                    c += 1
+            totals[i] = total
+            if len(ns) > 0:
+                _top_proportions_row(
+                    data[indptr[i]:indptr[i + 1]], ns, total, proportions[i])
+    return (totals, n_features, control_totals, proportions,
+            var_totals, var_n_cells)
+
+
+@numba.njit(parallel=True, nogil=True, error_model='numpy')
+def _qc_metrics_dense(X, control_flags, n_controls, ns, codes, n_groups,
+                      n_blocks):
+    n_obs, n_vars = X.shape
+    step = (n_obs + n_blocks - 1) // n_blocks
+    totals = np.zeros(n_obs)
+    n_features = np.zeros(n_obs, dtype=np.int64)
+    control_totals = np.zeros((n_obs, n_controls))
+    proportions = np.zeros((n_obs, len(ns)))
+    var_totals = np.zeros((n_blocks, n_groups, n_vars))
+    var_n_cells = np.zeros((n_blocks, n_groups, n_vars), dtype=np.int64)
+    for b in numba.prange(n_blocks):
+        for i in range(b * step, min((b + 1) * step, n_obs)):
+            g = codes[i]
+            total = 0.
+            for j in range(n_vars):
+                value = X[i, j]
+                if value == 0:
+                    continue
+                total += value
+                var_totals[b, g, j] += value
+                n_features[i] += 1
+                var_n_cells[b, g, j] += 1
+                flags = control_flags[j]
+                c = 0
+                while flags:
+                    if flags & 1:
+                        control_totals[i, c] += value
+                    flags >>= 1
+                    c += 1
+            totals[i] = total
+            if len(ns) > 0:
+                _top_proportions_row(X[i], ns, total, proportions[i])
+    return (totals, n_features, control_totals, proportions,
+            var_totals, var_n_cells)
+
 def top_proportions(mtx, n):
     """
     Calculates cumulative proportions of top expressed genes
@@ -170,6 +374,23 @@ def top_segment_proportions(mtx, ns):
     if issparse(mtx):
         if not isspmatrix_csr(mtx):
             mtx = csr_matrix(mtx)
+        # the kernel holds the top ns[-1] values of each row
+        bytes_per_row = 2 * max(ns) * mtx.dtype.itemsize
+    else:
+        # partitioning copies each row
+        bytes_per_row = 3 * mtx.shape[1] * mtx.dtype.itemsize
+    chunk_size = chunk_size_from_budget(bytes_per_row)
+    if chunk_size >= mtx.shape[0]:
+        return _top_segment_proportions(mtx, ns)
+    values = np.zeros((mtx.shape[0], len(ns)))
+    for start in range(0, mtx.shape[0], chunk_size):
+        end = min(start + chunk_size, mtx.shape[0])
+        values[start:end] = _top_segment_proportions(mtx[start:end], ns)
+    return values
+
+
+def _top_segment_proportions(mtx, ns):
+    if issparse(mtx):
         return top_segment_proportions_sparse_csr(mtx.data, mtx.indptr, ns)
     else:
         return top_segment_proportions_dense(mtx, ns)
@@ -14,6 +14,8 @@ from anndata import AnnData
 from .. import settings as sett
 from .. import logging as logg
 from ..utils import sanitize_anndata
+from ._chunked import iter_row_chunks, chunk_size_from_budget, row_nbytes, check_budget, memory_budget
+from ._utils import _get_mean_var
 
 # install dask if available
 try:
@@ -239,6 +241,228 @@ def filter_genes(data, min_counts=None, min_cells=None, max_counts=None,
     return gene_subset, number_per_gene
 
 
+def filter_cells_and_genes(data, min_counts_per_cell=None, max_counts_per_cell=None,
+                           min_genes=None, max_genes=None,
+                           min_counts_per_gene=None, max_counts_per_gene=None,
+                           min_cells=None, max_cells=None,
+                           chunked=False, chunk_size=None, copy=False):
+    """Filter cells and genes based on all criteria at once.
+
+    Unlike :func:`~scanpy.api.pp.filter_cells` and
+    :func:`~scanpy.api.pp.filter_genes`, any number of thresholds can be passed.
+    Counts and numbers of expressed entries per cell and per gene are computed
+    in a single pass over the data matrix, which is then subset only once.
+
+    The cell criteria are evaluated on all genes. The gene criteria are
+    evaluated on the cells that pass the cell criteria, just as when calling
+    :func:`~scanpy.api.pp.filter_cells` before
+    :func:`~scanpy.api.pp.filter_genes`.
+
+    Parameters
+    ----------
+    data : :class:`~anndata.AnnData`, `np.ndarray`, `sp.spmatrix`
+        The (annotated) data matrix of shape `n_obs` × `n_vars`. Rows correspond
+        to cells and columns to genes. Backed :class:`~anndata.AnnData` objects
+        are always processed in chunks and loaded into memory after filtering.
+    min_counts_per_cell : `int`, optional (default: `None`)
+        Minimum number of counts required for a cell to pass filtering.
+    max_counts_per_cell : `int`, optional (default: `None`)
+        Maximum number of counts required for a cell to pass filtering.
+    min_genes : `int`, optional (default: `None`)
+        Minimum number of genes expressed required for a cell to pass filtering.
+    max_genes : `int`, optional (default: `None`)
+        Maximum number of genes expressed required for a cell to pass filtering.
+    min_counts_per_gene : `int`, optional (default: `None`)
+        Minimum number of counts required for a gene to pass filtering.
+    max_counts_per_gene : `int`, optional (default: `None`)
+        Maximum number of counts required for a gene to pass filtering.
+    min_cells : `int`, optional (default: `None`)
+        Minimum number of cells expressed required for a gene to pass filtering.
+    max_cells : `int`, optional (default: `None`)
+        Maximum number of cells expressed required for a gene to pass filtering.
+    chunked : `bool`, optional (default: `False`)
+        Process the data matrix in chunks of rows.
+    chunk_size : `int`, optional (default: `None`)
+        Number of rows per chunk if `chunked`. By default derived from
+        `settings.max_memory`.
+    copy : `bool`, optional (default: `False`)
+        If an :class:`~anndata.AnnData` is passed, determines whether a copy
+        is returned.
+
+    Returns
+    -------
+    If `data` is an :class:`~anndata.AnnData`, filters the object and adds\
+    `n_counts` and `n_genes` to `adata.obs` as well as `n_counts` and `n_cells`\
+    to `adata.var`. Otherwise a tuple
+
+    cell_subset : `np.ndarray`
+        Boolean index mask that does filtering of cells.
+    gene_subset : `np.ndarray`
+        Boolean index mask that does filtering of genes.
+
+    Examples
+    --------
+    >>> adata = sc.datasets.pbmc3k()
+    >>> sc.pp.filter_cells_and_genes(adata, min_genes=200, min_cells=3)
+    """
+    cell_criteria = [min_counts_per_cell, max_counts_per_cell, min_genes, max_genes]
+    gene_criteria = [min_counts_per_gene, max_counts_per_gene, min_cells, max_cells]
+    if all(c is None for c in cell_criteria + gene_criteria):
+        raise ValueError(
+            'Provide at least one of `min_counts_per_cell`, `max_counts_per_cell`, '
+            '`min_genes`, `max_genes`, `min_counts_per_gene`, '
+            '`max_counts_per_gene`, `min_cells`, `max_cells`.')
+    if isinstance(data, AnnData):
+        adata = data.copy() if copy else data
+        chunked = chunked or adata.isbacked
+        cell_subset, gene_subset, stats = _filter_cells_and_genes(
+            adata.X, cell_criteria, gene_criteria, chunked, chunk_size)
+        obs_counts, obs_genes, var_counts, var_cells = stats
+        adata.obs['n_counts'] = obs_counts
+        adata.obs['n_genes'] = obs_genes
+        adata.var['n_counts'] = var_counts
+        adata.var['n_cells'] = var_cells
+        _subset_cells_and_genes(adata, cell_subset, gene_subset, chunk_size)
+        return adata if copy else None
+    cell_subset, gene_subset, _ = _filter_cells_and_genes(
+        data, cell_criteria, gene_criteria, chunked, chunk_size)
+    return cell_subset, gene_subset
+
+
+def _filter_cells_and_genes(X, cell_criteria, gene_criteria, chunked, chunk_size):
+    n_obs, n_vars = X.shape
+    obs_counts = np.zeros(n_obs, dtype=np.float64)
+    obs_genes = np.zeros(n_obs, dtype=np.int64)
+    var_counts = np.zeros(n_vars, dtype=np.float64)
+    var_cells = np.zeros(n_vars, dtype=np.int64)
+    cell_subset = np.zeros(n_obs, dtype=bool)
+    if chunked:
+        if chunk_size is None:
+            chunk_size = chunk_size_from_budget(row_nbytes(X), n_copies=2)
+        chunks = iter_row_chunks(X, chunk_size)
+    else:
+        chunks = [(csr_matrix(X) if issparse(X) and not isspmatrix_csr(X) else X, 0, n_obs)]
+    for chunk, start, end in chunks:
+        if issparse(chunk):
+            counts, genes = _row_counts_csr(chunk.data, chunk.indptr)
+        else:
+            counts, genes = _row_counts_dense(chunk)
+        obs_counts[start:end] = counts
+        obs_genes[start:end] = genes
+        mask = _within(counts, *cell_criteria[:2]) & _within(genes, *cell_criteria[2:])
+        cell_subset[start:end] = mask
+        if issparse(chunk):
+            _column_counts_csr(chunk.data, chunk.indices, chunk.indptr, mask,
+                               var_counts, var_cells)
+        else:
+            _column_counts_dense(chunk, mask, var_counts, var_cells)
+    gene_subset = (_within(var_counts, *gene_criteria[:2])
+                   & _within(var_cells, *gene_criteria[2:]))
+    logg.info('filtered out {} cells and {} genes'
+              .format(n_obs - cell_subset.sum(), n_vars - gene_subset.sum()))
+    return cell_subset, gene_subset, (obs_counts, obs_genes, var_counts, var_cells)
+
+
+def _within(number, min_number, max_number):
+    subset = np.ones(len(number), dtype=bool)
+    if min_number is not None:
+        subset &= number >= min_number
+    if max_number is not None:
+        subset &= number <= max_number
+    return subset
+
+
+def _subset_cells_and_genes(adata, cell_subset, gene_subset, chunk_size):
+    """Subset both dimensions of `adata` inplace, copying the data only once.
+
+    Backed objects are read in chunks and loaded into memory.
+    """
+    if adata.isbacked:
+        blocks = [
+            _subset_matrix(chunk, cell_subset[start:end], gene_subset)
+            for chunk, start, end in iter_row_chunks(
+                adata.X, chunk_size_from_budget(row_nbytes(adata.X), n_copies=2)
+                if chunk_size is None else chunk_size)]
+        if blocks and issparse(blocks[0]):
+            X = sp.sparse.vstack(blocks, format='csr')
+        else:
+            X = np.vstack(blocks)
+        layers, raw = None, None
+        if adata.raw is not None:
+            logg.warn('`.raw` of a backed AnnData is not carried over when filtering.')
+    else:
+        X = _subset_matrix(adata._X, cell_subset, gene_subset)
+        layers = {key: _subset_matrix(layer, cell_subset, gene_subset)
+                  for key, layer in adata.layers.items()}
+        raw = None if adata.raw is None else adata.raw[cell_subset]
+    obs = adata.obs[cell_subset].copy()
+    var = adata.var[gene_subset].copy()
+    obsm = {key: value[cell_subset] for key, value in adata.obsm.items()}
+    varm = {key: value[gene_subset] for key, value in adata.varm.items()}
+    uns = adata.uns
+    if adata.isbacked:
+        adata.file.close()
+    adata._init_as_actual(X=X, obs=obs, var=var, uns=uns, obsm=obsm, varm=varm,
+                          layers=layers, raw=raw, dtype=X.dtype)
+
+
+def _subset_matrix(X, cell_subset, gene_subset):
+    """Select rows and columns of `X` by boolean masks in a single copy."""
+    rows, cols = np.flatnonzero(cell_subset), np.flatnonzero(gene_subset)
+    if not issparse(X):
+        return X[np.ix_(rows, cols)]
+    # index the compressed axis first, which only copies the selected part
+    if sp.sparse.isspmatrix_csc(X):
+        return X[:, cols][rows]
+    return X[rows][:, cols]
+
+
+@numba.njit(parallel=True)
+def _row_counts_csr(data, indptr):
+    n = len(indptr) - 1
+    counts = np.zeros(n, dtype=np.float64)
+    n_positive = np.zeros(n, dtype=np.int64)
+    for i in numba.prange(n):
+        for j in range(indptr[i], indptr[i + 1]):
+            counts[i] += data[j]
+            if data[j] > 0:
+                n_positive[i] += 1
+    return counts, n_positive
+
+
+@numba.njit(parallel=True)
+def _row_counts_dense(X):
+    n = X.shape[0]
+    counts = np.zeros(n, dtype=np.float64)
+    n_positive = np.zeros(n, dtype=np.int64)
+    for i in numba.prange(n):
+        for j in range(X.shape[1]):
+            counts[i] += X[i, j]
+            if X[i, j] > 0:
+                n_positive[i] += 1
+    return counts, n_positive
+
+
+@numba.njit
+def _column_counts_csr(data, indices, indptr, row_mask, counts, n_positive):
+    for i in range(len(indptr) - 1):
+        if row_mask[i]:
+            for j in range(indptr[i], indptr[i + 1]):
+                counts[indices[j]] += data[j]
+                if data[j] > 0:
+                    n_positive[indices[j]] += 1
+
+
+@numba.njit
+def _column_counts_dense(X, row_mask, counts, n_positive):
+    for i in range(X.shape[0]):
+        if row_mask[i]:
+            for j in range(X.shape[1]):
+                counts[j] += X[i, j]
+                if X[i, j] > 0:
+                    n_positive[j] += 1
+
+
 def log1p(data, copy=False, chunked=False, chunk_size=None):
     """Logarithmize the data matrix.
 
@@ -252,6 +476,11 @@ def log1p(data, copy=False, chunked=False, chunk_size=None):
     copy : `bool`, optional (default: `False`)
         If an :class:`~anndata.AnnData` is passed, determines whether a copy
         is returned.
+    chunked : `bool`, optional (default: `False`)
+        Process the data matrix in chunks of rows.
+    chunk_size : `int`, optional (default: `None`)
+        Number of rows per chunk if `chunked`. By default derived from
+        `settings.max_memory`.
 
     Returns
     -------
@@ -270,6 +499,8 @@ def log1p(data, copy=False, chunked=False, chunk_size=None):
 
     if isinstance(data, AnnData):
         if chunked:
+            if chunk_size is None:
+                chunk_size = chunk_size_from_budget(row_nbytes(data.X), n_copies=2)
             for chunk, start, end in data.chunked_X(chunk_size):
                  data.X[start:end] = _log1p(chunk)
         else:
@@ -293,6 +524,11 @@ def sqrt(data, copy=False, chunked=False, chunk_size=None):
     copy : `bool`, optional (default: `False`)
         If an :class:`~scanpy.api.AnnData` is passed, determines whether a copy
         is returned.
+    chunked : `bool`, optional (default: `False`)
+        Process the data matrix in chunks of rows.
+    chunk_size : `int`, optional (default: `None`)
+        Number of rows per chunk if `chunked`. By default derived from
+        `settings.max_memory`.
 
     Returns
     -------
@@ -301,6 +537,8 @@ def sqrt(data, copy=False, chunked=False, chunk_size=None):
     if isinstance(data, AnnData):
         adata = data.copy() if copy else data
         if chunked:
+            if chunk_size is None:
+                chunk_size = chunk_size_from_budget(row_nbytes(adata.X), n_copies=2)
             for chunk, start, end in adata.chunked_X(chunk_size):
                 adata.X[start:end] = sqrt(chunk)
         else:
@@ -354,8 +592,15 @@ def pca(data, n_comps=None, zero_center=True, svd_solver='auto', random_state=0,
         incremental PCA automatically zero centers and ignores settings of
         `random_seed` and `svd_solver`. If `False`, perform a full PCA.
     chunk_size : `int`, optional (default: `None`)
-        Number of observations to include in each chunk. Required if `chunked`
-        is `True`.
+        Number of observations to include in each chunk. By default derived
+        from `settings.max_memory`.
+
+    If zero-centering sparse data would densify it beyond
+    `settings.max_memory`, the incremental PCA is used automatically.
+
+    Dask arrays are decomposed without loading them into memory: for
+    `svd_solver='randomized'` by a randomized SVD, otherwise by the exact SVD
+    based on a tall-and-skinny QR decomposition.
 
     Returns
     -------
@@ -402,12 +647,21 @@ def pca(data, n_comps=None, zero_center=True, svd_solver='auto', random_state=0,
         use_highly_variable = True if 'highly_variable' in adata.var.keys() else False
     adata_comp = adata[:, adata.var['highly_variable']] if use_highly_variable else adata
 
+    if (not chunked and zero_center and issparse(adata_comp.X)
+            and np.prod(adata_comp.shape) * adata_comp.X.dtype.itemsize > memory_budget()):
+        logg.info('    densifying the data would exceed `settings.max_memory`, '
+                  'computing an incremental PCA instead')
+        chunked = True
     if chunked:
         if not zero_center or random_state or svd_solver != 'auto':
             logg.msg('Ignoring zero_center, random_state, svd_solver', v=4)
 
         from sklearn.decomposition import IncrementalPCA
 
+        if chunk_size is None:
+            # the densified chunk and scikit-learn's copies of it
+            chunk_size = max(n_comps, chunk_size_from_budget(
+                row_nbytes(adata_comp.X, dense=True), n_copies=4))
         X_pca = np.zeros((adata_comp.X.shape[0], n_comps), adata_comp.X.dtype)
 
         pca_ = IncrementalPCA(n_components=n_comps)
@@ -419,6 +673,13 @@ def pca(data, n_comps=None, zero_center=True, svd_solver='auto', random_state=0,
         for chunk, start, end in adata_comp.chunked_X(chunk_size):
             chunk = chunk.toarray() if issparse(chunk) else chunk
             X_pca[start:end] = pca_.transform(chunk)
+    elif da is not None and isinstance(adata.X, da.Array):
+        # views of AnnData objects would load the dask array into memory
+        X = adata.X[:, adata.var['highly_variable'].values] if use_highly_variable else adata.X
+        zero_center = zero_center if zero_center is not None else True
+        pca_ = _DaskPCA(n_components=n_comps, zero_center=zero_center,
+                        svd_solver=svd_solver, random_state=random_state)
+        X_pca = pca_.fit_transform(X)
     else:
         zero_center = zero_center if zero_center is not None else False if issparse(adata_comp.X) else True
         if zero_center:
@@ -467,6 +728,43 @@ def pca(data, n_comps=None, zero_center=True, svd_solver='auto', random_state=0,
             return X_pca
 
 
+class _DaskPCA:
+    """PCA of a dask array, exposing the attributes of scikit-learn's PCA."""
+
+    def __init__(self, n_components, zero_center=True, svd_solver='auto',
+                 random_state=0):
+        self.n_components = n_components
+        self.zero_center = zero_center
+        self.svd_solver = svd_solver
+        self.random_state = random_state
+
+    def fit_transform(self, X):
+        from sklearn.utils.extmath import svd_flip
+        n_obs = X.shape[0]
+        mean, var = materialize_as_ndarray(_get_mean_var(X))
+        if self.zero_center:
+            X = X - mean.astype(X.dtype)
+        if self.svd_solver == 'randomized':
+            u, s, v = da.linalg.svd_compressed(
+                X, self.n_components, n_power_iter=4, seed=self.random_state)
+        else:
+            # tsqr requires a single chunk along the columns
+            u, s, v = da.linalg.svd(X.rechunk({1: -1}))
+        u, s, v = da.compute(
+            u[:, :self.n_components], s[:self.n_components], v[:self.n_components])
+        u, v = svd_flip(u, v)
+        X_pca = u * s
+        if self.zero_center:
+            self.explained_variance_ = s ** 2 / (n_obs - 1)
+            total_var = var.sum()
+        else:  # like TruncatedSVD
+            self.explained_variance_ = X_pca.var(axis=0)
+            total_var = var.sum() * (n_obs - 1) / n_obs
+        self.explained_variance_ratio_ = self.explained_variance_ / total_var
+        self.components_ = v
+        return X_pca
+
+
 def normalize_per_cell(data, counts_per_cell_after=None, counts_per_cell=None,
                        key_n_counts=None, copy=False, layers=[], use_rep=None,
                        min_counts=1):
@@ -646,6 +944,8 @@ def regress_out(adata, keys, n_jobs=None, copy=False):
         keys = [keys]
 
     if issparse(adata.X):
+        check_budget(np.prod(adata.X.shape) * adata.X.dtype.itemsize,
+                     'Densifying the data matrix for `regress_out`')
         adata.X = adata.X.toarray()
 
     n_jobs = sett.n_jobs if n_jobs is None else n_jobs
@@ -759,17 +1059,29 @@ def scale(data, zero_center=True, max_value=None, copy=False):
     Returns
     -------
     Depending on `copy` returns or updates `adata` with a scaled `adata.X`.
+    A dask array passed as `data` is always returned as a lazily scaled copy.
     """
     if isinstance(data, AnnData):
         adata = data.copy() if copy else data
+        if da is not None and isinstance(adata.X, da.Array):
+            adata.X = scale(adata.X, zero_center=zero_center, max_value=max_value)
+            return adata if copy else None
         # need to add the following here to make inplace logic work
         if zero_center and issparse(adata.X):
             logg.msg(
                 '... scale_data: as `zero_center=True`, sparse input is '
                 'densified and may lead to large memory consumption')
+            check_budget(np.prod(adata.X.shape) * adata.X.dtype.itemsize,
+                         'Zero-centering the sparse data matrix')
             adata.X = adata.X.toarray()
         scale(adata.X, zero_center=zero_center, max_value=max_value, copy=False)
         return adata if copy else None
+    if da is not None and isinstance(data, da.Array):
+        # dask arrays cannot be modified inplace, return a lazily scaled array
+        mean, var = materialize_as_ndarray(_get_mean_var(data))
+        X = data - mean.astype(data.dtype) if zero_center else data
+        X = X / np.sqrt(var).astype(data.dtype)
+        return X if max_value is None else da.minimum(X, max_value)
     X = data.copy() if copy else data  # proceed with the data matrix
     zero_center = zero_center if zero_center is not None else False if issparse(X) else True
     if not zero_center and max_value is not None:
@@ -782,6 +1094,8 @@ def scale(data, zero_center=True, max_value=None, copy=False):
         logg.msg('... scale_data: as `zero_center=True`, sparse input is '
                  'densified and may lead to large memory consumption, returning copy',
                  v=4)
+        check_budget(np.prod(X.shape) * X.dtype.itemsize,
+                     'Zero-centering the sparse data matrix')
         X = X.toarray()
         copy = True
     _scale(X, zero_center)
@@ -789,9 +1103,18 @@ def scale(data, zero_center=True, max_value=None, copy=False):
     return X if copy else None
 
 
-def subsample(data, fraction=None, n_obs=None, random_state=0, copy=False):
+def subsample(data, fraction=None, n_obs=None, random_state=0, copy=False,
+              method='uniform', use_rep=None, n_pcs=None):
     """Subsample to a fraction of the number of observations.
 
+    By default, observations are drawn uniformly, so that rare populations
+    may vanish. The `'geometric'` method instead draws a geometric sketch
+    [Hie19]_ that covers the space of a low-dimensional representation
+    evenly: the representation is partitioned into a grid of hypercubes
+    and one observation is drawn from each of `n_obs` randomly chosen
+    non-empty hypercubes. Its run time is linear in the number of
+    observations.
+
     Parameters
     ----------
     data : :class:`~anndata.AnnData`, `np.ndarray`, `sp.sparse`
@@ -806,6 +1129,14 @@ def subsample(data, fraction=None, n_obs=None, random_state=0, copy=False):
     copy : `bool`, optional (default: `False`)
         If an :class:`~anndata.AnnData` is passed, determines whether a copy
         is returned.
+    method : {`'uniform'`, `'geometric'`}, optional (default: `'uniform'`)
+        Draw observations uniformly or as a geometric sketch.
+    use_rep : `str` or `None`, optional (default: `None`)
+        Representation used by the `'geometric'` method, see
+        :func:`~scanpy.api.pp.neighbors`. If `data` is array-like, its rows
+        are used directly.
+    n_pcs : `int` or `None`, optional (default: `None`)
+        Number of PCs used by the `'geometric'` method if `use_rep` is `None`.
 
     Returns
     -------
@@ -825,7 +1156,18 @@ def subsample(data, fraction=None, n_obs=None, random_state=0, copy=False):
         logg.msg('... subsampled to {} data points'.format(new_n_obs))
     else:
         raise ValueError('Either pass `n_obs` or `fraction`.')
-    obs_indices = np.random.choice(old_n_obs, size=new_n_obs, replace=False)
+    if method == 'uniform':
+        obs_indices = np.random.choice(old_n_obs, size=new_n_obs, replace=False)
+    elif method == 'geometric':
+        if isinstance(data, AnnData):
+            from ..tools._utils import choose_representation
+            X_rep = choose_representation(data, use_rep=use_rep, n_pcs=n_pcs)
+        else:
+            X_rep = data
+        X_rep = X_rep.toarray() if issparse(X_rep) else X_rep
+        obs_indices = _geometric_sketch(X_rep, new_n_obs)
+    else:
+        raise ValueError('`method` needs to be \'uniform\' or \'geometric\'.')
     if isinstance(data, AnnData):
         adata = data.copy() if copy else data
         adata._inplace_subset_obs(obs_indices)
@@ -835,13 +1177,63 @@ def subsample(data, fraction=None, n_obs=None, random_state=0, copy=False):
         return X[obs_indices], obs_indices
 
 
-def downsample_counts(adata, target_counts=20000, random_state=0, 
-                      replace=True, copy=False):
+def _geometric_sketch(X, n_obs, n_iter=30):
+    """Indices of a geometric sketch of the rows of `X` of size `n_obs`.
+
+    Uses the global state of `np.random`.
+    """
+    X = np.asarray(X, dtype=np.float64)
+    X = X - X.min(axis=0)
+    X /= max(X.max(), np.finfo(np.float64).tiny)
+    # random odd multipliers hash the integer grid coordinates to one key
+    multipliers = np.random.randint(1, 2**62, size=X.shape[1], dtype=np.int64) | 1
+
+    def boxes(side):
+        keys = np.floor(X / side).astype(np.int64) @ multipliers
+        return pd.factorize(keys)[0]
+
+    # bisect the (logarithmic) side length for the coarsest grid that has
+    # at least `n_obs` non-empty hypercubes, stop once close enough
+    low, high = np.log(1e-12), np.log(2.)
+    box_ids = boxes(np.exp(low))
+    for _ in range(n_iter):
+        middle = (low + high) / 2
+        ids = boxes(np.exp(middle))
+        if ids.max() + 1 >= n_obs:
+            low, box_ids = middle, ids
+            if ids.max() + 1 <= 1.05 * n_obs:
+                break
+        else:
+            high = middle
+    n_boxes = box_ids.max() + 1
+    # a random member for each hypercube
+    order = np.random.permutation(X.shape[0])
+    members = np.empty(n_boxes, dtype=int)
+    members[box_ids[order]] = order
+    if n_boxes >= n_obs:
+        obs_indices = np.random.choice(members, size=n_obs, replace=False)
+    else:  # duplicated observations, fill up uniformly
+        rest = np.setdiff1d(np.arange(X.shape[0]), members)
+        obs_indices = np.concatenate([
+            members, np.random.choice(rest, size=n_obs - n_boxes, replace=False)])
+    return np.sort(obs_indices)
+
+
+def downsample_counts(adata, target_counts=20000, random_state=0,
+                      replace=True, copy=False, total_counts=None):
     """Downsample counts so that each cell has no more than `target_counts`.
 
     Cells with fewer counts than `target_counts` are unaffected by this. This
     has been implemented by M. D. Luecken.
 
+    Alternatively, pass `total_counts` to downsample the whole data matrix so
+    that the sum of all counts is `total_counts`. This is equivalent to
+    drawing `total_counts` of all counts of the data set at once and is
+    useful for comparing data sets at the same sequencing depth.
+
+    Cells are processed in parallel, each with an independent stream of
+    random numbers, so results do not depend on the number of threads.
+
     Parameters
     ----------
     adata : :class:`~anndata.AnnData`
@@ -849,6 +1241,7 @@ def downsample_counts(adata, target_counts=20000, random_state=0,
     target_counts : `int` (default: 20,000)
         Target number of counts for downsampling. Cells with more counts than
         'target_counts' will be downsampled to have 'target_counts' counts.
+        Ignored if `total_counts` is passed.
     random_state : `int` or `None`, optional (default: 0)
         Random seed to change subsampling.
     replace : `bool`, optional (default: `True`)
@@ -856,6 +1249,8 @@ def downsample_counts(adata, target_counts=20000, random_state=0,
     copy : `bool`, optional (default: `False`)
         If an :class:`~anndata.AnnData` is passed, determines whether a copy
         is returned.
+    total_counts : `int` or `None`, optional (default: `None`)
+        Target number of counts of the whole data matrix.
 
     Returns
     -------
@@ -864,53 +1259,100 @@ def downsample_counts(adata, target_counts=20000, random_state=0,
     if copy:
         adata = adata.copy()
     adata.X = adata.X.astype(np.integer)  # Numba doesn't want floats
-    if issparse(adata.X):
-        X = adata.X
-        if not isspmatrix_csr(X):
-            X = csr_matrix(X)
-        totals = np.ravel(X.sum(axis=1))
-        under_target = np.nonzero(totals > target_counts)[0]
-        cols = np.split(X.data.view(), X.indptr[1:-1])
-        for colidx in under_target:
-            col = cols[colidx]
-            downsample_cell(col, target_counts, random_state=random_state,
-                            replace=replace, inplace=True)
+    X = adata.X
+    if issparse(X) and not isspmatrix_csr(X):
+        X = csr_matrix(X)
+    totals = np.ravel(X.sum(axis=1))
+    random_state = np.random.RandomState(random_state)
+    if total_counts is None:
+        targets = np.full(totals.shape, target_counts, dtype=totals.dtype)
+    elif total_counts >= totals.sum():
+        logg.info('total_counts is not smaller than the total counts of the data, '
+                  'not downsampling')
+        targets = totals
+    else:
+        # distribute the total target over cells, then downsample each cell;
+        # always without replacement so that no cell exceeds its own counts
+        targets = totals.copy()
+        _downsample_array_seeded(
+            targets, total_counts, random_state.randint(2**31 - 1), False)
+    seeds = random_state.randint(2**31 - 1, size=X.shape[0])
+    if issparse(X):
+        _downsample_csr(X.data, X.indptr, targets, seeds, replace)
         if not isspmatrix_csr(adata.X):  # Put it back
             adata.X = type(adata.X)(X)
     else:
-        totals = np.ravel(adata.X.sum(axis=1))
-        under_target = np.nonzero(totals > target_counts)[0]
-        adata.X[under_target, :] = \
-            np.apply_along_axis(downsample_cell, 1, adata.X[under_target, :],
-                                target_counts, random_state=random_state, replace=replace)
+        _downsample_dense(X, targets, seeds, replace)
     if copy: return adata
 
+
+@numba.njit(parallel=True)
+def _downsample_csr(data, indptr, targets, seeds, replace):
+    for i in numba.prange(indptr.size - 1):
+        col = data[indptr[i]:indptr[i+1]]
+        if col.sum() > targets[i]:
+            np.random.seed(seeds[i])  # only seeds the state of this thread
+            _downsample_array(col, targets[i], replace)
+
+
+@numba.njit(parallel=True)
+def _downsample_dense(X, targets, seeds, replace):
+    for i in numba.prange(X.shape[0]):
+        col = X[i]
+        if col.sum() > targets[i]:
+            np.random.seed(seeds[i])
+            _downsample_array(col, targets[i], replace)
+
+
+def downsample_cell(col, target, random_state=0, replace=True, inplace=False):
+    """Evenly reduce counts in cell to target amount.
+
+    Deprecated, use :func:`~scanpy.api.pp.downsample_counts` instead.
+    """
+    logg.warn('`downsample_cell` is deprecated, use `downsample_counts` instead')
+    if not inplace:
+        col = col.copy()
+    if col.sum() > target:
+        _downsample_array_seeded(col, target, random_state, replace)
+    return col
+
+
 @numba.njit
-def downsample_cell(col: np.array, target: int, random_state: int=0, 
-                    replace: bool=True, inplace: bool=False):
+def _downsample_array_seeded(col, target, seed, replace):
+    np.random.seed(seed)
+    _downsample_array(col, target, replace)
+
+
+@numba.njit
+def _downsample_array(col, target, replace):
     """
-    Evenly reduce counts in cell to target amount.
-    
-    This is an internal function and has some restrictions:
-    
-    * `dtype` of col must be an integer (i.e. satisfy issubclass(col.dtype.type, np.integer))
-    * total counts in cell must be less than target
+    Evenly reduce counts in `col` to `target` amount, inplace.
+
+    Draws the counts of each entry sequentially from the conditional binomial
+    (with replacement) or hypergeometric (without replacement) distribution,
+    which does not need to allocate an array of size of the total counts.
+
+    `col` needs to be of integer type and have more counts than `target`.
     """
-    np.random.seed(random_state)
-    cumcounts = col.cumsum()
-    if inplace:
-        col[:] = 0
-    else:
-        col = np.zeros_like(col)
-    total = cumcounts[-1]
-    sample = np.random.choice(total, target, replace=replace)
-    sample.sort()
-    geneptr = 0
-    for count in sample:
-        while count >= cumcounts[geneptr]:
-            geneptr += 1
-        col[geneptr] += 1
-    return col
+    remaining_total = col.sum()
+    remaining = target
+    for j in range(col.size):
+        count = col[j]
+        if count == 0:
+            continue
+        if remaining == 0:
+            col[j] = 0
+            continue
+        if count == remaining_total:
+            drawn = remaining
+        elif replace:
+            drawn = np.random.binomial(remaining, count / remaining_total)
+        else:
+            drawn = np.random.hypergeometric(
+                count, remaining_total - count, remaining)
+        col[j] = drawn
+        remaining -= drawn
+        remaining_total -= count
 
 
 def zscore_deprecated(X):
@@ -961,29 +1403,6 @@ def _pca_fallback(data, n_comps=2):
     return np.dot(evecs.T, data.T).T
 
 
-def _get_mean_var(X):
-    # - using sklearn.StandardScaler throws an error related to
-    #   int to long trafo for very large matrices
-    # - using X.multiply is slower
-    if True:
-        mean = X.mean(axis=0)
-        if issparse(X):
-            mean_sq = X.multiply(X).mean(axis=0)
-            mean = mean.A1
-            mean_sq = mean_sq.A1
-        else:
-            mean_sq = np.multiply(X, X).mean(axis=0)
-        # enforece R convention (unbiased estimator) for variance
-        var = (mean_sq - mean**2) * (X.shape[0]/(X.shape[0]-1))
-    else:
-        from sklearn.preprocessing import StandardScaler
-        scaler = StandardScaler(with_mean=False).partial_fit(X)
-        mean = scaler.mean_
-        # enforce R convention (unbiased estimator)
-        var = scaler.var_ * (X.shape[0]/(X.shape[0]-1))
-    return mean, var
-
-
 def _scale(X, zero_center=True):
     # - using sklearn.StandardScaler throws an error related to
     #   int to long trafo for very large matrices
@@ -0,0 +1,193 @@
+"""Size factors from pooled cells
+"""
+
+import numba
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix, diags
+from scipy.sparse.linalg import LinearOperator, lsqr
+
+from .. import logging as logg
+from .. import settings
+
+# weight of the equations that tie each cell to the average cell and make the
+# linear system solvable
+_LOW_WEIGHT = 1e-6
+
+
+def pooled_size_factors(adata, sizes=(21, 41, 61, 81, 101), groupby=None,
+                        min_mean=0.1, key_added='size_factors', copy=False):
+    """Size factors by deconvolution of pooled cells [Lun16]_.
+
+    Counts are summed over pools of cells with similar library sizes, whose
+    size factors can be robustly estimated against an average pseudo-cell
+    as the median ratio of expression, even if most counts are zero. The
+    size factors of the pools are then deconvolved into size factors of the
+    cells by solving a sparse linear system. This is the estimator of
+    `computeSumFactors` from *scran*, implemented natively.
+
+    Cells are arranged in a ring ordered by library size and pools are
+    formed by sliding windows of each size in `sizes` around it.
+
+    Parameters
+    ----------
+    adata : :class:`~anndata.AnnData`
+        Annotated data matrix with counts in `.X`.
+    sizes : sequence of `int`, optional (default: `(21, 41, 61, 81, 101)`)
+        Pool sizes. Pools larger than a group of cells are skipped.
+    groupby : `str` or `None`, optional (default: `None`)
+        Key of a categorical annotation in `.obs` of groups of cells, e.g.,
+        a coarse clustering, that are pooled separately. Size factors of the
+        groups are rescaled to be comparable. Pooling within groups avoids
+        violating the assumption that most genes are not differentially
+        expressed between the cells of a pool.
+    min_mean : `float`, optional (default: 0.1)
+        Only use genes whose average library size-adjusted count is at
+        least `min_mean`.
+    key_added : `str`, optional (default: `'size_factors'`)
+        Key in `.obs` under which to store the size factors.
+    copy : `bool`, optional (default: `False`)
+        Return a copy instead of writing to `adata`.
+
+    Returns
+    -------
+    Depending on `copy`, returns or updates `adata` with the size factors,
+    centered to have mean 1, in `.obs[key_added]`. To normalize, divide by
+    them, e.g., with `sc.pp.normalize_per_cell(adata,
+    counts_per_cell=adata.obs['size_factors'].values, counts_per_cell_after=1)`.
+    """
+    logg.info('computing pooled size factors', r=True)
+    adata = adata.copy() if copy else adata
+    X = csr_matrix(adata.X, dtype=np.float64)
+    lib_sizes = np.ravel(X.sum(axis=1))
+    if np.any(lib_sizes <= 0):
+        raise ValueError('All cells need to have positive library sizes.')
+    if groupby is None:
+        groups_codes = np.zeros(adata.n_obs, dtype=int)
+    else:
+        groups_codes = pd.Categorical(adata.obs[groupby]).codes
+    # library size-adjusted counts, scaled to the average library size
+    X_adjusted = diags(lib_sizes.mean() / lib_sizes) @ X
+    size_factors = np.zeros(adata.n_obs)
+    for code in np.unique(groups_codes):
+        cells = np.flatnonzero(groups_codes == code)
+        X_group = X_adjusted[cells]
+        pseudo_cell = np.ravel(X_group.mean(axis=0))
+        genes = pseudo_cell >= min_mean
+        if not np.any(genes):
+            raise ValueError(
+                'No gene has an average count of at least `min_mean = {}`.'
+                .format(min_mean))
+        theta = _deconvolve(
+            X_group[:, genes], pseudo_cell[genes], lib_sizes[cells], sizes)
+        size_factors[cells] = theta * lib_sizes[cells]
+    if groupby is not None:
+        size_factors = _rescale_groups(X, size_factors, groups_codes)
+    if np.any(size_factors <= 0):
+        logg.warn('encountered non-positive size factors, '
+                  'consider filtering cells with low counts or using larger pools')
+    adata.obs[key_added] = size_factors / size_factors.mean()
+    logg.info('    finished', time=True,
+              end=' ' if settings.verbosity > 2 else '\n')
+    logg.hint('added\n'
+              '    \'{}\', size factors (adata.obs)'.format(key_added))
+    return adata if copy else None
+
+
+def _deconvolve(X, pseudo_cell, lib_sizes, sizes):
+    """Size factors of the cells relative to their library sizes."""
+    n_cells = X.shape[0]
+    sizes = np.array([s for s in sizes if s <= n_cells], dtype=np.int64)
+    if len(sizes) == 0:
+        sizes = np.array([n_cells], dtype=np.int64)
+    # ring of cells: even ranks of the library sizes ascending, odd descending,
+    # so that every window pools cells of similar library sizes
+    order = np.argsort(lib_sizes, kind='mergesort')
+    ring = np.concatenate([order[::2], order[1::2][::-1]])
+    X_ring = X[ring]
+    medians = _pool_medians(
+        X_ring.data, X_ring.indices, X_ring.indptr, pseudo_cell, sizes,
+        max(1, min(numba.config.NUMBA_NUM_THREADS, n_cells)))
+    # one equation per pool, which sums the size factors of its cells, plus
+    # one down-weighted equation per cell; the design matrix has
+    # `sum(sizes) * n_cells` entries and is applied via cumulative sums over
+    # the ring instead of being stored
+    weight = np.sqrt(_LOW_WEIGHT)
+    n_pools = len(sizes) * n_cells
+    cells = np.arange(n_cells)
+
+    def matvec(theta):
+        theta = np.ravel(theta)
+        cumsum = np.concatenate([[0], np.cumsum(np.concatenate([theta, theta]))])
+        return np.concatenate(
+            [cumsum[cells + size] - cumsum[cells] for size in sizes]
+            + [weight * theta])
+
+    def rmatvec(y):
+        y = np.ravel(y)
+        theta = weight * y[n_pools:]
+        for size, pools in zip(sizes, np.split(y[:n_pools], len(sizes))):
+            # cell j is in the pools starting at j - size + 1, ..., j
+            cumsum = np.concatenate([[0], np.cumsum(np.concatenate([pools, pools]))])
+            ends = cells + n_cells + 1
+            theta = theta + cumsum[ends] - cumsum[ends - size]
+        return theta
+
+    design = LinearOperator(
+        (n_pools + n_cells, n_cells), matvec=matvec, rmatvec=rmatvec)
+    rhs = np.concatenate([medians.ravel(), np.full(n_cells, weight)])
+    theta = np.empty(n_cells)
+    theta[ring] = lsqr(design, rhs, atol=1e-10, btol=1e-10)[0]
+    return theta
+
+
+def _rescale_groups(X, size_factors, groups_codes):
+    """Make size factors comparable across groups via their pseudo-cells.
+
+    Each group is rescaled by the median ratio of its average normalized
+    expression to the one of the largest group.
+    """
+    codes = np.unique(groups_codes)
+    X_normalized = diags(1 / size_factors) @ X
+    pseudo_cells = [
+        np.ravel(X_normalized[groups_codes == code].mean(axis=0))
+        for code in codes]
+    reference = pseudo_cells[np.argmax(np.bincount(groups_codes)[codes])]
+    for code, pseudo_cell in zip(codes, pseudo_cells):
+        genes = (pseudo_cell > 0) & (reference > 0)
+        size_factors[groups_codes == code] *= np.median(
+            pseudo_cell[genes] / reference[genes])
+    return size_factors
+
+
+@numba.njit(parallel=True)
+def _pool_medians(data, indices, indptr, pseudo_cell, sizes, n_blocks):
+    # every block of starting positions slides its own window around the ring
+    n_cells = len(indptr) - 1
+    n_genes = len(pseudo_cell)
+    medians = np.zeros((len(sizes), n_cells))
+    step = (n_cells + n_blocks - 1) // n_blocks
+    for b in numba.prange(n_blocks):
+        window = np.zeros(n_genes)
+        ratios = np.zeros(n_genes)
+        start, stop = b * step, min((b + 1) * step, n_cells)
+        for s in range(len(sizes)):
+            if start >= stop:
+                continue
+            window[:] = 0
+            for j in range(start, start + sizes[s]):
+                row = j % n_cells
+                for k in range(indptr[row], indptr[row + 1]):
+                    window[indices[k]] += data[k]
+            for i in range(start, stop):
+                if i > start:
+                    row = (i - 1) % n_cells
+                    for k in range(indptr[row], indptr[row + 1]):
+                        window[indices[k]] -= data[k]
+                    row = (i + sizes[s] - 1) % n_cells
+                    for k in range(indptr[row], indptr[row + 1]):
+                        window[indices[k]] += data[k]
+                for g in range(n_genes):
+                    ratios[g] = window[g] / pseudo_cell[g]
+                medians[s, i] = np.median(ratios)
+    return medians
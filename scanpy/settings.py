@@ -58,7 +58,8 @@ figdir = './figures/'
 max_memory = 15
 """Maximal memory usage in Gigabyte.
 
-Is currently not well respected....
+Chunked computations derive their chunk sizes from it. Operations that would
+densify data beyond it switch to a chunked computation or fail early.
 """
 
 n_jobs = 1
@@ -0,0 +1,31 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse as sp
+from anndata import AnnData
+
+import scanpy.api as sc
+
+
+def test_aggregate():
+    np.random.seed(0)
+    X = sp.random(200, 30, density=0.3, format='csr') * 10
+    obs = pd.DataFrame({
+        'sample': pd.Categorical(np.random.choice(['a', 'b'], 200)),
+        'cell_type': pd.Categorical(np.random.choice(['t', 'b', 'nk'], 200))})
+    obs.loc[obs.index[:5], 'cell_type'] = np.nan
+    funcs = ['sum', 'mean', 'count_nonzero', 'var']
+    for data in [X, X.toarray()]:
+        adata = AnnData(data, obs=obs)
+        agg = sc.tl.aggregate(adata, ['sample', 'cell_type'], funcs=funcs)
+        assert agg.shape == (6, 30)
+        assert np.array_equal(agg.X, agg.layers['sum'])
+        dense = X.toarray()
+        for name, group in agg.obs.iterrows():
+            mask = ((obs['sample'] == group['sample'])
+                    & (obs['cell_type'] == group['cell_type'])).values
+            assert group['n_cells'] == mask.sum()
+            i = agg.obs_names.get_loc(name)
+            assert np.allclose(agg.layers['sum'][i], dense[mask].sum(axis=0))
+            assert np.allclose(agg.layers['mean'][i], dense[mask].mean(axis=0))
+            assert np.allclose(agg.layers['count_nonzero'][i], (dense[mask] != 0).sum(axis=0))
+            assert np.allclose(agg.layers['var'][i], dense[mask].var(axis=0, ddof=1))
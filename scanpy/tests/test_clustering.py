@@ -1,4 +1,5 @@
 import pytest
+import numpy as np
 import scanpy.api as sc
 
 @pytest.fixture
@@ -22,3 +23,23 @@ def test_partition_type(adata_neighbors):
     import louvain
     sc.tl.louvain(adata_neighbors, partition_type=louvain.RBERVertexPartition)
     sc.tl.louvain(adata_neighbors, partition_type=louvain.SurpriseVertexPartition)
+
+
+def test_louvain_resolutions():
+    adata = sc.datasets.pbmc68k_reduced()
+    resolutions = [0.5, 1]
+    sc.tl.louvain(adata, resolutions=resolutions)
+    assert list(adata.uns['louvain']['keys']) == ['louvain_0.5', 'louvain_1']
+    assert len(adata.uns['louvain']['n_clusters']) == 2
+    # each resolution is clustered as by a single call
+    sc.tl.louvain(adata, resolution=1, key_added='single')
+    assert (adata.obs['louvain_1'] == adata.obs['single']).all()
+    sc.tl.louvain(adata, resolutions=resolutions, n_jobs=2, key_added='pool')
+    assert (adata.obs['pool_0.5'] == adata.obs['louvain_0.5']).all()
+    # warm starts merge the clusters of higher resolutions
+    resolutions = [2, 0.5, 1]
+    sc.tl.louvain(adata, resolutions=resolutions, warm_start=True, key_added='warm')
+    n_clusters = adata.uns['louvain']['n_clusters']
+    assert list(n_clusters) == [
+        adata.obs['warm_{:g}'.format(r)].nunique() for r in resolutions]
+    assert np.all(np.diff(n_clusters[np.argsort(resolutions)]) >= 0)
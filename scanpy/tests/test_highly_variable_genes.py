@@ -31,3 +31,58 @@ def test_higly_variable_genes_compare_to_seurat():
                                pbmc.var['dispersions_norm'],
                                rtol=2e-05,
                                atol=2e-05)
+
+
+def test_highly_variable_genes_batch_key():
+    pbmc = sc.datasets.pbmc68k_reduced()
+    pbmc.X = pbmc.raw.X
+    pbmc.var_names_make_unique()
+    sc.pp.normalize_per_cell(pbmc, counts_per_cell_after=1e4)
+    sc.pp.log1p(pbmc)
+    pbmc.obs['batch'] = pd.Categorical(
+        np.random.RandomState(0).choice(['a', 'b'], pbmc.n_obs))
+    sc.pp.highly_variable_genes(pbmc, batch_key='batch', n_top_genes=200)
+    assert pbmc.var['highly_variable'].sum() == 200
+    assert pbmc.varm['highly_variable_per_batch'].shape == (pbmc.n_vars, 2)
+    # per-batch statistics equal those of the subsets
+    for b, batch in enumerate(['a', 'b']):
+        adata = pbmc[pbmc.obs['batch'] == batch].copy()
+        sc.pp.highly_variable_genes(adata, n_top_genes=200)
+        assert np.array_equal(pbmc.varm['highly_variable_per_batch'][:, b],
+                              adata.var['highly_variable'])
+        np.testing.assert_allclose(pbmc.varm['means_per_batch'][:, b],
+                                   adata.var['means'], rtol=1e-5)
+    nbatches = pbmc.var['highly_variable_nbatches']
+    assert nbatches[pbmc.var['highly_variable']].min() >= nbatches[~pbmc.var['highly_variable']].max()
+    assert np.array_equal(pbmc.var['highly_variable_intersection'], nbatches == 2)
+
+
+def test_highly_variable_genes_seurat_v3(tmpdir):
+    from scipy import sparse
+    from statsmodels.nonparametric.smoothers_lowess import lowess
+    rng = np.random.RandomState(0)
+    # genes with log-uniform means, the first 20 are strongly overdispersed
+    means = 10 ** rng.uniform(-1, 1, 300)
+    size = np.where(np.arange(300) < 20, .1, 10)
+    X = rng.negative_binomial(size, size / (size + means), (500, 300))
+    X = X.astype(np.float32)
+    adata = sc.AnnData(sparse.csr_matrix(X))
+    sc.pp.highly_variable_genes(adata, flavor='seurat_v3', n_top_genes=50)
+    assert adata.var['highly_variable'].sum() == 50
+    assert adata.var['highly_variable'][:20].all()
+    # dense reference
+    mean, var = X.mean(axis=0), X.var(axis=0, ddof=1)
+    log_mean = np.log10(mean)
+    fitted = lowess(np.log10(var), log_mean, frac=.3,
+                    delta=.01 * np.ptp(log_mean), return_sorted=False)
+    Z = np.minimum((X - mean) / np.sqrt(10 ** fitted), np.sqrt(X.shape[0]))
+    np.testing.assert_allclose(adata.var['variances_norm'],
+                               (Z ** 2).sum(axis=0) / (X.shape[0] - 1), rtol=1e-4)
+    # streaming over a backed file
+    filename = str(tmpdir.join('counts.h5ad'))
+    adata.write(filename)
+    adata_backed = sc.read(filename, backed='r')
+    sc.pp.highly_variable_genes(adata_backed, flavor='seurat_v3', n_top_genes=50)
+    np.testing.assert_allclose(adata_backed.var['variances_norm'],
+                               adata.var['variances_norm'])
+    adata_backed.file.close()
@@ -120,3 +120,27 @@ def test_metrics_argument():
     no_knn_manhattan.compute_neighbors(method="gauss", knn=False,
         n_neighbors=n_neighbors, metric="manhattan")
     assert not np.allclose(no_knn_euclidean.distances, no_knn_manhattan.distances)
+
+
+def test_igraph_from_connectivities(neigh):
+    from scanpy import utils
+    neigh.compute_neighbors(method='umap', n_neighbors=n_neighbors)
+    # one edge per pair of neighbors in the undirected graph
+    g = neigh.to_igraph()
+    assert g.ecount() == 5
+    assert np.allclose(utils.get_sparse_from_igraph(g, 'weight').toarray(),
+                       connectivities_umap)
+    g = utils.get_igraph_from_adjacency(neigh.connectivities, directed=True)
+    assert g.ecount() == 10
+    # the graph of the same matrix is reused
+    g = utils.get_igraph_from_adjacency(neigh.connectivities, use_cache=True)
+    assert utils.get_igraph_from_adjacency(
+        neigh.connectivities, use_cache=True) is g
+    assert utils.get_igraph_from_adjacency(
+        neigh.connectivities.copy(), use_cache=True) is not g
+    # unless it was modified in place
+    g = utils.get_igraph_from_adjacency(neigh.connectivities, use_cache=True)
+    neigh.connectivities.data[:] = 1
+    g_modified = utils.get_igraph_from_adjacency(neigh.connectivities, use_cache=True)
+    assert g_modified is not g
+    assert np.allclose(g_modified.es['weight'], 1)
@@ -43,6 +43,40 @@ def test_normalize_per_cell():
         axis=1).A1.tolist()
 
 
+def test_pooled_size_factors():
+    rng = np.random.RandomState(0)
+    size_factors = rng.lognormal(0, .5, 500)
+    groups = rng.randint(0, 2, 500)
+    # the second group strongly expresses the first 50 genes
+    means = np.tile(rng.gamma(.5, 2, 400), (2, 1))
+    means[1, :50] *= 10
+    X = rng.poisson(size_factors[:, None] * means[groups])
+    adata = AnnData(sp.csr_matrix(X, dtype=np.float32))
+    adata.obs['group'] = groups.astype(str)
+    sc.pp.pooled_size_factors(adata)
+    assert np.isclose(adata.obs['size_factors'].mean(), 1)
+    assert np.corrcoef(adata.obs['size_factors'], size_factors)[0, 1] > .95
+    sc.pp.pooled_size_factors(adata, groupby='group', sizes=(21, 41))
+    ratios = adata.obs['size_factors'] / size_factors
+    assert np.isclose(np.median(ratios[groups == 0]),
+                      np.median(ratios[groups == 1]), rtol=.1)
+
+
+def test_magic_neighbors():
+    rng = np.random.RandomState(0)
+    adata = AnnData(sp.csr_matrix(rng.poisson(1, (300, 40)), dtype=np.float32))
+    sc.pp.pca(adata, n_comps=10)
+    sc.pp.neighbors(adata, n_neighbors=10)
+    adata_genes = sc.pp.magic(
+        adata, name_list=['0', '5'], t=2, method='neighbors')
+    adata_all = sc.pp.magic(adata, t=2, method='neighbors', copy=True)
+    assert np.allclose(adata_all.X[:, [0, 5]], adata_genes.X, rtol=1e-5)
+    # diffusion smoothes the data
+    assert np.all(adata_all.X.var(axis=0) < adata.X.toarray().var(axis=0))
+    sc.pp.magic(adata, name_list='pca_only', n_pca=10, method='neighbors')
+    assert adata.obsm['X_magic'].shape == (300, 10)
+
+
 def test_subsample():
     adata = AnnData(np.ones((200, 10)))
     sc.pp.subsample(adata, n_obs=40)
@@ -51,6 +85,20 @@ def test_subsample():
     assert adata.n_obs == 4
 
 
+def test_subsample_geometric():
+    rng = np.random.RandomState(0)
+    # a large and a rare population
+    X = np.vstack([rng.randn(10000, 5), rng.randn(50, 5) * .5 + 20])
+    X_sub, indices = sc.pp.subsample(X, n_obs=300, method='geometric')
+    assert len(np.unique(indices)) == 300
+    assert np.array_equal(X_sub, X[indices])
+    assert np.sum(indices >= 10000) >= 10
+    adata = AnnData(X)
+    adata.obsm['X_pca'] = X
+    sc.pp.subsample(adata, n_obs=300, method='geometric', use_rep='X_pca')
+    assert adata.n_obs == 300
+
+
 def test_recipe_plotting():
     sc.settings.autoshow = False
     adata = AnnData(np.random.randint(0, 1000, (1000, 1000)))
@@ -109,3 +157,125 @@ def test_downsample_counts():
                     == new_totals[initial_totals <= TARGET])
         if not replace:
             assert np.all(X >= adata.X)
+
+
+def test_downsample_total_counts():
+    X = np.random.randint(0, 100, (1000, 100)) * \
+        np.random.binomial(1, .3, (1000, 100))
+    total = X.sum() // 3
+    for fmt, replace in product((np.asarray, sp.csr_matrix, sp.csc_matrix), (True, False)):
+        adata = AnnData(X=fmt(X))
+        adata = sc.pp.downsample_counts(adata, total_counts=total, replace=replace, copy=True)
+        result = adata.X.toarray() if sp.issparse(adata.X) else adata.X
+        assert result.sum() == total
+        assert all(result[X == 0] == 0)
+        if not replace:
+            assert np.all(X >= result)
+        again = sc.pp.downsample_counts(AnnData(X=fmt(X)), total_counts=total,
+                                        replace=replace, copy=True)
+        again = again.X.toarray() if sp.issparse(again.X) else again.X
+        assert np.array_equal(result, again)
+    # most cells are downsampled little, so a binomial split would exceed them
+    total = X.sum() * 99 // 100
+    for replace in (True, False):
+        adata = sc.pp.downsample_counts(AnnData(X=X.copy()), total_counts=total,
+                                        replace=replace, copy=True)
+        assert adata.X.sum() == total
+
+
+def test_plan_matches_eager(tmpdir):
+    np.random.seed(0)
+    X = np.random.negative_binomial(1, .5, (300, 50)) * \
+        np.random.binomial(1, .3, (300, 50))
+    for fmt in (np.asarray, sp.csr_matrix):
+        adata = AnnData(fmt(X.astype(np.float32)))
+        infile = str(tmpdir.join('in.h5ad'))
+        outfile = str(tmpdir.join('out.h5ad'))
+        adata.write(infile)
+        plan = (sc.pp.Plan()
+                .filter_cells(min_genes=5)
+                .filter_genes(min_cells=10)
+                .normalize_per_cell(counts_per_cell_after=1e4)
+                .log1p()
+                .highly_variable_genes(n_top_genes=20)
+                .scale(max_value=3))
+        assert plan.n_passes == 3
+        plan.execute(infile, outfile, chunk_size=64)
+        result = sc.read_h5ad(outfile)
+        sc.pp.filter_cells(adata, min_genes=5)
+        sc.pp.filter_genes(adata, min_cells=10)
+        sc.pp.normalize_per_cell(adata, counts_per_cell_after=1e4)
+        sc.pp.log1p(adata)
+        sc.pp.highly_variable_genes(adata, n_top_genes=20)
+        sc.pp.scale(adata, max_value=3)
+        assert result.shape == adata.shape
+        assert np.allclose(result.X, adata.X, atol=1e-5)
+        assert np.array_equal(result.obs['n_genes'], adata.obs['n_genes'])
+        assert np.array_equal(result.var['highly_variable'], adata.var['highly_variable'])
+
+
+def test_filter_cells_and_genes(tmpdir):
+    np.random.seed(0)
+    X = np.random.negative_binomial(1, .5, (200, 40)) * \
+        np.random.binomial(1, .3, (200, 40))
+    for fmt in (np.asarray, sp.csr_matrix, sp.csc_matrix):
+        adata = AnnData(fmt(X.astype(np.float32)))
+        expected = adata.copy()
+        sc.pp.filter_cells(expected, min_genes=8)
+        sc.pp.filter_cells(expected, max_counts=40)
+        sc.pp.filter_genes(expected, min_cells=25)
+        sc.pp.filter_cells_and_genes(
+            adata, min_genes=8, max_counts_per_cell=40, min_cells=25)
+        assert np.array_equal(adata.obs_names, expected.obs_names)
+        assert np.array_equal(adata.var_names, expected.var_names)
+        assert np.array_equal(adata.obs['n_genes'], expected.obs['n_genes'])
+        assert np.array_equal(adata.var['n_cells'], expected.var['n_cells'])
+        assert np.allclose(sp.csr_matrix(adata.X).toarray(), sp.csr_matrix(expected.X).toarray())
+
+        filename = str(tmpdir.join('backed.h5ad'))
+        AnnData(fmt(X.astype(np.float32))).write(filename)
+        backed = sc.read_h5ad(filename, backed='r')
+        sc.pp.filter_cells_and_genes(
+            backed, min_genes=8, max_counts_per_cell=40, min_cells=25,
+            chunk_size=64)
+        assert not backed.isbacked
+        assert np.array_equal(backed.var_names, expected.var_names)
+        assert np.allclose(sp.csr_matrix(backed.X).toarray(), sp.csr_matrix(expected.X).toarray())
+
+
+def test_mean_var_groups():
+    from scanpy.preprocessing._utils import _get_mean_var, _get_mean_var_groups
+    X = sp.random(3000, 50, density=.2, format='csr', random_state=0)
+    dense = X.toarray()
+    codes = np.random.RandomState(0).randint(-1, 3, X.shape[0])
+    for fmt in (sp.csr_matrix, sp.csc_matrix, np.asarray):
+        means, vars, ns = _get_mean_var_groups(fmt(dense), codes, 3)
+        for g in range(3):
+            assert ns[g] == np.sum(codes == g)
+            assert np.allclose(means[g], dense[codes == g].mean(axis=0))
+            assert np.allclose(vars[g], dense[codes == g].var(axis=0, ddof=1))
+        mean, var = _get_mean_var(fmt(dense), mask=codes >= 0)
+        assert np.allclose(var, dense[codes >= 0].var(axis=0, ddof=1))
+        mean, var = _get_mean_var(fmt(dense), expm1=True)
+        assert np.allclose(mean, np.expm1(dense).mean(axis=0))
+        assert np.allclose(var, np.expm1(dense).var(axis=0, ddof=1))
+
+
+def test_max_memory():
+    import pytest
+    X = sp.random(1000, 100, density=.1, format='csr', dtype=np.float32, random_state=0)
+    max_memory = sc.settings.max_memory
+    sc.settings.max_memory = 100 * 1024 / 1024 ** 3  # 100 kB
+    try:
+        with pytest.raises(MemoryError):
+            sc.pp.scale(AnnData(X.copy()))
+        adata = AnnData(X.copy())
+        sc.pp.pca(adata, n_comps=5)
+        expected = AnnData(X.copy())
+        sc.pp.pca(expected, n_comps=5, chunked=True)
+        assert np.allclose(adata.obsm['X_pca'], expected.obsm['X_pca'])
+        adata = AnnData(X.toarray())
+        sc.pp.log1p(adata, chunked=True)
+        assert np.allclose(adata.X, np.log1p(X.toarray()))
+    finally:
+        sc.settings.max_memory = max_memory
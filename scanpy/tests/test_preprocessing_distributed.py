@@ -84,3 +84,56 @@ class TestPreprocessingDistributed:
         adata_log1p = ad.read_zarr(temp_store)
         log1p(adata)
         npt.assert_allclose(adata_log1p.X, adata.X)
+
+
+@pytest.mark.skipif(not all((find_spec('dask'), find_spec('zarr'))), reason='Dask and Zarr required')
+class TestPreprocessingDask:
+    @pytest.fixture()
+    def adatas(self):
+        import dask.array as da
+
+        a = ad.read_zarr(input_file)
+        a.X = a.X[:]
+        a = a[:, (a.X > 0).sum(axis=0) >= 10].copy()  # avoid constant genes
+        a_dist = a.copy()
+        a_dist.X = da.from_array(a.X.copy(), chunks=(2000, a.n_vars))
+        log1p(a)
+        log1p(a_dist)
+        return a, a_dist
+
+    def test_highly_variable_genes(self, adatas):
+        adata, adata_dist = adatas
+        highly_variable_genes(adata_dist)
+        highly_variable_genes(adata)
+        npt.assert_array_equal(adata_dist.var['highly_variable'], adata.var['highly_variable'])
+
+    def test_scale(self, adatas):
+        adata, adata_dist = adatas
+        scale(adata_dist, max_value=10)
+        result = materialize_as_ndarray(adata_dist.X)
+        scale(adata, max_value=10)
+        npt.assert_allclose(result, adata.X, rtol=1e-4, atol=1e-4)
+
+    def test_pca(self, adatas):
+        adata, adata_dist = adatas
+        pca(adata_dist, n_comps=10)
+        pca(adata, n_comps=10, svd_solver='full')
+        npt.assert_allclose(adata_dist.uns['pca']['variance_ratio'],
+                            adata.uns['pca']['variance_ratio'], rtol=1e-4)
+        npt.assert_allclose(adata_dist.obsm['X_pca'], adata.obsm['X_pca'],
+                            rtol=1e-3, atol=1e-3)
+
+    def test_neighbors(self):
+        import dask.array as da
+        import numpy as np
+
+        X = np.random.RandomState(0).randn(1000, 10).astype(np.float32)
+        adata = ad.AnnData(X)
+        adata.obsm['X_rep'] = X
+        adata_dist = ad.AnnData(X.copy())
+        adata_dist.obsm['X_rep'] = da.from_array(X, chunks=(300, 10))
+        neighbors(adata, use_rep='X_rep', n_neighbors=10)
+        neighbors(adata_dist, use_rep='X_rep', n_neighbors=10)
+        for key in ('distances', 'connectivities'):
+            diff = adata_dist.uns['neighbors'][key] - adata.uns['neighbors'][key]
+            assert abs(diff).max() < 1e-6
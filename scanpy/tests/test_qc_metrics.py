@@ -115,3 +115,63 @@ def test_qc_metrics_format():
         assert np.allclose(adata.obs, adata_dense.obs)
         for col in adata.var: # np.allclose doesn't like mix of types
             assert np.allclose(adata.var[col], adata_dense.var[col])
+
+
+def test_qc_metrics_reference():
+    a = np.random.binomial(100, .005, (500, 300))
+    mito = np.arange(300) < 30
+    adata = sc.AnnData(X=sparse.csr_matrix(a), var=pd.DataFrame({"mito": mito}))
+    # unsorted ranks
+    obs, var = sc.pp.calculate_qc_metrics(
+        adata, feature_controls=["mito"], percent_top=(20, 5))
+    totals = a.sum(axis=1)
+    assert np.array_equal(obs["total_counts"], totals)
+    assert np.array_equal(obs["total_features_by_counts"], (a != 0).sum(axis=1))
+    assert np.allclose(obs["total_counts_mito"], a[:, mito].sum(axis=1))
+    top = -np.sort(-a, axis=1)
+    assert np.allclose(obs["pct_counts_in_top_5_features"],
+                       top[:, :5].sum(axis=1) / totals * 100)
+    assert np.allclose(obs["pct_counts_in_top_20_features"],
+                       top[:, :20].sum(axis=1) / totals * 100)
+    assert np.allclose(var["total_counts"], a.sum(axis=0))
+    assert np.array_equal(var["n_cells_by_counts"], (a != 0).sum(axis=0))
+
+
+def test_qc_metrics_chunked(tmpdir):
+    a = np.random.binomial(100, .005, (1000, 200)).astype(np.float32)
+    init_var = pd.DataFrame({"mito": np.arange(200) < 20})
+    adata = sc.AnnData(X=sparse.csr_matrix(a), var=init_var.copy())
+    obs, var = sc.pp.calculate_qc_metrics(adata, feature_controls=["mito"])
+    obs_chunked, var_chunked = sc.pp.calculate_qc_metrics(
+        adata, feature_controls=["mito"], chunked=True, chunk_size=300)
+    assert np.allclose(obs_chunked, obs)
+    assert np.allclose(var_chunked, var)
+    for X in [a, sparse.csr_matrix(a)]:
+        filename = str(tmpdir.join("{}.h5ad".format(type(X).__name__)))
+        sc.AnnData(X=X, var=init_var.copy()).write(filename)
+        adata_backed = sc.read(filename, backed="r")
+        sc.pp.calculate_qc_metrics(
+            adata_backed, feature_controls=["mito"], chunk_size=300,
+            inplace=True)
+        assert np.allclose(adata_backed.obs[obs.columns], obs)
+        adata_backed.file.close()
+
+
+def test_qc_metrics_groupby():
+    a = np.random.binomial(100, .005, (600, 50))
+    adata = sc.AnnData(X=sparse.csr_matrix(a))
+    adata.obs["sample"] = pd.Categorical(np.random.choice(["a", "b", "c"], 600))
+    obs, var, grouped = sc.pp.calculate_qc_metrics(adata, groupby="sample")
+    assert grouped.shape == (150, 6)
+    assert np.allclose(obs, sc.pp.calculate_qc_metrics(adata)[0])
+    for sample in "abc":
+        _, var_sample = sc.pp.calculate_qc_metrics(
+            adata[adata.obs["sample"] == sample])
+        group = grouped[grouped["sample"] == sample]
+        assert np.array_equal(group["var_names"], adata.var_names)
+        for col in ["total_counts", "mean_counts", "n_cells_by_counts",
+                    "pct_dropout_by_counts"]:
+            assert np.allclose(group[col], var_sample[col])
+    assert np.allclose(
+        grouped.groupby("var_names")["total_counts"].sum()[adata.var_names],
+        var["total_counts"])
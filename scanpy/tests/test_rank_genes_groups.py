@@ -86,3 +86,105 @@ def test_results_sparse():
     for name in true_scores_t_test.dtype.names:
         assert np.allclose(true_scores_wilcoxon[name][:7], adata.uns['rank_genes_groups']['scores'][name][:7])
     assert np.array_equal(true_names_wilcoxon[:7], adata.uns['rank_genes_groups']['names'][:7])
+
+
+def test_mean_var_rest():
+    from scanpy.tools.rank_genes_groups import _get_mean_var_rest
+    seed(1234)
+    X = negative_binomial(2, 0.25, (300, 20)).astype(float)
+    # -1 marks observations in none of the groups
+    codes = np.random.randint(-1, 4, 300)
+    means, vars, means_rest, vars_rest, ns_rest = _get_mean_var_rest(
+        sp.csr_matrix(X), codes, 4)
+    for g in range(4):
+        rest = X[codes != g]
+        assert ns_rest[g] == rest.shape[0]
+        assert np.allclose(means[g], X[codes == g].mean(axis=0))
+        assert np.allclose(means_rest[g], rest.mean(axis=0))
+        assert np.allclose(vars_rest[g], rest.var(axis=0, ddof=1))
+
+
+def test_wilcoxon_tie_correct():
+    from scipy.stats import rankdata
+    seed(1234)
+    adata = get_example_data(sparse=True)
+    X = adata.X.toarray()
+    rank_genes_groups(adata, 'true_groups', n_genes=20, method='wilcoxon',
+                      tie_correct=True)
+    ranks = np.apply_along_axis(rankdata, 0, X)
+    n_total, n_active = X.shape[0], 10
+    ties = np.array([np.sum(np.unique(x, return_counts=True)[1] ** 3.
+                            - np.unique(x, return_counts=True)[1]) for x in X.T])
+    var = n_active * (n_total - n_active) * (n_total + 1) / 12 \
+        * (1 - ties / (n_total ** 3 - n_total))
+    scores = (ranks[:n_active].sum(axis=0) - n_active * (n_total + 1) / 2) / np.sqrt(var)
+    result = adata.uns['rank_genes_groups']
+    indices = adata.var_names.get_indexer(result['names']['0'])
+    assert np.allclose(result['scores']['0'], scores[indices])
+
+
+def test_pvals_adj_n_jobs():
+    from statsmodels.stats.multitest import multipletests
+    from scanpy import settings
+    from scanpy.tools.rank_genes_groups import _benjamini_hochberg
+    seed(1234)
+    pvals = np.random.uniform(size=(5, 50)) ** 3
+    pvals[:, :5] = pvals[:, [0]]  # ties
+    pvals_adj = _benjamini_hochberg(pvals)
+    for p, p_adj in zip(pvals, pvals_adj):
+        assert np.allclose(p_adj, multipletests(p, method='fdr_bh')[1])
+    # results do not depend on the number of threads across groups
+    adata = get_example_data(sparse=True)
+    rank_genes_groups(adata, 'true_groups', method='t-test')
+    result = adata.uns['rank_genes_groups']
+    n_jobs = settings.n_jobs
+    settings.n_jobs = 2
+    try:
+        rank_genes_groups(adata, 'true_groups', method='t-test', key_added='n_jobs')
+    finally:
+        settings.n_jobs = n_jobs
+    for key in ['names', 'scores', 'pvals', 'pvals_adj']:
+        assert np.array_equal(result[key], adata.uns['n_jobs'][key])
+
+
+def test_compact_storage():
+    from scanpy.tools.rank_genes_groups import _ranked_groups, _ranked_field
+    seed(1234)
+    adata = get_example_data(sparse=True)
+    rank_genes_groups(adata, 'true_groups', n_genes=20, method='wilcoxon')
+    rank_genes_groups(adata, 'true_groups', n_genes=20, method='wilcoxon',
+                      storage='compact', key_added='compact')
+    result, compact = adata.uns['rank_genes_groups'], adata.uns['compact']
+    assert compact['indices'].dtype == np.int32
+    assert compact['scores'].shape == (20, 2)
+    assert _ranked_groups(compact) == result['names'].dtype.names
+    for group in result['names'].dtype.names:
+        assert np.array_equal(
+            _ranked_field(adata, 'compact', 'names', group), result['names'][group])
+        for field in ['scores', 'logfoldchanges', 'pvals', 'pvals_adj']:
+            assert np.allclose(_ranked_field(adata, 'compact', field, group),
+                               result[field][group], rtol=1e-6)
+
+
+def test_backed_gene_blocks(tmpdir):
+    from anndata import read_h5ad
+    from scanpy import settings
+    seed(1234)
+    for fmt in [sp.csr_matrix, sp.csc_matrix, lambda X: X.toarray()]:
+        adata = get_example_data(sparse=True)
+        adata.X = fmt(adata.X)
+        filename = str(tmpdir.join('backed.h5ad'))
+        adata.write(filename)
+        rank_genes_groups(adata, 'true_groups', n_genes=20, method='t-test')
+        backed = read_h5ad(filename, backed='r')
+        max_memory = settings.max_memory
+        # blocks of a few genes
+        settings.max_memory = 1e-5
+        try:
+            rank_genes_groups(backed, 'true_groups', n_genes=20, method='t-test')
+        finally:
+            settings.max_memory = max_memory
+        result, result_backed = adata.uns['rank_genes_groups'], backed.uns['rank_genes_groups']
+        for key in ['names', 'scores', 'pvals_adj']:
+            assert np.array_equal(result[key], result_backed[key])
+        backed.file.close()
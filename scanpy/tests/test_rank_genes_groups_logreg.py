@@ -21,3 +21,22 @@ def test_rank_genes_groups_with_renamed_categories():
 
         sc.tl.rank_genes_groups(adata, 'louvain', method=method)
         assert adata.uns['rank_genes_groups']['names'][0].tolist() == ('3', '1', '0')
+
+
+def test_rank_genes_groups_logreg_subsample_warm_start():
+    from scanpy.tools.rank_genes_groups import _subsample_groups
+    codes = np.repeat([-1, 0, 1, 2], [10, 100, 30, 60])
+    indices = _subsample_groups(codes, 3, 50, 0)
+    assert np.bincount(codes[indices]).tolist() == [50, 30, 50]
+
+    adata = sc.datasets.blobs(n_variables=10, n_centers=3, n_observations=300)
+    kwds = dict(method='logreg', solver='saga', multi_class='multinomial',
+                max_cells_per_group=80, warm_start=True, max_iter=1000)
+    sc.tl.rank_genes_groups(adata, 'blobs', **kwds)
+    fit = adata.uns['rank_genes_groups']['logreg']
+    assert fit['coef'].shape == (3, 10)
+    names = adata.uns['rank_genes_groups']['names']
+    sc.tl.rank_genes_groups(adata, 'blobs', **kwds)
+    assert np.allclose(adata.uns['rank_genes_groups']['logreg']['coef'],
+                       fit['coef'], atol=1e-2)
+    assert np.array_equal(adata.uns['rank_genes_groups']['names'][0], names[0])
@@ -12,3 +12,19 @@ def test_add_score():
     some_genes = np.concatenate([np.unique(gene_names[np.random.randint(0, 1000, 10)]), np.unique(gene_names[np.random.randint(1000, 2000, 3)])])
     sc.tl.score_genes(adata, some_genes, score_name='Test')
     assert adata.obs['Test'].dtype == 'float32'
+
+
+def test_score_genes_multi():
+    from scipy import sparse
+    np.random.seed(0)
+    adata = AnnData(sparse.random(200, 300, density=0.2, format='csr', dtype=np.float32) * 10)
+    gene_lists = {
+        'score_{}'.format(i): list(adata.var_names[np.random.choice(300, 10, replace=False)])
+        for i in range(3)}
+    reference = adata.copy()
+    for score_name, gene_list in gene_lists.items():
+        sc.tl.score_genes(reference, gene_list, score_name=score_name, random_state=1)
+    sc.tl.score_genes_multi(adata, gene_lists, random_state=1)
+    for score_name in gene_lists:
+        assert adata.obs[score_name].dtype == 'float32'
+        assert np.allclose(adata.obs[score_name], reference.obs[score_name], atol=1e-5)
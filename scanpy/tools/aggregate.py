@@ -0,0 +1,146 @@
+"""Aggregate the expression of groups of observations.
+"""
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import issparse, csr_matrix, hstack
+from anndata import AnnData
+
+from .. import settings
+from .. import logging as logg
+from ..preprocessing._chunked import (
+    iter_row_chunks, row_nbytes, chunk_size_from_budget)
+
+
+_AVAIL_FUNCS = ('sum', 'mean', 'count_nonzero', 'var')
+
+
+def aggregate(adata, by, funcs=('sum', 'mean'), use_raw=False):
+    """Aggregate the expression of groups of observations, e.g., to pseudobulks.
+
+    The groups are the combinations of categories of the keys `by`. All
+    statistics are computed with a single product of a sparse indicator
+    matrix of the groups with the data, without densifying sparse data. The
+    data is aggregated in chunks of observations that fit into
+    `settings.max_memory`.
+
+    Parameters
+    ----------
+    adata : :class:`~anndata.AnnData`
+        Annotated data matrix.
+    by : `str` or `list` of `str`
+        Keys of categorical annotations in `.obs` to group by. Observations
+        with a missing value in any of them are not aggregated.
+    funcs : `str` or `list` of `str`, optional (default: `('sum', 'mean')`)
+        Statistics per group and variable, any of `'sum'`, `'mean'`,
+        `'count_nonzero'` and `'var'`. The variance is unbiased (R
+        convention).
+    use_raw : `bool`, optional (default: `False`)
+        Aggregate the `raw` attribute of `adata`.
+
+    Returns
+    -------
+    :class:`~anndata.AnnData`
+        Groups × variables. Each statistic is stored in `.layers`, `.X` is
+        the first one of `funcs`. `.obs` holds the categories of `by` and the
+        number of observations of each group, `'n_cells'`; `.var` is copied.
+
+    Examples
+    --------
+    Pseudobulk counts of each cell type in each sample:
+
+    >>> pseudobulk = sc.tl.aggregate(adata, ['sample', 'cell_type'], funcs='sum')
+    """
+    by = [by] if isinstance(by, str) else list(by)
+    funcs = [funcs] if isinstance(funcs, str) else list(funcs)
+    for func in funcs:
+        if func not in _AVAIL_FUNCS:
+            raise ValueError('`funcs` must be among {}, not {!r}.'
+                             .format(_AVAIL_FUNCS, func))
+    logg.info('aggregating by {}'.format(by), r=True)
+    if use_raw and adata.raw is None:
+        raise ValueError('`use_raw=True`, but `adata.raw` is None.')
+    X = adata.raw.X if use_raw else adata.X
+    var = (adata.raw.var if use_raw else adata.var).copy()
+
+    codes, obs = _group_codes(adata.obs, by)
+    n_groups = len(obs)
+    cells = np.flatnonzero(codes >= 0)
+    indicator = csr_matrix(
+        (np.ones(len(cells)), (codes[cells], cells)), shape=(n_groups, X.shape[0]))
+    # blocks of columns of the data whose sums are needed
+    stats = ['sum']
+    if 'var' in funcs:
+        stats.append('sum_sq')
+    if 'count_nonzero' in funcs:
+        stats.append('count_nonzero')
+    # the stacked blocks of a chunk are float64 copies, bound their size
+    chunk_size = chunk_size_from_budget(row_nbytes(X), n_copies=len(stats) + 1)
+    n_vars = X.shape[1]
+    sums = np.zeros((n_groups, len(stats) * n_vars))
+    for chunk, start, end in iter_row_chunks(X, chunk_size):
+        # one product of the indicator with all blocks
+        product = indicator[:, start:end] @ _stack_stats(chunk, stats)
+        sums += product.toarray() if issparse(product) else product
+    sums = dict(zip(stats, np.split(sums, len(stats), axis=1)))
+
+    n_cells = obs['n_cells'].values[:, None]
+    results = {}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = sums['sum'] / n_cells
+        for func in funcs:
+            if func == 'sum':
+                results[func] = sums['sum']
+            elif func == 'mean':
+                results[func] = mean
+            elif func == 'count_nonzero':
+                results[func] = sums['count_nonzero']
+            elif func == 'var':
+                results[func] = (sums['sum_sq'] - n_cells * mean ** 2) / (n_cells - 1)
+    adata_agg = AnnData(results[funcs[0]], obs=obs, var=var, dtype=np.float64)
+    for func in funcs:
+        adata_agg.layers[func] = results[func]
+    logg.info('    finished', time=True,
+              end=' ' if settings.verbosity > 2 else '\n')
+    logg.hint('returned AnnData of {} groups × {} variables with layers {}'
+              .format(n_groups, n_vars, funcs))
+    return adata_agg
+
+
+def _group_codes(obs, by):
+    """Group of each observation and annotation of the observed groups."""
+    categoricals = [pd.Categorical(obs[key]) for key in by]
+    codes = np.column_stack([c.codes for c in categoricals]).astype(np.int64)
+    valid = np.all(codes >= 0, axis=1)
+    groups, inverse = np.unique(codes[valid], axis=0, return_inverse=True)
+    group_codes = np.full(len(obs), -1, dtype=np.int64)
+    group_codes[valid] = inverse
+    group_obs = pd.DataFrame(index=[
+        '_'.join(str(c.categories[code]) for c, code in zip(categoricals, group))
+        for group in groups])
+    for key, c, key_codes in zip(by, categoricals, groups.T):
+        group_obs[key] = pd.Categorical.from_codes(key_codes, c.categories)
+    group_obs['n_cells'] = np.bincount(inverse, minlength=len(groups))
+    return group_codes, group_obs
+
+
+def _stack_stats(X, stats):
+    """Horizontally stack the transformations of `X` that are summed per group."""
+    # accumulate in double precision
+    X = X.astype(np.float64, copy=False) if issparse(X) else np.asarray(X, dtype=np.float64)
+    blocks = []
+    for stat in stats:
+        if stat == 'sum':
+            blocks.append(X)
+        elif stat == 'sum_sq':
+            blocks.append(X.multiply(X) if issparse(X) else np.square(X))
+        elif stat == 'count_nonzero':
+            if issparse(X):
+                nonzero = csr_matrix(X, copy=True)
+                nonzero.data = (nonzero.data != 0).astype(nonzero.dtype)
+            else:
+                nonzero = (X != 0).astype(X.dtype)
+            blocks.append(nonzero)
+    if issparse(X):
+        return hstack(blocks, format='csr')
+    return np.hstack(blocks)
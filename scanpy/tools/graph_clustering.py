@@ -1,9 +1,10 @@
+import importlib
+
 import numpy as np
-import pandas as pd
-from natsort import natsorted
 from .. import utils
 from .. import settings
 from .. import logging as logg
+from .louvain import _find_partition, _labels, _cluster_resolutions, _add_resolutions
 
 
 def graph_clustering(
@@ -18,6 +19,9 @@ def graph_clustering(
         use_weights=False,
         partition_type=None,
         partition_kwargs=None,
+        resolutions=None,
+        warm_start=False,
+        n_jobs=None,
         copy=False):
     """Cluster cells into subgroups [Blondel08]_ [Levine15]_ [Traag17]_.
     Cluster cells using the Louvain algorithm [Blondel08]_ in the implementation
@@ -53,6 +57,19 @@ def graph_clustering(
     partition_kwargs : `dict`, optional (default: `None`)
         Key word arguments to pass to partitioning, if `vtraag` method is 
         being used.
+    resolutions : sequence of `float` or `None`, optional (default: `None`)
+        Cluster at each of these resolutions instead of a single one, with
+        `partition_type` defaulting to `RBConfigurationVertexPartition`. The
+        graph is constructed once and the labels are added as
+        `'{key_added}_{resolution}'`. Only for the flavors `'vtraag'` and
+        `'leiden'`.
+    warm_start : `bool`, optional (default: `False`)
+        If clustering at several `resolutions`, initialize each clustering
+        with the one of the next higher resolution. The resolutions are then
+        processed sequentially, starting with the highest one.
+    n_jobs : `int` or `None`, optional (default: `None`)
+        Number of processes for clustering at several `resolutions` without
+        `warm_start`. Defaults to `settings.n_jobs`.
     copy : `bool` (default: `False`)
         Copy adata or modify it inplace.
     Returns
@@ -62,7 +79,11 @@ def graph_clustering(
         louvain : :class:`pandas.Series` (``adata.obs``, dtype `category`)
             Array of dim (number of samples) that stores the subgroup id ('0',
             '1', ...) for each cell.
-    
+
+        If `resolutions` is given, one column of cluster labels per resolution
+        in ``adata.obs`` and the quality and number of clusters of each
+        clustering in ``adata.uns['clustering']``.
+
     AnnData
         When `copy=True` is set, a copy of ``adata`` with those fields is returned.
     """
@@ -70,12 +91,19 @@ def graph_clustering(
     if (flavor not in {'vtraag','leiden'}) and (partition_type is not None):
         raise ValueError(
             '`partition_type` is only a valid argument when `flavour` is "vtraag" or "leiden"')
+    if resolutions is not None:
+        if flavor not in {'vtraag', 'leiden'}:
+            raise ValueError(
+                '`resolutions` is only a valid argument when `flavor` is "vtraag" or "leiden"')
+        if resolution is not None:
+            raise ValueError('Pass either `resolution` or `resolutions`.')
     adata = adata.copy() if copy else adata
     if adjacency is None and 'neighbors' not in adata.uns:
         raise ValueError(
             'You need to run `pp.neighbors` first to compute a neighborhood graph.')
     if adjacency is None:
         adjacency = adata.uns['neighbors']['connectivities']
+    restrict_indices = None
     if restrict_to is not None:
         restrict_key, restrict_categories = restrict_to
         if not isinstance(restrict_categories[0], str):
@@ -89,17 +117,35 @@ def graph_clustering(
         restrict_indices = adata.obs[restrict_key].isin(restrict_categories).values
         adjacency = adjacency[restrict_indices, :]
         adjacency = adjacency[:, restrict_indices]
+    if key_added is None:
+        key_added = 'clustering' if restrict_to is None else restrict_key + '_R'
     if flavor in {'vtraag', 'igraph', 'leiden'}:
         if flavor == 'igraph' and resolution is not None:
             logg.warn('`resolution` parameter has no effect for flavor "igraph"')
         if directed and flavor == 'igraph':
             directed = False
         if not directed: logg.m('    using the undirected graph', v=4)
-        g = utils.get_igraph_from_adjacency(adjacency, directed=directed)
+        g = utils.get_igraph_from_adjacency(
+            adjacency, directed=directed, use_cache=True)
         if use_weights:
             weights = np.array(g.es["weight"]).astype(np.float64)
         else:
             weights = None
+        if resolutions is not None:
+            package_name = 'leidenalg' if flavor == 'leiden' else 'louvain'
+            if partition_type is None:
+                partition_type = importlib.import_module(
+                    package_name).RBConfigurationVertexPartition
+            partition_kwargs = {} if partition_kwargs is None else partition_kwargs
+            if use_weights:
+                partition_kwargs["weights"] = weights
+            memberships, qualities = _cluster_resolutions(
+                package_name, g, partition_type, partition_kwargs,
+                resolutions, random_state, warm_start, n_jobs)
+            return _add_resolutions(
+                adata, memberships, qualities, resolutions, 'clustering',
+                key_added, random_state, warm_start,
+                restrict_to, restrict_indices, copy)
         if flavor == 'leiden':
             import leidenalg
             if partition_kwargs is None:
@@ -128,9 +174,9 @@ def graph_clustering(
             if use_weights:
                 partition_kwargs["weights"] = weights
             logg.info('    using the "louvain" package of Traag (2017)')
-            louvain.set_rng_seed(random_state)
-            part = louvain.find_partition(g, partition_type,
-                **partition_kwargs)
+            part = _find_partition((
+                'louvain', g, partition_type, partition_kwargs, None,
+                random_state))
         elif flavor == 'igraph':
             part = g.community_multilevel(weights=weights)
         groups = np.array(part.membership)
@@ -144,23 +190,8 @@ def graph_clustering(
         for k, v in partition.items(): groups[k] = v
     else:
         raise ValueError('`flavor` needs to be "leiden" or "vtraag" or "igraph" or "taynaud".')
-    unique_groups = np.unique(groups)
-    n_clusters = len(unique_groups)
-    if restrict_to is None:
-        groups = groups.astype('U')
-        key_added = 'clustering' if key_added is None else key_added
-        adata.obs[key_added] = pd.Categorical(
-            values=groups,
-            categories=natsorted(unique_groups.astype('U')))
-    else:
-        key_added = restrict_key + '_R' if key_added is None else key_added
-        all_groups = adata.obs[restrict_key].astype('U')
-        prefix = '-'.join(restrict_categories) + ','
-        new_groups = [prefix + g for g in groups.astype('U')]
-        all_groups.iloc[restrict_indices] = new_groups
-        adata.obs[key_added] = pd.Categorical(
-            values=all_groups,
-            categories=natsorted(all_groups.unique()))
+    n_clusters = len(np.unique(groups))
+    adata.obs[key_added] = _labels(adata, groups, restrict_to, restrict_indices)
     adata.uns['clustering'] = {}
     adata.uns['clustering']['params'] = {'resolution': resolution, 'random_state': random_state}
     logg.info('    finished', time=True, end=' ' if settings.verbosity > 2 else '\n')
@@ -1,3 +1,5 @@
+import importlib
+
 import numpy as np
 import pandas as pd
 from natsort import natsorted
@@ -18,6 +20,9 @@ def louvain(
         use_weights=False,
         partition_type=None,
         partition_kwargs=None,
+        resolutions=None,
+        warm_start=False,
+        n_jobs=None,
         copy=False):
     """Cluster cells into subgroups [Blondel08]_ [Levine15]_ [Traag17]_.
 
@@ -56,6 +61,17 @@ def louvain(
     partition_kwargs : `dict`, optional (default: `None`)
         Key word arguments to pass to partitioning, if `vtraag` method is 
         being used.
+    resolutions : sequence of `float` or `None`, optional (default: `None`)
+        Cluster at each of these resolutions instead of a single one. The
+        graph is constructed once and the labels are added as
+        `'{key_added}_{resolution}'`. Only for the flavor `'vtraag'`.
+    warm_start : `bool`, optional (default: `False`)
+        If clustering at several `resolutions`, initialize each clustering
+        with the one of the next higher resolution. The resolutions are then
+        processed sequentially, starting with the highest one.
+    n_jobs : `int` or `None`, optional (default: `None`)
+        Number of processes for clustering at several `resolutions` without
+        `warm_start`. Defaults to `settings.n_jobs`.
     copy : `bool` (default: `False`)
         Copy adata or modify it inplace.
 
@@ -67,7 +83,11 @@ def louvain(
         louvain : :class:`pandas.Series` (``adata.obs``, dtype `category`)
             Array of dim (number of samples) that stores the subgroup id ('0',
             '1', ...) for each cell.
-    
+
+        If `resolutions` is given, one column of cluster labels per resolution
+        in ``adata.obs`` and the quality and number of clusters of each
+        clustering in ``adata.uns['louvain']``.
+
     AnnData
         When `copy=True` is set, a copy of ``adata`` with those fields is returned.
     """
@@ -75,12 +95,18 @@ def louvain(
     if (flavor != 'vtraag') and (partition_type is not None):
         raise ValueError(
             '`partition_type` is only a valid argument when `flavour` is "vtraag"')
+    if resolutions is not None:
+        if flavor != 'vtraag':
+            raise ValueError('`resolutions` is only a valid argument when `flavor` is "vtraag"')
+        if resolution is not None:
+            raise ValueError('Pass either `resolution` or `resolutions`.')
     adata = adata.copy() if copy else adata
     if adjacency is None and 'neighbors' not in adata.uns:
         raise ValueError(
             'You need to run `pp.neighbors` first to compute a neighborhood graph.')
     if adjacency is None:
         adjacency = adata.uns['neighbors']['connectivities']
+    restrict_indices = None
     if restrict_to is not None:
         restrict_key, restrict_categories = restrict_to
         if not isinstance(restrict_categories[0], str):
@@ -94,13 +120,16 @@ def louvain(
         restrict_indices = adata.obs[restrict_key].isin(restrict_categories).values
         adjacency = adjacency[restrict_indices, :]
         adjacency = adjacency[:, restrict_indices]
+    if key_added is None:
+        key_added = 'louvain' if restrict_to is None else restrict_key + '_R'
     if flavor in {'vtraag', 'igraph'}:
         if flavor == 'igraph' and resolution is not None:
             logg.warn('`resolution` parameter has no effect for flavor "igraph"')
         if directed and flavor == 'igraph':
             directed = False
         if not directed: logg.m('    using the undirected graph', v=4)
-        g = utils.get_igraph_from_adjacency(adjacency, directed=directed)
+        g = utils.get_igraph_from_adjacency(
+            adjacency, directed=directed, use_cache=True)
         if use_weights:
             weights = np.array(g.es["weight"]).astype(np.float64)
         else:
@@ -116,9 +145,17 @@ def louvain(
             if use_weights:
                 partition_kwargs["weights"] = weights
             logg.info('    using the "louvain" package of Traag (2017)')
-            louvain.set_rng_seed(random_state)
-            part = louvain.find_partition(g, partition_type,
-                                          **partition_kwargs)
+            if resolutions is not None:
+                memberships, qualities = _cluster_resolutions(
+                    'louvain', g, partition_type, partition_kwargs,
+                    resolutions, random_state, warm_start, n_jobs)
+                return _add_resolutions(
+                    adata, memberships, qualities, resolutions, 'louvain',
+                    key_added, random_state, warm_start,
+                    restrict_to, restrict_indices, copy)
+            part = _find_partition((
+                'louvain', g, partition_type, partition_kwargs, None,
+                random_state))
             # adata.uns['louvain_quality'] = part.quality()
         elif flavor == 'igraph':
             part = g.community_multilevel(weights=weights)
@@ -133,23 +170,8 @@ def louvain(
         for k, v in partition.items(): groups[k] = v
     else:
         raise ValueError('`flavor` needs to be "vtraag" or "igraph" or "taynaud".')
-    unique_groups = np.unique(groups)
-    n_clusters = len(unique_groups)
-    if restrict_to is None:
-        groups = groups.astype('U')
-        key_added = 'louvain' if key_added is None else key_added
-        adata.obs[key_added] = pd.Categorical(
-            values=groups,
-            categories=natsorted(unique_groups.astype('U')))
-    else:
-        key_added = restrict_key + '_R' if key_added is None else key_added
-        all_groups = adata.obs[restrict_key].astype('U')
-        prefix = '-'.join(restrict_categories) + ','
-        new_groups = [prefix + g for g in groups.astype('U')]
-        all_groups.iloc[restrict_indices] = new_groups
-        adata.obs[key_added] = pd.Categorical(
-            values=all_groups,
-            categories=natsorted(all_groups.unique()))
+    n_clusters = len(np.unique(groups))
+    adata.obs[key_added] = _labels(adata, groups, restrict_to, restrict_indices)
     adata.uns['louvain'] = {}
     adata.uns['louvain']['params'] = {'resolution': resolution, 'random_state': random_state}
     logg.info('    finished', time=True, end=' ' if settings.verbosity > 2 else '\n')
@@ -157,3 +179,94 @@ def louvain(
               '    \'{}\', the cluster labels (adata.obs, categorical)'
               .format(n_clusters, key_added))
     return adata if copy else None
+
+
+def _labels(adata, groups, restrict_to=None, restrict_indices=None):
+    """Categorical cluster labels, within the restricted categories if given."""
+    if restrict_to is None:
+        return pd.Categorical(
+            values=groups.astype('U'),
+            categories=natsorted(np.unique(groups).astype('U')))
+    restrict_key, restrict_categories = restrict_to
+    all_groups = adata.obs[restrict_key].astype('U')
+    prefix = '-'.join(restrict_categories) + ','
+    new_groups = [prefix + g for g in groups.astype('U')]
+    all_groups.iloc[restrict_indices] = new_groups
+    return pd.Categorical(
+        values=all_groups,
+        categories=natsorted(all_groups.unique()))
+
+
+def _find_partition(task):
+    """Optimize a partition with the `louvain` or `leidenalg` package.
+
+    Takes a single tuple so that it can be mapped over a process pool.
+    """
+    package_name, g, partition_type, partition_kwargs, initial_membership, random_state = task
+    package = importlib.import_module(package_name)
+    partition_kwargs = dict(partition_kwargs)
+    if hasattr(package, 'set_rng_seed'):
+        package.set_rng_seed(random_state)
+    else:  # louvain >= 0.7 and leidenalg
+        partition_kwargs['seed'] = random_state
+    return package.find_partition(
+        g, partition_type, initial_membership=initial_membership,
+        **partition_kwargs)
+
+
+def _cluster_resolutions(
+        package_name, g, partition_type, partition_kwargs,
+        resolutions, random_state, warm_start, n_jobs):
+    """Memberships and qualities of the partitions at each resolution."""
+    n_jobs = settings.n_jobs if n_jobs is None else n_jobs
+    tasks = []
+    for resolution in resolutions:
+        kwargs = dict(partition_kwargs, resolution_parameter=resolution)
+        tasks.append((package_name, g, partition_type, kwargs, None, random_state))
+    results = [None] * len(tasks)
+    if warm_start:
+        # coarser partitions are found by merging the clusters of finer ones
+        membership = None
+        for i in np.argsort(resolutions)[::-1]:
+            task = tasks[i][:4] + (membership, random_state)
+            results[i] = _membership_quality(task)
+            membership = results[i][0].tolist()
+    elif n_jobs > 1 and len(tasks) > 1:
+        import multiprocessing
+        with multiprocessing.Pool(min(n_jobs, len(tasks))) as pool:
+            results = pool.map(_membership_quality, tasks)
+    else:
+        results = list(map(_membership_quality, tasks))
+    memberships = [membership for membership, _ in results]
+    qualities = np.array([quality for _, quality in results])
+    return memberships, qualities
+
+
+def _membership_quality(task):
+    # partitions cannot be sent back from worker processes
+    part = _find_partition(task)
+    return np.array(part.membership), part.quality()
+
+
+def _add_resolutions(
+        adata, memberships, qualities, resolutions, uns_key, key_added,
+        random_state, warm_start, restrict_to, restrict_indices, copy):
+    """Add the labels of all resolutions to `.obs` and their summary to `.uns`."""
+    keys = ['{}_{:g}'.format(key_added, resolution) for resolution in resolutions]
+    for key, groups in zip(keys, memberships):
+        adata.obs[key] = _labels(adata, groups, restrict_to, restrict_indices)
+    n_clusters = np.array([len(np.unique(groups)) for groups in memberships])
+    adata.uns[uns_key] = {
+        'params': {'resolutions': np.array(resolutions, dtype=float),
+                   'random_state': random_state,
+                   'warm_start': warm_start},
+        'keys': np.array(keys),
+        'quality': qualities,
+        'n_clusters': n_clusters}
+    logg.info('    finished', time=True, end=' ' if settings.verbosity > 2 else '\n')
+    logg.hint('found {} to {} clusters at {} resolutions and added\n'
+              '    {}, the cluster labels (adata.obs, categorical)\n'
+              '    \'{}\', quality and number of clusters of each resolution (adata.uns)'
+              .format(n_clusters.min(), n_clusters.max(), len(keys),
+                      ', '.join('\'{}\''.format(key) for key in keys), uns_key))
+    return adata if copy else None
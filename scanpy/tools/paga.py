@@ -170,7 +170,7 @@ class PAGA():
             g, membership=self._adata.obs[self._groups_key].cat.codes.values)
         ns = vc.sizes()
         cg = vc.cluster_graph(combine_edges='sum')
-        inter_es = utils.get_sparse_from_igraph(cg, weight_attr='weight')/2
+        inter_es = utils.get_sparse_from_igraph(cg, weight_attr='weight')
         connectivities = inter_es.copy()
         inter_es = inter_es.tocoo()
         n_neighbors_sq = self._neighbors.n_neighbors**2
@@ -1,15 +1,18 @@
 """Rank genes according to differential expression.
 """
 
+from concurrent.futures import ThreadPoolExecutor
+
+import numba
 import numpy as np
-import pandas as pd
-from math import sqrt, floor
-from scipy.sparse import issparse
+from scipy.sparse import issparse, csc_matrix
 
 from .. import utils
 from .. import settings
 from .. import logging as logg
-from ..preprocessing import simple
+from ..preprocessing._chunked import (
+    memory_budget, iter_col_chunks, col_nbytes, chunk_size_from_budget)
+from ..preprocessing._utils import _get_mean_var_groups
 
 
 def rank_genes_groups(
@@ -24,9 +27,19 @@ def rank_genes_groups(
         copy=False,
         method='t-test_overestim_var',
         corr_method='benjamini-hochberg',
+        tie_correct=False,
+        max_cells_per_group=None,
+        warm_start=False,
+        random_state=0,
+        storage='recarray',
         **kwds):
     """Rank genes for characterizing groups.
 
+    For data in a backed h5ad file or a zarr or dask array, the t-tests and
+    the Wilcoxon test stream blocks of genes within `settings.max_memory` and
+    keep only the top-ranked genes of each group. Store backed sparse data as
+    CSC for this, blocks of genes of CSR data take a pass over the file each.
+
     Parameters
     ----------
     adata : :class:`~anndata.AnnData`
@@ -57,17 +70,46 @@ def rank_genes_groups(
     rankby_abs : `bool`, optional (default: `False`)
         Rank genes by the absolute value of the score, not by the
         score. The returned scores are never the absolute values.
+    tie_correct : `bool`, optional (default: `False`)
+        Use the tie correction of the variance of the rank sums for 'wilcoxon'.
+        Sparse data have many ties, the zeros.
+    max_cells_per_group : `int` or `None`, optional (default: `None`)
+        For 'logreg', fit on a random subsample of at most this many cells of
+        each group. Small groups are kept entirely, so that the subsample is
+        stratified by group.
+    warm_start : `bool`, optional (default: `False`)
+        For 'logreg', initialize the fit with the coefficients of a previous
+        run with `warm_start=True` that are stored in `.uns[key_added]`, if it
+        had the same groups and genes, and store the new coefficients there.
+        Related runs, e.g., with a different regularization or subsample, then
+        converge in few iterations. Not supported by the 'liblinear' solver.
+    random_state : `int`, optional (default: 0)
+        Seed for the subsampling of 'logreg', also passed to
+        `LogisticRegression`.
+    storage : {'recarray', 'compact'}, optional (default: 'recarray')
+        If 'recarray', store gene names and statistics as structured arrays
+        indexed by group ids. If 'compact', store `int32` indices into the
+        gene names and `float32` statistics as matrices of shape `n_genes` ×
+        `n_groups`, which is much smaller in memory and on disk for many
+        groups and genes. The plotting functions resolve the gene names of
+        both.
     **kwds : keyword parameters
         Are passed to test methods. Currently this affects only parameters that
         are passed to `sklearn.linear_model.LogisticRegression
         <http://scikit-learn.org/stable/modules/generated/sklearn.linear_model.LogisticRegression.html>`__.
         For instance, you can pass `penalty='l1'` to try to come up with a
         minimal set of genes that are good predictors (sparse solution meaning
-        few non-zero fitted coefficients).
+        few non-zero fitted coefficients). For many cells and groups, pass
+        `solver='saga'`, which works on sparse data, or `solver='sag'` or
+        `'lbfgs'` with `multi_class='ovr'`, which fits the groups in parallel
+        in `settings.n_jobs` processes.
 
     Returns
     -------
-    Updates `adata` with the following fields.
+    Updates `adata` with the following fields. For `storage='compact'`,
+    `'names'` is replaced by `'indices'` into the `var_names` of `.raw`, if
+    used, or `adata`, the other fields are matrices with one column per group
+    and `'groups'` stores the group ids.
     names : structured `np.ndarray` (`.uns['rank_genes_groups']`)
         Structured array to be indexed by group id storing the gene
         names. Ordered according to scores.
@@ -91,6 +133,10 @@ def rank_genes_groups(
     if corr_method not in avail_corr:
         raise ValueError('Correction method must be one of {}.'.format(avail_corr))
 
+    avail_storage = {'recarray', 'compact'}
+    if storage not in avail_storage:
+        raise ValueError('Storage must be one of {}.'.format(avail_storage))
+
     
     adata = adata.copy() if copy else adata
     utils.sanitize_anndata(adata)
@@ -111,6 +157,10 @@ def rank_genes_groups(
 
     if key_added is None:
         key_added = 'rank_genes_groups'
+    # coefficients of a previous run of 'logreg' to start from
+    previous_fit = None
+    if warm_start and key_added in adata.uns:
+        previous_fit = adata.uns[key_added].get('logreg')
     adata.uns[key_added] = {}
     adata.uns[key_added]['params'] = {
         'groupby': groupby,
@@ -137,263 +187,460 @@ def rank_genes_groups(
     
     n_groups = groups_masks.shape[0]
     ns = np.zeros(n_groups, dtype=int)
+    # group code of each observation, -1 for observations in none of the groups
+    groups_codes = np.full(X.shape[0], -1, dtype=int)
     for imask, mask in enumerate(groups_masks):
         ns[imask] = np.where(mask)[0].size
+        groups_codes[mask] = imask
     logg.msg('consider \'{}\' groups:'.format(groupby), groups_order, v=4)
     logg.msg('with sizes:', ns, v=4)
     if reference != 'rest':
         ireference = np.where(groups_order == reference)[0][0]
-    reference_indices = np.arange(adata_comp.n_vars, dtype=int)
 
     rankings_gene_scores = []
-    rankings_gene_names = []
+    rankings_gene_indices = []
     rankings_gene_logfoldchanges = []
     rankings_gene_pvals = []
     rankings_gene_pvals_adj = []
     
-    if method in {'t-test', 't-test_overestim_var'}:
-        from scipy import stats
-        from statsmodels.stats.multitest import multipletests
-        # loop over all masks and compute means, variances and sample numbers
-        means = np.zeros((n_groups, n_genes))
-        vars = np.zeros((n_groups, n_genes))
-        for imask, mask in enumerate(groups_masks):
-            means[imask], vars[imask] = simple._get_mean_var(X[mask])
-        # test each either against the union of all other groups or against a
-        # specific group
-        for igroup in range(n_groups):
-            if reference == 'rest':
-                mask_rest = ~groups_masks[igroup]
-            else:
-                if igroup == ireference: continue
-                else: mask_rest = groups_masks[ireference]
-            mean_rest, var_rest = simple._get_mean_var(X[mask_rest])
-            ns_group = ns[igroup]  # number of observations in group
-            if method == 't-test': ns_rest = np.where(mask_rest)[0].size
-            elif method == 't-test_overestim_var': ns_rest = ns[igroup]  # hack for overestimating the variance for small groups
-            else: raise ValueError('Method does not exist.')
-            
-            denominator = np.sqrt(vars[igroup]/ns_group + var_rest/ns_rest)
-            denominator[np.flatnonzero(denominator == 0)] = np.nan
-            scores = (means[igroup] - mean_rest) / denominator #Welch t-test
-            mean_rest[mean_rest == 0] = 1e-9  # set 0s to small value
-            foldchanges = (means[igroup] + 1e-9) / mean_rest
-            scores[np.isnan(scores)] = 0
-            #Get p-values
-            denominator_dof = (np.square(vars[igroup]) / (np.square(ns_group)*(ns_group-1))) + (
-                (np.square(var_rest) / (np.square(ns_rest) * (ns_rest - 1))))
-            denominator_dof[np.flatnonzero(denominator_dof == 0)] = np.nan
-            dof = np.square(vars[igroup]/ns_group + var_rest/ns_rest) / denominator_dof # dof calculation for Welch t-test
-            dof[np.isnan(dof)] = 0
-            pvals = stats.t.sf(abs(scores), dof)*2 # *2 because of two-tailed t-test
-
-            if corr_method == 'benjamini-hochberg':
-                pvals[np.isnan(pvals)] = 1  # set Nan values to 1 to properly convert using Benhjamini Hochberg
-                _, pvals_adj, _, _ = multipletests(pvals, alpha=0.05, method='fdr_bh')
-            elif corr_method == 'bonferroni':
-                pvals_adj = pvals * n_genes
-
-            scores_sort = np.abs(scores) if rankby_abs else scores
-            partition = np.argpartition(scores_sort, -n_genes_user)[-n_genes_user:]
-            partial_indices = np.argsort(scores_sort[partition])[::-1]
-            global_indices = reference_indices[partition][partial_indices]
-            rankings_gene_scores.append(scores[global_indices])
-            rankings_gene_logfoldchanges.append(np.log2(np.abs(foldchanges[global_indices])))
-            rankings_gene_names.append(adata_comp.var_names[global_indices])
-            rankings_gene_pvals.append(pvals[global_indices])
-            rankings_gene_pvals_adj.append(pvals_adj[global_indices])
-            
-    elif method == 'logreg':
+    if method == 'logreg':
         # if reference is not set, then the groups listed will be compared to the rest
         # if reference is set, then the groups listed will be compared only to the other groups listed
         from sklearn.linear_model import LogisticRegression
         reference = groups_order[0]
         if len(groups) == 1:
             raise Exception('Cannot perform logistic regression on a single cluster.')
-        adata_copy = adata[adata.obs[groupby].isin(groups_order)]        
-        adata_comp = adata_copy
-        if adata.raw is not None and use_raw:
-            adata_comp = adata_copy.raw
-        X = adata_comp.X
-
-        clf = LogisticRegression(**kwds)
-        clf.fit(X, adata_copy.obs[groupby].cat.codes)
-        scores_all = clf.coef_
-        for igroup, group in enumerate(groups_order):
-            if len(groups_order) <= 2:  # binary logistic regression
-                scores = scores_all[0]
+        # select the observations of the groups by index instead of copying a
+        # view of adata
+        obs_indices = _subsample_groups(
+            groups_codes, n_groups, max_cells_per_group, random_state)
+        if len(obs_indices) < X.shape[0]:
+            X = X[obs_indices]
+        if kwds.get('solver', 'liblinear') not in {'liblinear', 'warn'}:
+            # one-vs-rest problems are fit in parallel
+            kwds.setdefault('n_jobs', settings.n_jobs)
+        clf = LogisticRegression(
+            warm_start=warm_start, random_state=random_state, **kwds)
+        if previous_fit is not None:
+            if (list(previous_fit['groups']) == [str(g) for g in groups_order]
+                    and previous_fit['coef'].shape[1] == n_genes):
+                clf.coef_ = np.array(previous_fit['coef'])
+                clf.intercept_ = np.array(previous_fit['intercept'])
             else:
-                scores = scores_all[igroup]
-            partition = np.argpartition(scores, -n_genes_user)[-n_genes_user:]
-            partial_indices = np.argsort(scores[partition])[::-1]
-            global_indices = reference_indices[partition][partial_indices]
-            rankings_gene_scores.append(scores[global_indices])
-            rankings_gene_names.append(adata_comp.var_names[global_indices])
-            if len(groups_order) <= 2:
-                break
-
-    elif method == 'wilcoxon':
-        from scipy import stats
-        from statsmodels.stats.multitest import multipletests
-        CONST_MAX_SIZE = 10000000
-        means = np.zeros((n_groups, n_genes))
-        vars = np.zeros((n_groups, n_genes))
-        # initialize space for z-scores
-        scores = np.zeros(n_genes)
-        # First loop: Loop over all genes
-        if reference != 'rest':
-            for imask, mask in enumerate(groups_masks):
-                means[imask], vars[imask] = simple._get_mean_var(X[mask])  # for fold-change
-                if imask == ireference: continue
-                else: mask_rest = groups_masks[ireference]
-                ns_rest = np.where(mask_rest)[0].size
-                mean_rest, var_rest = simple._get_mean_var(X[mask_rest]) # for fold-change
-                if ns_rest <= 25 or ns[imask] <= 25:
-                    logg.hint('Few observations in a group for '
-                              'normal approximation (<=25). Lower test accuracy.')
-                n_active = ns[imask]
-                m_active = ns_rest
-
-                # Now calculate gene expression ranking in chunkes:
-                chunk = []
-                # Calculate chunk frames
-                n_genes_max_chunk = floor(CONST_MAX_SIZE / (n_active + m_active))
-                if n_genes_max_chunk < n_genes - 1:
-                    chunk_index = n_genes_max_chunk
-                    while chunk_index < n_genes - 1:
-                        chunk.append(chunk_index)
-                        chunk_index = chunk_index + n_genes_max_chunk
-                    chunk.append(n_genes - 1)
-                else:
-                    chunk.append(n_genes - 1)
-
-                left = 0
-                # Calculate rank sums for each chunk for the current mask
-                for chunk_index, right in enumerate(chunk):
-                    # Check if issparse is true: AnnData objects are currently sparse.csr or ndarray.
-                    if issparse(X):
-                        df1 = pd.DataFrame(data=X[mask, left:right].todense())
-                        df2 = pd.DataFrame(data=X[mask_rest, left:right].todense(),
-                                           index=np.arange(start=n_active, stop=n_active + m_active))
-                    else:
-                        df1 = pd.DataFrame(data=X[mask, left:right])
-                        df2 = pd.DataFrame(data=X[mask_rest, left:right],
-                                           index=np.arange(start=n_active, stop=n_active + m_active))
-                    df1 = df1.append(df2)
-                    ranks = df1.rank()
-                    # sum up adjusted_ranks to calculate W_m,n
-                    scores[left:right] = np.sum(ranks.loc[0:n_active, :])
-                    left = right + 1
-
-                scores = (scores - (n_active * (n_active + m_active + 1) / 2)) / sqrt(
-                    (n_active * m_active * (n_active + m_active + 1) / 12))
-                scores[np.isnan(scores)] = 0
-                pvals = 2 * stats.distributions.norm.sf(np.abs(scores))
-
-                if corr_method == 'benjamini-hochberg':
-                    pvals[np.isnan(pvals)] = 1  # set Nan values to 1 to properly convert using Benhjamini Hochberg
-                    _, pvals_adj, _, _ = multipletests(pvals, alpha=0.05, method='fdr_bh')
-                elif corr_method == 'bonferroni':
-                    pvals_adj = pvals * n_genes
-
-                mean_rest[mean_rest == 0] = 1e-9  # set 0s to small value
-                foldchanges = (means[imask] + 1e-9) / mean_rest
-                scores_sort = np.abs(scores) if rankby_abs else scores
-                partition = np.argpartition(scores_sort, -n_genes_user)[-n_genes_user:]
-                partial_indices = np.argsort(scores_sort[partition])[::-1]
-                global_indices = reference_indices[partition][partial_indices]
-                rankings_gene_scores.append(scores[global_indices])
-                rankings_gene_names.append(adata_comp.var_names[global_indices])
-                rankings_gene_logfoldchanges.append(np.log2(np.abs(foldchanges[global_indices])))
-                rankings_gene_pvals.append(pvals[global_indices])
-                rankings_gene_pvals_adj.append(pvals_adj[global_indices])
-
-
-        # If no reference group exists, ranking needs only to be done once (full mask)
+                logg.warn('groups or genes differ from the previous run, '
+                          'not using its coefficients for a warm start')
+        clf.fit(X, groups_codes[obs_indices])
+        if warm_start:
+            adata.uns[key_added]['logreg'] = {
+                'groups': np.array([str(g) for g in groups_order]),
+                'coef': clf.coef_,
+                'intercept': clf.intercept_}
+        # a single row of coefficients for binary logistic regression
+        scores_all = clf.coef_
+        for scores, indices in zip(
+                scores_all, _top_indices(scores_all, n_genes_user)):
+            rankings_gene_scores.append(scores[indices])
+            rankings_gene_indices.append(indices)
+
+    else:
+        # test all groups at once, either against the union of all other
+        # groups or against a specific group
+        if reference == 'rest':
+            igroups, ireference = np.arange(n_groups), None
         else:
-            scores = np.zeros((n_groups, n_genes))
-            chunk = []
-            n_cells = X.shape[0]
-            n_genes_max_chunk = floor(CONST_MAX_SIZE / n_cells)
-            if n_genes_max_chunk < n_genes - 1:
-                chunk_index = n_genes_max_chunk
-                while chunk_index < n_genes - 1:
-                    chunk.append(chunk_index)
-                    chunk_index = chunk_index + n_genes_max_chunk
-                chunk.append(n_genes - 1)
+            igroups = np.flatnonzero(np.arange(n_groups) != ireference)
+            if method == 'wilcoxon' and np.any(ns[[ireference, *igroups]] <= 25):
+                logg.hint('Few observations in a group for '
+                          'normal approximation (<=25). Lower test accuracy.')
+        if issparse(X) or isinstance(X, np.ndarray):
+            blocks = [(X, 0, n_genes)]
+        else:
+            # stream blocks of genes from backed, zarr or dask arrays, the
+            # next block is read while the current one is tested
+            chunk_size = chunk_size_from_budget(col_nbytes(X), n_copies=4)
+            blocks = iter_col_chunks(X, chunk_size, prefetch=True)
+        # p-values of all genes are needed for the correction
+        pvals = np.empty((len(igroups), n_genes))
+        top = None
+        for X_block, start, end in blocks:
+            if method == 'wilcoxon':
+                scores, pvals[:, start:end], foldchanges = _wilcoxon(
+                    X_block, groups_codes, ns, igroups, ireference, tie_correct)
             else:
-                chunk.append(n_genes - 1)
-            left = 0
-            for chunk_index, right in enumerate(chunk):
-                # Check if issparse is true
-                if issparse(X):
-                    df1 = pd.DataFrame(data=X[:, left:right].todense())
-                else:
-                    df1 = pd.DataFrame(data=X[:, left:right])
-                ranks = df1.rank()
-                # sum up adjusted_ranks to calculate W_m,n
-                for imask, mask in enumerate(groups_masks):
-                    scores[imask, left:right] = np.sum(ranks.loc[mask, :])
-                left = right + 1
-
-            for imask, mask in enumerate(groups_masks):
-                means[imask], vars[imask] = simple._get_mean_var(X[mask]) #for fold-change
-                mask_rest = ~groups_masks[imask]
-                mean_rest, var_rest = simple._get_mean_var(X[mask_rest]) #for fold-change
-
-                scores[imask, :] = (scores[imask, :] - (ns[imask] * (n_cells + 1) / 2)) / sqrt(
-                    (ns[imask] * (n_cells - ns[imask]) * (n_cells + 1) / 12))
-                scores[np.isnan(scores)] = 0
-                pvals = 2 * stats.distributions.norm.sf(np.abs(scores[imask,:]))
-
-                if corr_method == 'benjamini-hochberg':
-                    pvals[np.isnan(pvals)] = 1  # set Nan values to 1 to properly convert using Benhjamini Hochberg
-                    _, pvals_adj, _, _ = multipletests(pvals, alpha=0.05, method='fdr_bh')
-                elif corr_method == 'bonferroni':
-                    pvals_adj = pvals * n_genes
-
-                mean_rest[mean_rest == 0] = 1e-9  # set 0s to small value
-                foldchanges = (means[imask] + 1e-9) / mean_rest
-                scores_sort = np.abs(scores) if rankby_abs else scores
-                partition = np.argpartition(scores_sort[imask, :], -n_genes_user)[-n_genes_user:]
-                partial_indices = np.argsort(scores_sort[imask, partition])[::-1]
-                global_indices = reference_indices[partition][partial_indices]
-                rankings_gene_scores.append(scores[imask, global_indices])
-                rankings_gene_names.append(adata_comp.var_names[global_indices])
-                rankings_gene_logfoldchanges.append(np.log2(np.abs(foldchanges[global_indices])))
-                rankings_gene_pvals.append(pvals[global_indices])
-                rankings_gene_pvals_adj.append(pvals_adj[global_indices])
+                scores, pvals[:, start:end], foldchanges = _t_test(
+                    X_block, groups_codes, ns, igroups, ireference,
+                    method == 't-test_overestim_var')
+            # keep only the top-ranked genes of all groups
+            top = _merge_top(top, start, scores, foldchanges, n_genes_user, rankby_abs)
+        global_indices, scores, foldchanges = top
 
+        if corr_method == 'benjamini-hochberg':
+            pvals[np.isnan(pvals)] = 1  # set Nan values to 1 to properly convert using Benhjamini Hochberg
+            pvals_adj = _map_groups(_benjamini_hochberg, pvals)
+        elif corr_method == 'bonferroni':
+            pvals_adj = pvals * n_genes
+        for i, indices in enumerate(global_indices):
+            rankings_gene_scores.append(scores[i])
+            rankings_gene_indices.append(indices)
+            rankings_gene_logfoldchanges.append(np.log2(np.abs(foldchanges[i])))
+            rankings_gene_pvals.append(pvals[i, indices])
+            rankings_gene_pvals_adj.append(pvals_adj[i, indices])
 
     groups_order_save = [str(g) for g in groups_order]
     if (reference != 'rest' and method != 'logreg') or (method == 'logreg' and len(groups) == 2):
         groups_order_save = [g for g in groups_order if g != reference]
-    adata.uns[key_added]['scores'] = np.rec.fromarrays(
-        [n for n in rankings_gene_scores],
-        dtype=[(rn, 'float32') for rn in groups_order_save])
-    adata.uns[key_added]['names'] = np.rec.fromarrays(
-        [n for n in rankings_gene_names],
-        dtype=[(rn, 'U50') for rn in groups_order_save])
-
+    rankings = [('scores', rankings_gene_scores, 'float32')]
     if method in {'t-test', 't-test_overestim_var', 'wilcoxon'}:
-        adata.uns[key_added]['logfoldchanges'] = np.rec.fromarrays(
-            [n for n in rankings_gene_logfoldchanges],
-            dtype=[(rn, 'float32') for rn in groups_order_save])
-        adata.uns[key_added]['pvals'] = np.rec.fromarrays(
-            [n for n in rankings_gene_pvals],
-            dtype=[(rn, 'float64') for rn in groups_order_save])
-        adata.uns[key_added]['pvals_adj'] = np.rec.fromarrays(
-            [n for n in rankings_gene_pvals_adj],
-            dtype=[(rn, 'float64') for rn in groups_order_save])
-    
+        rankings += [
+            ('logfoldchanges', rankings_gene_logfoldchanges, 'float32'),
+            ('pvals', rankings_gene_pvals, 'float64'),
+            ('pvals_adj', rankings_gene_pvals_adj, 'float64')]
+    if storage == 'compact':
+        # one column per group, names are resolved from the indices on demand
+        adata.uns[key_added]['groups'] = np.array(groups_order_save, dtype=str)
+        adata.uns[key_added]['indices'] = np.column_stack(
+            rankings_gene_indices).astype(np.int32)
+        for field, values, _ in rankings:
+            adata.uns[key_added][field] = np.column_stack(values).astype(np.float32)
+    else:
+        adata.uns[key_added]['names'] = np.rec.fromarrays(
+            [adata_comp.var_names[n] for n in rankings_gene_indices],
+            dtype=[(rn, 'U50') for rn in groups_order_save])
+        for field, values, dtype in rankings:
+            adata.uns[key_added][field] = np.rec.fromarrays(
+                [n for n in values],
+                dtype=[(rn, dtype) for rn in groups_order_save])
+
     logg.info('    finished', time=True, end=' ' if settings.verbosity > 2 else '\n')
-    logg.hint(
-        'added to `.uns[\'{}\']`\n'
-        '    \'names\', sorted np.recarray to be indexed by group ids\n'
-        '    \'scores\', sorted np.recarray to be indexed by group ids\n'
-        .format(key_added)
-        + ('    \'logfoldchanges\', sorted np.recarray to be indexed by group ids\n'
-           '    \'pvals\', sorted np.recarray to be indexed by group ids\n'
-           '    \'pvals_adj\', sorted np.recarray to be indexed by group ids'
-           if method in {'t-test', 't-test_overestim_var', 'wilcoxon'} else ''))
+    if storage == 'compact':
+        logg.hint(
+            'added to `.uns[\'{}\']`\n'
+            '    \'indices\', \'scores\', ..., sorted matrices with one column '
+            'per group of \'groups\''.format(key_added))
+    else:
+        logg.hint(
+            'added to `.uns[\'{}\']`\n'
+            '    \'names\', sorted np.recarray to be indexed by group ids\n'
+            '    \'scores\', sorted np.recarray to be indexed by group ids\n'
+            .format(key_added)
+            + ('    \'logfoldchanges\', sorted np.recarray to be indexed by group ids\n'
+               '    \'pvals\', sorted np.recarray to be indexed by group ids\n'
+               '    \'pvals_adj\', sorted np.recarray to be indexed by group ids'
+               if method in {'t-test', 't-test_overestim_var', 'wilcoxon'} else ''))
     return adata if copy else None
+
+
+def _ranked_groups(result):
+    """Group ids of a result of :func:`rank_genes_groups`."""
+    if 'indices' in result:
+        return tuple(str(g) for g in result['groups'])
+    return result['names'].dtype.names
+
+
+def _ranked_field(adata, key, field, group):
+    """Sorted `field` of `group` of a result of :func:`rank_genes_groups`.
+
+    For compact results, gene names are resolved from the stored indices.
+    """
+    result = adata.uns[key]
+    if 'indices' not in result:
+        return result[field][group]
+    igroup = _ranked_groups(result).index(str(group))
+    if field != 'names':
+        return result[field][:, igroup]
+    if adata.raw is not None and result['params']['use_raw']:
+        var_names = adata.raw.var_names
+    else:
+        var_names = adata.var_names
+    return var_names[result['indices'][:, igroup]].values
+
+
+def _t_test(X, groups_codes, ns, igroups, ireference, overestim_var):
+    """Welch t-test of the groups `igroups` against the rest or a reference.
+
+    Returns
+    -------
+    scores, pvals, foldchanges : `np.ndarray`
+        Arrays of shape `len(igroups)` × `n_vars`.
+    """
+    from scipy import special
+    # means, variances and sample numbers of all groups and of the rest
+    # of each group in a single pass
+    means, vars, means_rest, vars_rest, ns_rests = _get_mean_var_rest(
+        X, groups_codes, len(ns))
+    if ireference is None:
+        mean_rest, var_rest = means_rest[igroups], vars_rest[igroups]
+        ns_rest = ns_rests[igroups][:, None]
+    else:
+        mean_rest, var_rest = means[[ireference]], vars[[ireference]]
+        ns_rest = ns[ireference]
+    mean_group, var_group = means[igroups], vars[igroups]
+    ns_group = ns[igroups][:, None]  # number of observations in group
+    if overestim_var:
+        ns_rest = ns_group  # hack for overestimating the variance for small groups
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        denominator = np.sqrt(var_group/ns_group + var_rest/ns_rest)
+        denominator[denominator == 0] = np.nan
+        scores = (mean_group - mean_rest) / denominator  # Welch t-test
+        scores[np.isnan(scores)] = 0
+        # dof calculation for Welch t-test
+        denominator_dof = (np.square(var_group) / (np.square(ns_group)*(ns_group-1))) + (
+            (np.square(var_rest) / (np.square(ns_rest) * (ns_rest - 1))))
+        denominator_dof[denominator_dof == 0] = np.nan
+        dof = np.square(var_group/ns_group + var_rest/ns_rest) / denominator_dof
+        dof[np.isnan(dof)] = 0
+    # *2 because of two-tailed t-test, `stdtr` is the cdf of the t-distribution
+    pvals = _map_groups(
+        lambda s, d: special.stdtr(d, -np.abs(s)) * 2, scores, dof)
+    mean_rest = np.where(mean_rest == 0, 1e-9, mean_rest)  # set 0s to small value
+    foldchanges = (mean_group + 1e-9) / mean_rest
+    return scores, pvals, foldchanges
+
+
+def _wilcoxon(X, groups_codes, ns, igroups, ireference, tie_correct):
+    """Wilcoxon rank-sum test of the groups `igroups` against the rest or a reference.
+
+    Returns
+    -------
+    scores, pvals, foldchanges : `np.ndarray`
+        Arrays of shape `len(igroups)` × `n_vars`.
+    """
+    from scipy import special
+    n_groups = len(ns)
+    # for fold-changes
+    means, _, means_rest, _, _ = _get_mean_var_rest(X, groups_codes, n_groups)
+    if ireference is not None:
+        ns_rest = ns[ireference]
+        scores = np.zeros((len(igroups), X.shape[1]))
+        for i, imask in enumerate(igroups):
+            # rank the observations of the group and the reference only
+            codes = np.full(X.shape[0], -1, dtype=np.int64)
+            codes[groups_codes == imask] = 0
+            codes[groups_codes == ireference] = 1
+            rank_sums, ties = _rank_sums(X, codes, 2)
+            scores[i] = _rank_sums_z_scores(
+                rank_sums[0], ties, ns[imask], ns[imask] + ns_rest, tie_correct)
+        mean_rest = means[[ireference]]
+    # If no reference group exists, ranking needs only to be done once
+    else:
+        # observations in none of the groups are ranked, too
+        codes = np.where(groups_codes < 0, n_groups, groups_codes)
+        rank_sums, ties = _rank_sums(X, codes, n_groups + 1)
+        scores = _rank_sums_z_scores(
+            rank_sums[igroups], ties, ns[igroups][:, None], X.shape[0], tie_correct)
+        mean_rest = means_rest[igroups]
+    # `ndtr` is the cdf of the standard normal distribution
+    pvals = _map_groups(lambda s: 2 * special.ndtr(-np.abs(s)), scores)
+    mean_rest = np.where(mean_rest == 0, 1e-9, mean_rest)  # set 0s to small value
+    foldchanges = (means[igroups] + 1e-9) / mean_rest
+    return scores, pvals, foldchanges
+
+
+def _merge_top(top, start, scores, foldchanges, n_top, rankby_abs):
+    """Merge the top-ranked genes of a block of genes into `top`.
+
+    Parameters
+    ----------
+    top : `tuple` or `None`
+        Indices, scores and fold changes of the top-ranked genes of all
+        groups so far, sorted by score, or `None` for the first block.
+    start : `int`
+        Index of the first gene of the block.
+    scores, foldchanges : `np.ndarray`
+        Statistics of the genes of the block, one row per group.
+    """
+    scores_sort = np.abs(scores) if rankby_abs else scores
+    indices = _map_groups(
+        lambda s: _top_indices(s, min(n_top, s.shape[1])), scores_sort)
+    candidates = (
+        indices + start,
+        np.take_along_axis(scores, indices, axis=1),
+        np.take_along_axis(foldchanges, indices, axis=1))
+    if top is None:
+        return candidates
+    candidates = [np.hstack([t, c]) for t, c in zip(top, candidates)]
+    scores_sort = np.abs(candidates[1]) if rankby_abs else candidates[1]
+    order = _top_indices(scores_sort, min(n_top, scores_sort.shape[1]))
+    return tuple(np.take_along_axis(c, order, axis=1) for c in candidates)
+
+
+def _get_mean_var_rest(X, groups_codes, n_groups):
+    """Means and variances of the groups and of the rest of each group.
+
+    The statistics of the rest, all observations not in a group, are derived
+    from the totals minus the group, so that `X` is passed only once.
+
+    Returns
+    -------
+    means, vars, means_rest, vars_rest : `np.ndarray`
+        Arrays of shape `n_groups` × `n_vars`.
+    ns_rest : `np.ndarray`
+        Number of observations in the rest of each group.
+    """
+    # observations in none of the groups are collected in an extra group
+    codes = np.where(groups_codes < 0, n_groups, groups_codes)
+    means, vars, ns = _get_mean_var_groups(X, codes, n_groups + 1)
+    sums = means * ns[:, None]
+    # groups with a single observation have no variance, but no spread either
+    sums_sq = np.nan_to_num(vars) * (ns[:, None] - 1) + sums * means
+    sums[ns == 0], sums_sq[ns == 0] = 0, 0
+    ns_rest = ns.sum() - ns[:n_groups]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means_rest = (sums.sum(axis=0) - sums[:n_groups]) / ns_rest[:, None]
+        vars_rest = ((sums_sq.sum(axis=0) - sums_sq[:n_groups])
+                     - ns_rest[:, None] * means_rest ** 2) / (ns_rest[:, None] - 1)
+    # cancellation may leave tiny negative variances
+    np.maximum(vars_rest, 0, out=vars_rest)
+    return means[:n_groups], vars[:n_groups], means_rest, vars_rest, ns_rest
+
+
+def _subsample_groups(groups_codes, n_groups, max_cells_per_group, random_state):
+    """Indices of the observations in the groups, at most `max_cells_per_group` per group."""
+    if max_cells_per_group is None:
+        return np.flatnonzero(groups_codes >= 0)
+    random_state = np.random.RandomState(random_state)
+    indices = []
+    for igroup in range(n_groups):
+        group_indices = np.flatnonzero(groups_codes == igroup)
+        if len(group_indices) > max_cells_per_group:
+            group_indices = random_state.choice(
+                group_indices, max_cells_per_group, replace=False)
+        indices.append(group_indices)
+    return np.sort(np.concatenate(indices))
+
+
+def _map_groups(func, *arrays):
+    """Apply `func` to blocks of rows of `arrays`, one row per group.
+
+    With `settings.n_jobs > 1`, the blocks are processed in a thread pool; the
+    vectorized NumPy and SciPy functions used here release the GIL.
+    """
+    n_rows = arrays[0].shape[0]
+    n_jobs = min(settings.n_jobs, n_rows)
+    if n_jobs <= 1:
+        return func(*arrays)
+    bounds = np.linspace(0, n_rows, n_jobs + 1).astype(int)
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        blocks = executor.map(
+            lambda b: func(*[array[b[0]:b[1]] for array in arrays]),
+            zip(bounds[:-1], bounds[1:]))
+        return np.concatenate(list(blocks))
+
+
+def _benjamini_hochberg(pvals):
+    """Benjamini-Hochberg adjusted p-values of each row of `pvals`.
+
+    Same as `fdr_bh` of `statsmodels.stats.multitest.multipletests`.
+    """
+    n_tests = pvals.shape[1]
+    order = np.argsort(pvals, axis=1)
+    pvals_sorted = np.take_along_axis(pvals, order, axis=1)
+    pvals_sorted /= np.arange(1, n_tests + 1) / float(n_tests)
+    # step-up: the adjusted p-value is the smallest one of all larger p-values
+    pvals_sorted = np.minimum.accumulate(pvals_sorted[:, ::-1], axis=1)[:, ::-1]
+    np.minimum(pvals_sorted, 1, out=pvals_sorted)
+    pvals_adj = np.empty_like(pvals_sorted)
+    np.put_along_axis(pvals_adj, order, pvals_sorted, axis=1)
+    return pvals_adj
+
+
+def _top_indices(scores, n_top):
+    """Indices of the `n_top` largest scores of each row, in descending order."""
+    partition = np.argpartition(scores, -n_top, axis=1)[:, -n_top:]
+    partial_indices = np.argsort(
+        np.take_along_axis(scores, partition, axis=1), axis=1)[:, ::-1]
+    return np.take_along_axis(partition, partial_indices, axis=1)
+
+
+def _rank_sums(X, codes, n_groups):
+    """Per-group sums of the ranks of the observations within each variable.
+
+    Only observations with non-negative `codes` are ranked. The zeros of a
+    variable are ranked as a single block of ties, only the nonzero values
+    are sorted.
+
+    Returns
+    -------
+    rank_sums : `np.ndarray`
+        Array of shape `n_groups` × `n_vars`.
+    ties : `np.ndarray`
+        Sum of `t**3 - t` over the blocks of `t` ties of each variable.
+    """
+    codes = np.asarray(codes, dtype=np.int64)
+    ns = np.bincount(codes[codes >= 0], minlength=n_groups)
+    if issparse(X):
+        X = X.tocsc()
+        return _rank_sums_csc(
+            X.data, X.indices, X.indptr, codes, n_groups, ns)
+    # convert blocks of columns of dense data
+    n_vars = X.shape[1]
+    chunk_size = max(1, memory_budget() // (X.shape[0] * 3 * 8))
+    rank_sums = np.zeros((n_groups, n_vars))
+    ties = np.zeros(n_vars)
+    for start in range(0, n_vars, chunk_size):
+        end = min(start + chunk_size, n_vars)
+        X_chunk = csc_matrix(X[:, start:end])
+        rank_sums[:, start:end], ties[start:end] = _rank_sums_csc(
+            X_chunk.data, X_chunk.indices, X_chunk.indptr, codes, n_groups, ns)
+    return rank_sums, ties
+
+
+def _rank_sums_z_scores(rank_sums, ties, n_active, n_total, tie_correct):
+    """Normal approximation of the rank-sum statistic of a group."""
+    n_rest = n_total - n_active
+    var = n_active * n_rest * (n_total + 1) / 12
+    if tie_correct:
+        var = var * (1 - ties / (float(n_total) ** 3 - n_total))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scores = (rank_sums - n_active * (n_total + 1) / 2) / np.sqrt(var)
+    scores[np.isnan(scores)] = 0
+    return scores
+
+
+@numba.njit(parallel=True)
+def _rank_sums_csc(data, indices, indptr, codes, n_groups, ns):
+    n_vars = len(indptr) - 1
+    n_ranked = ns.sum()
+    rank_sums = np.zeros((n_groups, n_vars))
+    ties = np.zeros(n_vars)
+    for j in numba.prange(n_vars):
+        start, end = indptr[j], indptr[j + 1]
+        # nonzero values of the ranked observations
+        values = np.empty(end - start, dtype=np.float64)
+        groups = np.empty(end - start, dtype=np.int64)
+        n_nonzero = 0
+        for k in range(start, end):
+            g = codes[indices[k]]
+            if g >= 0 and data[k] != 0:
+                values[n_nonzero] = data[k]
+                groups[n_nonzero] = g
+                n_nonzero += 1
+        values = values[:n_nonzero]
+        groups = groups[:n_nonzero]
+        order = np.argsort(values, kind='mergesort')
+        n_zeros = n_ranked - n_nonzero
+        n_negative = 0
+        nonzeros_per_group = np.zeros(n_groups, dtype=np.int64)
+        i = 0
+        while i < n_nonzero:
+            value = values[order[i]]
+            i_end = i + 1
+            while i_end < n_nonzero and values[order[i_end]] == value:
+                i_end += 1
+            n_ties = i_end - i
+            if value < 0:
+                n_negative += n_ties
+            # average rank of the block, the zeros rank below positive values
+            rank = i + (n_ties + 1) / 2 + (n_zeros if value > 0 else 0)
+            for m in range(i, i_end):
+                g = groups[order[m]]
+                rank_sums[g, j] += rank
+                nonzeros_per_group[g] += 1
+            ties[j] += float(n_ties) ** 3 - n_ties
+            i = i_end
+        zero_rank = n_negative + (n_zeros + 1) / 2
+        for g in range(n_groups):
+            rank_sums[g, j] += zero_rank * (ns[g] - nonzeros_per_group[g])
+        ties[j] += float(n_zeros) ** 3 - n_zeros
+    return rank_sums, ties
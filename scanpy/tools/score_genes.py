@@ -6,6 +6,7 @@ import pandas as pd
 import scipy.sparse
 from .. import settings
 from .. import logging as logg
+from ..preprocessing._utils import _get_mean_var
 
 
 def score_genes(
@@ -124,6 +125,120 @@ def score_genes(
     return adata if copy else None
 
 
+def score_genes_multi(
+        adata,
+        gene_lists,
+        ctrl_size=50,
+        gene_pool=None,
+        n_bins=25,
+        random_state=0,
+        copy=False,
+        use_raw=False):
+    """Score many sets of genes at once [Satija15]_.
+
+    Computes the same scores as :func:`~scanpy.api.tl.score_genes` for each
+    set of genes, but the average expression of the genes is computed only
+    once with a sparse reduction, the control genes of all sets are drawn from
+    the same expression bins and all scores are obtained by a single product
+    of the data with a sparse genes × sets weight matrix. The data is never
+    densified.
+
+    Parameters
+    ----------
+    adata : :class:`~anndata.AnnData`
+        The annotated data matrix.
+    gene_lists : `dict`
+        Gene lists by the names of the fields to be added in `.obs`.
+    ctrl_size : `int`, optional (default: 50)
+        Number of reference genes to be sampled per expression bin of the
+        genes of a set.
+    gene_pool : `list` or `None`, optional (default: `None`)
+        Genes for sampling the reference sets. Default is all genes.
+    n_bins : `int`, optional (default: 25)
+        Number of expression level bins for sampling.
+    random_state : `int`, optional (default: 0)
+        The random seed for sampling, the reference set of each gene list is
+        drawn as by :func:`~scanpy.api.tl.score_genes` with this seed. Unlike
+        there, `0` is a seed, too, so that scores are reproducible.
+    copy : `bool`, optional (default: `False`)
+        Copy `adata` or modify it inplace.
+    use_raw : `bool`, optional (default: `False`)
+        Use `raw` attribute of `adata` if present.
+
+    Returns
+    -------
+    Depending on `copy`, returns or updates `adata` with a field in `.obs` for
+    each key of `gene_lists`.
+    """
+    logg.info('computing {} scores'.format(len(gene_lists)), r=True)
+    adata = adata.copy() if copy else adata
+    _adata = adata.raw if use_raw else adata
+    var_names = _adata.var_names
+    if not gene_pool:
+        pool = np.arange(len(var_names))
+    else:
+        pool = var_names.get_indexer([x for x in gene_pool if x in var_names])
+    # average expression of the genes of the pool, in a single pass
+    obs_avg = pd.Series(_get_mean_var(_adata.X)[0][pool], index=pool)
+    obs_avg = obs_avg[np.isfinite(obs_avg)]
+    n_items = int(np.round(len(obs_avg) / (n_bins - 1)))
+    obs_cut = obs_avg.rank(method='min') // n_items
+    # genes of each expression bin, shared by all gene lists
+    bins = {cut: np.array(genes.index) for cut, genes in obs_cut.groupby(obs_cut)}
+
+    # weights of the genes of each list and their control genes, one column
+    # per score
+    score_names, rows, cols, weights = [], [], [], []
+    for score_name, gene_list in gene_lists.items():
+        genes = []
+        for gene in gene_list:
+            if gene in var_names:
+                genes.append(var_names.get_loc(gene))
+            else:
+                logg.warn('gene: {} is not in adata.var_names and will be ignored'
+                          .format(gene))
+        genes = np.unique(genes).astype(int)
+        if len(genes) == 0:
+            logg.hint('could not add \n'
+                      '    \'{}\', score of gene set (adata.obs)'.format(score_name))
+            continue
+        control_genes = _control_genes(
+            genes, obs_cut, bins, ctrl_size, np.random.RandomState(random_state))
+        for indices, weight in [(genes, 1 / len(genes)),
+                                (control_genes, -1 / len(control_genes))]:
+            rows.append(indices)
+            cols.append(np.full(len(indices), len(score_names)))
+            weights.append(np.full(len(indices), weight))
+        score_names.append(score_name)
+    if not score_names:
+        return adata if copy else None
+    weights = scipy.sparse.csr_matrix(
+        (np.concatenate(weights), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(len(var_names), len(score_names)))
+    scores = _adata.X @ weights
+    if scipy.sparse.issparse(scores):
+        scores = scores.toarray()
+    scores = np.asarray(scores, dtype=np.result_type(_adata.X.dtype, np.float32))
+    for score_name, score in zip(score_names, scores.T):
+        adata.obs[score_name] = pd.Series(score, index=adata.obs_names)
+
+    logg.info('    finished', time=True, end=' ' if settings.verbosity > 2 else '\n')
+    logg.hint('added\n'
+              + '\n'.join('    \'{}\', score of gene set (adata.obs)'.format(name)
+                          for name in score_names))
+    return adata if copy else None
+
+
+def _control_genes(genes, obs_cut, bins, ctrl_size, random_state):
+    """Draw `ctrl_size` genes from every expression bin of `genes`."""
+    control_genes = set()
+    for cut in np.unique(obs_cut.loc[obs_cut.index.intersection(genes)]):
+        r_genes = bins[cut].copy()
+        random_state.shuffle(r_genes)
+        control_genes.update(r_genes[:ctrl_size])
+    return np.array(sorted(control_genes - set(genes)), dtype=int)
+
+
 def score_genes_cell_cycle(
         adata,
         s_genes,
@@ -147,8 +262,10 @@ def score_genes_cell_cycle(
     copy : `bool`, optional (default: `False`)
         Copy `adata` or modify it inplace.
     **kwargs : optional keyword arguments
-        Are passed to :func:`~scanpy.api.score_genes`. `ctrl_size` is not
-        possible, as it's set as `min(len(s_genes), len(g2m_genes))`.
+        Are passed to :func:`~scanpy.api.tl.score_genes_multi`. `ctrl_size` is
+        not possible, as it's set as `min(len(s_genes), len(g2m_genes))`. The
+        default `random_state=0` seeds the sampling of the reference genes,
+        which previously used the global random state.
 
     Returns
     -------
@@ -173,10 +290,10 @@ def score_genes_cell_cycle(
 
     adata = adata.copy() if copy else adata
     ctrl_size = min(len(s_genes), len(g2m_genes))
-    # add s-score
-    score_genes(adata, gene_list=s_genes, score_name='S_score', ctrl_size=ctrl_size, **kwargs)
-    # add g2m-score
-    score_genes(adata, gene_list=g2m_genes, score_name='G2M_score', ctrl_size=ctrl_size, **kwargs)
+    # add s-score and g2m-score
+    score_genes_multi(
+        adata, {'S_score': s_genes, 'G2M_score': g2m_genes},
+        ctrl_size=ctrl_size, **kwargs)
     scores = adata.obs[['S_score', 'G2M_score']]
 
     # default phase is S
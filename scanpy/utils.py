@@ -2,6 +2,7 @@
 """
 
 import inspect
+import weakref
 from collections import namedtuple
 from functools import partial
 from types import ModuleType
@@ -299,27 +300,73 @@ def get_graph_tool_from_adjacency(adjacency, directed=None):
     return g
 
 
-def get_igraph_from_adjacency(adjacency, directed=None):
-    """Get igraph graph from adjacency matrix."""
+# the last graph constructed by `get_igraph_from_adjacency` with `use_cache`,
+# by `(id(adjacency), directed)`; it is dropped with its matrix
+_igraph_cache = {}
+
+
+def get_igraph_from_adjacency(adjacency, directed=None, use_cache=False):
+    """Get igraph graph from adjacency matrix.
+
+    The edges are read from the CSR arrays of `adjacency`. Undirected graphs
+    have one edge per pair of connected nodes, taken from the upper triangle
+    of `adjacency`, which is symmetrized by averaging if needed.
+
+    Parameters
+    ----------
+    adjacency : sparse matrix
+        Weighted adjacency matrix.
+    directed : `bool` or `None`, optional (default: `None`)
+        Whether the graph is directed.
+    use_cache : `bool`, optional (default: `False`)
+        Reuse the graph last constructed from the same `adjacency` object,
+        e.g., when clustering the same neighborhood graph repeatedly. The
+        graph is reconstructed if the number or the sum of the entries of
+        `adjacency` changed. The returned graph is shared and must not be
+        modified.
+    """
+    directed = bool(directed)
+    key = (id(adjacency), directed)
+    if use_cache:
+        fingerprint = _adjacency_fingerprint(adjacency)
+        if key in _igraph_cache:
+            ref, cached_fingerprint, g = _igraph_cache[key]
+            if ref() is adjacency and cached_fingerprint == fingerprint:
+                return g
     import igraph as ig
-    sources, targets = adjacency.nonzero()
-    weights = adjacency[sources, targets]
-    if isinstance(weights, np.matrix):
-        weights = weights.A1
-    g = ig.Graph(directed=directed)
-    g.add_vertices(adjacency.shape[0])  # this adds adjacency.shap[0] vertices
-    g.add_edges(list(zip(sources, targets)))
-    try:
-        g.es['weight'] = weights
-    except:
-        pass
-    if g.vcount() != adjacency.shape[0]:
-        logg.warn('The constructed graph has only {} nodes. '
-                  'Your adjacency matrix contained redundant nodes.'
-                  .format(g.vcount()))
+    matrix = scipy.sparse.csr_matrix(adjacency)
+    if not directed:
+        if (matrix != matrix.T).nnz > 0:
+            matrix = (matrix + matrix.T) / 2
+        matrix = scipy.sparse.triu(matrix, format='csr')
+    sources = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+    targets, weights = matrix.indices, matrix.data
+    # skip explicitly stored zeros without modifying the arrays of `adjacency`
+    nonzero = weights != 0
+    if not np.all(nonzero):
+        sources, targets, weights = (
+            sources[nonzero], targets[nonzero], weights[nonzero])
+    # igraph converts sequences of python ints fastest
+    edges = list(zip(sources.tolist(), targets.tolist()))
+    g = ig.Graph(n=matrix.shape[0], edges=edges, directed=directed)
+    g.es['weight'] = weights.tolist()
+    if use_cache:
+        def drop(ref, key=key):
+            if key in _igraph_cache and _igraph_cache[key][0] is ref:
+                del _igraph_cache[key]
+        # only keep the last graph alive
+        _igraph_cache.clear()
+        _igraph_cache[key] = (weakref.ref(adjacency, drop), fingerprint, g)
     return g
 
 
+def _adjacency_fingerprint(adjacency):
+    """Cheap summary of the entries of `adjacency` to detect modifications."""
+    if scipy.sparse.issparse(adjacency):
+        return adjacency.nnz, float(adjacency.data.sum())
+    return adjacency.shape, float(np.sum(adjacency))
+
+
 def get_sparse_from_igraph(graph, weight_attr=None):
     from scipy.sparse import csr_matrix
     edges = graph.get_edgelist()